@@ -5,12 +5,20 @@ import os
 import sys
 import json
 from datetime import datetime, timedelta, time
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, ForeignKey, BigInteger, Float
+from sqlalchemy import create_engine, Column, Integer, String, Boolean, DateTime, ForeignKey, BigInteger, Float, Index, func, inspect, text
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import sessionmaker, relationship, declarative_base
 import asyncio
-from collections import defaultdict, deque
+from collections import defaultdict, deque, namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import gzip
+import hashlib
+import heapq
+import math
 import random
 import requests
+from time import monotonic, perf_counter
 
 # 心跳首次運行標誌
 heartbeat_first_run = {'executed': False}
@@ -31,7 +39,8 @@ if DATABASE_URL:
             pool_pre_ping=True,
             echo=False
         )
-        SessionLocal = sessionmaker(bind=engine)
+        # expire_on_commit=False：查詢結果在 session 關閉後仍可讀取（數據庫執行緒池回傳用）
+        SessionLocal = sessionmaker(bind=engine, expire_on_commit=False)
         print("✅ 數據庫連接已建立")
     except Exception as e:
         print(f"⚠️ 數據庫連接失敗: {e}")
@@ -68,6 +77,11 @@ class Guild(Base):
     youtube_last_subscriber_count = Column(Integer, default=0)
     youtube_notify_channel = Column(BigInteger, nullable=True)
     member_count = Column(Integer, default=0)
+    # 防炸群參數（每個伺服器獨立）
+    raid_max_joins_per_10min = Column(Integer, default=5)
+    raid_max_msgs_per_minute = Column(Integer, default=5)
+    raid_spam_threshold = Column(Integer, default=3)
+    raid_min_account_age_days = Column(Integer, default=7)
     approved_roles = relationship("ApprovedRole", back_populates="guild", cascade="all, delete-orphan")
     blacklist_entries = relationship("Blacklist", back_populates="guild", cascade="all, delete-orphan")
     whitelist_entries = relationship("Whitelist", back_populates="guild", cascade="all, delete-orphan")
@@ -88,6 +102,10 @@ class Blacklist(Base):
     reason = Column(String, nullable=True)
     added_at = Column(DateTime, default=datetime.utcnow)
     guild = relationship("Guild", back_populates="blacklist_entries")
+    __table_args__ = (
+        Index("ix_blacklist_guild_user", "guild_id", "user_id"),
+        Index("ix_blacklist_user", "user_id"),
+    )
 
 class Whitelist(Base):
     __tablename__ = "whitelist"
@@ -97,6 +115,10 @@ class Whitelist(Base):
     reason = Column(String, nullable=True)
     added_at = Column(DateTime, default=datetime.utcnow)
     guild = relationship("Guild", back_populates="whitelist_entries")
+    __table_args__ = (
+        Index("ix_whitelist_guild_user", "guild_id", "user_id"),
+        Index("ix_whitelist_user", "user_id"),
+    )
 
 class Meme(Base):
     __tablename__ = "memes"
@@ -107,6 +129,9 @@ class Meme(Base):
     uploaded_by = Column(BigInteger)
     status = Column(String, default="approved")
     uploaded_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        Index("ix_memes_guild_status", "guild_id", "status"),
+    )
 
 class Submission(Base):
     __tablename__ = "submissions"
@@ -117,6 +142,9 @@ class Submission(Base):
     submitted_by = Column(BigInteger)
     status = Column(String, default="pending")
     submitted_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        Index("ix_submissions_guild_status", "guild_id", "status"),
+    )
 
 class Warning(Base):
     __tablename__ = "warnings"
@@ -126,6 +154,9 @@ class Warning(Base):
     warned_by = Column(BigInteger)
     reason = Column(String, nullable=True)
     warned_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        Index("ix_warnings_guild_user", "guild_id", "user_id"),
+    )
 
 class Verification(Base):
     __tablename__ = "verifications"
@@ -135,6 +166,9 @@ class Verification(Base):
     verified = Column(Boolean, default=False)
     verified_at = Column(DateTime, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        Index("ix_verifications_guild_user", "guild_id", "user_id"),
+    )
 
 class DailyCheckin(Base):
     __tablename__ = "daily_checkins"
@@ -143,6 +177,9 @@ class DailyCheckin(Base):
     user_id = Column(BigInteger)
     checkin_date = Column(String)  # YYYY-MM-DD format
     checkin_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        Index("uq_daily_checkins_guild_user_date", "guild_id", "user_id", "checkin_date", unique=True),
+    )
 
 class SpamLog(Base):
     __tablename__ = "spam_logs"
@@ -154,6 +191,9 @@ class SpamLog(Base):
     seconds = Column(Integer)
     action = Column(String)  # "muted", "warned", etc
     created_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        Index("ix_spam_logs_guild_user", "guild_id", "user_id"),
+    )
 
 class AuthorizedUser(Base):
     __tablename__ = "authorized_users"
@@ -173,38 +213,357 @@ class BotHeartbeat(Base):
     latency = Column(Integer, default=0)
     updated_at = Column(DateTime, default=datetime.utcnow)
 
-# 嘗試創建所有表，如果數據庫連接失敗則忽略
-try:
+class CommandUsageLog(Base):
+    __tablename__ = "command_usage_logs"
+    id = Column(Integer, primary_key=True)
+    command_name = Column(String)
+    prefix = Column(String)  # "/" 斜線指令, "?" 前綴指令
+    user_id = Column(BigInteger)
+    guild_id = Column(BigInteger, nullable=True)
+    guild_name = Column(String, nullable=True)
+    used_at = Column(DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        Index("ix_command_usage_logs_user", "user_id"),
+        Index("ix_command_usage_logs_guild_used_at", "guild_id", "used_at"),
+    )
+
+class BroadcastJob(Base):
+    __tablename__ = "broadcast_jobs"
+    id = Column(Integer, primary_key=True)
+    kind = Column(String)  # "announcement" 廣播, "owner_notice" 版主通知
+    payload = Column(String)  # JSON：訊息內容、標題、圖片
+    status = Column(String, default="running")  # running / completed / cancelled / failed
+    requested_by = Column(BigInteger)
+    total = Column(Integer, default=0)
+    sent = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    skipped = Column(Integer, default=0)
+    last_guild_id = Column(BigInteger, default=0)  # 已處理到的伺服器 ID（依 ID 排序）
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+class ServerBackup(Base):
+    __tablename__ = "server_backups"
+    id = Column(Integer, primary_key=True)
+    guild_id = Column(BigInteger)
+    file_name = Column(String, unique=True)  # server_backups 目錄下的檔名
+    kind = Column(String, default="full")  # "full" 完整備份, "incremental" 增量備份
+    base_id = Column(Integer, nullable=True)  # 增量備份所依據的上一個備份
+    channel_count = Column(Integer, default=0)
+    role_count = Column(Integer, default=0)
+    member_count = Column(Integer, default=0)
+    changed_count = Column(Integer, nullable=True)  # 本次寫入的記錄數（增量備份只含變更）
+    size_bytes = Column(BigInteger, default=0)
+    checksum = Column(String)  # 檔案 SHA-256
+    created_at = Column(DateTime, default=datetime.now)
+    __table_args__ = (
+        Index("ix_server_backups_guild_id", "guild_id", "id"),
+    )
+
+class SchemaMigration(Base):
+    __tablename__ = "schema_migrations"
+    version = Column(Integer, primary_key=True)
+    name = Column(String)
+    applied_at = Column(DateTime, default=datetime.utcnow)
+
+# ====== 數據庫結構遷移 ======
+# create_all 只會建立不存在的表，既有表的索引 / 約束變更需透過遷移補上
+# 新增遷移：在 SCHEMA_MIGRATIONS 末尾追加 (版本號, 名稱, 函數)，函數接收交易中的 connection
+
+def _create_model_indexes(connection, *models):
+    """為既有的表補建模型中定義的索引（已存在則跳過）"""
+    for model in models:
+        for index in model.__table__.indexes:
+            index.create(bind=connection, checkfirst=True)
+
+def _migration_hot_lookup_indexes(connection):
+    _create_model_indexes(connection, Blacklist, Whitelist, Meme, Submission, Warning, Verification, SpamLog, CommandUsageLog)
+
+def _migration_unique_daily_checkin(connection):
+    # 先移除重複簽到記錄（保留最早的一筆），再建立唯一索引
+    connection.execute(text(
+        "DELETE FROM daily_checkins WHERE id NOT IN "
+        "(SELECT min_id FROM (SELECT MIN(id) AS min_id FROM daily_checkins GROUP BY guild_id, user_id, checkin_date) AS keep)"
+    ))
+    _create_model_indexes(connection, DailyCheckin)
+
+def _add_missing_columns(connection, model):
+    """為既有的表補上模型中新增的欄位（帶預設值）"""
+    existing = {column['name'] for column in inspect(connection).get_columns(model.__tablename__)}
+    for column in model.__table__.columns:
+        if column.name in existing:
+            continue
+        ddl = f"ALTER TABLE {model.__tablename__} ADD COLUMN {column.name} {column.type.compile(dialect=connection.dialect)}"
+        default = column.default.arg if column.default is not None and column.default.is_scalar else None
+        if isinstance(default, bool):
+            ddl += f" DEFAULT {'TRUE' if default else 'FALSE'}"
+        elif isinstance(default, (int, float)):
+            ddl += f" DEFAULT {default}"
+        elif isinstance(default, str):
+            ddl += " DEFAULT '" + default.replace("'", "''") + "'"
+        connection.execute(text(ddl))
+
+def _migration_guild_raid_policy(connection):
+    _add_missing_columns(connection, Guild)
+
+def _migration_reason_trigram_indexes(connection):
+    # 原因搜尋是 ILIKE '%…%'，B-tree 索引無法使用；PostgreSQL 上改用 pg_trgm GIN 索引
+    if connection.dialect.name != 'postgresql':
+        return
+    try:
+        with connection.begin_nested():
+            connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    except Exception as e:
+        print(f"⚠️ 無法啟用 pg_trgm，原因搜尋將使用順序掃描：{str(e)}")
+        return
+    for table in ("blacklist", "whitelist"):
+        connection.execute(text(
+            f"CREATE INDEX IF NOT EXISTS ix_{table}_reason_trgm ON {table} USING gin (reason gin_trgm_ops)"
+        ))
+
+def _migration_incremental_backups(connection):
+    _add_missing_columns(connection, ServerBackup)
+
+SCHEMA_MIGRATIONS = [
+    (1, "熱門查詢欄位索引", _migration_hot_lookup_indexes),
+    (2, "每日簽到唯一鍵", _migration_unique_daily_checkin),
+    (3, "伺服器防炸群參數", _migration_guild_raid_policy),
+    (4, "原因搜尋 trigram 索引", _migration_reason_trigram_indexes),
+    (5, "增量備份欄位", _migration_incremental_backups),
+]
+
+def run_migrations(engine):
+    """建立缺少的表，並依序執行尚未套用的遷移（每個遷移一個交易）"""
     Base.metadata.create_all(engine)
+    with engine.connect() as connection:
+        applied = {row[0] for row in connection.execute(text("SELECT version FROM schema_migrations"))}
+    
+    for version, name, migration in SCHEMA_MIGRATIONS:
+        if version in applied:
+            continue
+        with engine.begin() as connection:
+            migration(connection)
+            connection.execute(
+                SchemaMigration.__table__.insert().values(version=version, name=name, applied_at=datetime.utcnow())
+            )
+        print(f"✅ 已套用數據庫遷移 {version}: {name}")
+
+# 嘗試建立 / 遷移所有表，如果數據庫連接失敗則忽略
+try:
+    if engine is not None:
+        run_migrations(engine)
 except Exception as e:
     print(f"⚠️ 數據庫初始化失敗：{str(e)}")
     print("⚠️ 機器人將在沒有數據庫功能的情況下繼續運行")
 
+# ====== 異步數據庫存取層 ======
+# 所有同步 SQLAlchemy 查詢都透過專用執行緒池執行，避免慢查詢阻塞 Discord 事件循環（心跳）
+DB_EXECUTOR_WORKERS = 10  # 與連接池 pool_size 相同
+db_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+
+def _run_with_session(func, *args, **kwargs):
+    """建立 session 執行 func(session, ...)，結束後關閉（在執行緒池中運行）"""
+    session = SessionLocal()
+    try:
+        return func(session, *args, **kwargs)
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+async def run_db(func, *args, **kwargs):
+    """在數據庫執行緒池中執行 func(session, ...) 並等待結果，不阻塞事件循環"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(_run_with_session, func, *args, **kwargs))
+
+# 事件循環延遲監測（用於比較數據庫異步化前後的心跳延遲）
+EVENT_LOOP_LAG_INTERVAL = 0.5  # 取樣間隔（秒）
+event_loop_lag_stats = {'samples': 0, 'last_ms': 0.0, 'max_ms': 0.0, 'total_ms': 0.0}
+
+async def monitor_event_loop_lag():
+    """定期睡眠並量測實際喚醒延遲，延遲越大代表事件循環被阻塞越久"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        lag_ms = max(0.0, (loop.time() - start - EVENT_LOOP_LAG_INTERVAL) * 1000)
+        event_loop_lag_stats['samples'] += 1
+        event_loop_lag_stats['last_ms'] = lag_ms
+        event_loop_lag_stats['total_ms'] += lag_ms
+        if lag_ms > event_loop_lag_stats['max_ms']:
+            event_loop_lag_stats['max_ms'] = lag_ms
+
 # Discord bot setup
 intents = discord.Intents.default()
 intents.members = True
 intents.message_content = True
 # 注意：確保在 Discord 開發者門戶中啟用 Members 和 Message Content Intent
 
+# ====== 指令使用審計佇列 ======
+# 指令使用事件先放入佇列，由背景任務批次寫入數據庫並合併發送通知，避免每個指令都多一次 REST 呼叫
+COMMAND_USAGE_NOTIFICATION_CHANNEL = 1446485737166995478
+AUDIT_QUEUE_MAX = 5000  # 佇列上限，超過則丟棄並計數（背壓）
+AUDIT_FLUSH_SECONDS = 5  # 每隔幾秒發送一批
+AUDIT_BATCH_MAX = 500  # 每次最多處理的事件數
+AUDIT_EMBEDS_PER_MESSAGE = 10  # Discord 單則訊息最多 10 個 embed
+AUDIT_DIGEST_LINE_LIMIT = 4000  # 摘要 embed 描述長度上限
+
+class CommandAuditQueue:
+    """收集指令使用事件，定期批次持久化並發送到通知頻道"""
+    
+    def __init__(self, maxsize=AUDIT_QUEUE_MAX):
+        self._queue = asyncio.Queue(maxsize=maxsize)
+        self.enqueued = 0
+        self.dropped = 0
+        self.persisted = 0
+        self.messages_sent = 0
+        self.persist_failures = 0
+        self.send_failures = 0
+    
+    def record(self, prefix, command_name, user, guild):
+        """記錄一次指令使用（不等待、不阻塞指令執行）"""
+        event = {
+            'prefix': prefix,
+            'command_name': command_name,
+            'user_id': user.id,
+            'user_mention': user.mention,
+            'guild_id': guild.id if guild else None,
+            'guild_name': guild.name if guild else None,
+            'used_at': datetime.now(),
+        }
+        try:
+            self._queue.put_nowait(event)
+            self.enqueued += 1
+        except asyncio.QueueFull:
+            self.dropped += 1
+    
+    def pending(self):
+        return self._queue.qsize()
+    
+    def drain(self, limit=AUDIT_BATCH_MAX):
+        events = []
+        while len(events) < limit:
+            try:
+                events.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return events
+    
+    @staticmethod
+    def _event_embed(event):
+        """單一事件的詳細通知（事件數少時使用）"""
+        embed = discord.Embed(title="📢 指令被使用", color=discord.Color.blurple())
+        embed.add_field(name="📋 指令名稱", value=f"`{event['prefix']}{event['command_name']}`", inline=False)
+        embed.add_field(name="👤 用戶", value=f"{event['user_mention']} ({event['user_id']})", inline=False)
+        embed.add_field(name="🏘️ 伺服器", value=event['guild_name'] or "❌ 私人訊息", inline=False)
+        if event['guild_id']:
+            embed.add_field(name="🏘️ 伺服器ID", value=f"`{event['guild_id']}`", inline=False)
+        embed.add_field(name="⏰ 時間", value=event['used_at'].strftime("%Y-%m-%d %H:%M:%S"), inline=False)
+        return embed
+    
+    @staticmethod
+    def _digest_embeds(events):
+        """多個事件合併成摘要 embed（每行一個事件）"""
+        embeds = []
+        lines = []
+        length = 0
+        for event in events:
+            location = f"{event['guild_name']} (`{event['guild_id']}`)" if event['guild_id'] else "私人訊息"
+            line = f"`{event['used_at'].strftime('%H:%M:%S')}` `{event['prefix']}{event['command_name']}` - <@{event['user_id']}> @ {location}"
+            if lines and length + len(line) + 1 > AUDIT_DIGEST_LINE_LIMIT:
+                embeds.append("\n".join(lines))
+                lines, length = [], 0
+            lines.append(line)
+            length += len(line) + 1
+        if lines:
+            embeds.append("\n".join(lines))
+        return [
+            discord.Embed(title=f"📢 指令使用摘要（{len(events)} 次）", description=description, color=discord.Color.blurple())
+            for description in embeds
+        ]
+    
+    def build_embeds(self, events):
+        if len(events) <= AUDIT_EMBEDS_PER_MESSAGE:
+            return [self._event_embed(event) for event in events]
+        return self._digest_embeds(events)
+    
+    def stats(self):
+        return {
+            'pending': self.pending(),
+            'enqueued': self.enqueued,
+            'dropped': self.dropped,
+            'persisted': self.persisted,
+            'messages_sent': self.messages_sent,
+            'persist_failures': self.persist_failures,
+            'send_failures': self.send_failures,
+        }
+
+command_audit_queue = CommandAuditQueue()
+
+def _persist_command_usage(session, events):
+    session.bulk_insert_mappings(CommandUsageLog, [
+        {
+            'command_name': event['command_name'],
+            'prefix': event['prefix'],
+            'user_id': event['user_id'],
+            'guild_id': event['guild_id'],
+            'guild_name': event['guild_name'],
+            'used_at': event['used_at'],
+        }
+        for event in events
+    ])
+    session.commit()
+
+async def flush_command_audit_queue():
+    """取出佇列中的事件：寫入審計表並合併發送通知"""
+    events = command_audit_queue.drain()
+    if not events:
+        return
+    
+    try:
+        await run_db(_persist_command_usage, events)
+        command_audit_queue.persisted += len(events)
+    except Exception as e:
+        command_audit_queue.persist_failures += 1
+        print(f"⚠️ 無法寫入指令使用記錄: {str(e)}")
+    
+    notification_channel = bot.get_channel(COMMAND_USAGE_NOTIFICATION_CHANNEL)
+    if not notification_channel:
+        return
+    embeds = command_audit_queue.build_embeds(events)
+    for i in range(0, len(embeds), AUDIT_EMBEDS_PER_MESSAGE):
+        try:
+            await notification_channel.send(embeds=embeds[i:i + AUDIT_EMBEDS_PER_MESSAGE])
+            command_audit_queue.messages_sent += 1
+        except Exception as e:
+            command_audit_queue.send_failures += 1
+            print(f"⚠️ 無法發送指令使用通知: {str(e)}")
+
+@tasks.loop(seconds=AUDIT_FLUSH_SECONDS)
+async def command_audit_flush_task():
+    """定期清空指令使用審計佇列"""
+    try:
+        await flush_command_audit_queue()
+    except Exception as e:
+        print(f"⚠️ 指令使用審計批次處理錯誤: {str(e)}")
+
 # 自定義 CommandTree 以攔截所有指令使用
 class NotifyingCommandTree(app_commands.CommandTree):
-    COMMAND_USAGE_NOTIFICATION_CHANNEL = 1446485737166995478
     
     async def interaction_check(self, interaction: Interaction) -> bool:
         """攔截所有斜線指令並檢查全域黑名單"""
         # 檢查用戶是否在全域黑名單中
         try:
-            session = SessionLocal()
-            blacklist_entry = session.query(Blacklist).filter_by(user_id=interaction.user.id).first()
-            session.close()
+            is_blacklisted, blacklist_reason = await find_blacklist_entry(interaction.user.id)
             
-            if blacklist_entry:
+            if is_blacklisted:
                 embed = discord.Embed(
                     title="🚫 您已被限制使用此機器人",
                     description="您在全域黑名單中，無法使用本機器人的任何指令。",
                     color=discord.Color.red()
                 )
-                embed.add_field(name="原因", value=blacklist_entry.reason or "未提供", inline=False)
+                embed.add_field(name="原因", value=blacklist_reason or "未提供", inline=False)
                 embed.add_field(name="⏰ 時間", value=datetime.now().strftime("%Y-%m-%d %H:%M:%S"), inline=False)
                 embed.add_field(name="📋 說明", value="如有疑問，請聯繫機器人開發者", inline=False)
                 
@@ -214,62 +573,420 @@ class NotifyingCommandTree(app_commands.CommandTree):
         except Exception as e:
             print(f"⚠️ 黑名單檢查失敗: {str(e)}")
         
-        # 發送指令使用通知
+        # 記錄指令使用（由審計佇列批次發送通知）
         try:
-            notification_channel = interaction.client.get_channel(self.COMMAND_USAGE_NOTIFICATION_CHANNEL)
-            if notification_channel:
-                embed = discord.Embed(title="📢 指令被使用", color=discord.Color.blurple())
-                embed.add_field(name="📋 指令名稱", value=f"`/{interaction.command.name}`", inline=False)
-                embed.add_field(name="👤 用戶", value=f"{interaction.user.mention} ({interaction.user.id})", inline=False)
-                embed.add_field(name="🏘️ 伺服器", value=interaction.guild.name if interaction.guild else "❌ 私人訊息", inline=False)
-                if interaction.guild:
-                    embed.add_field(name="🏘️ 伺服器ID", value=f"`{interaction.guild.id}`", inline=False)
-                embed.add_field(name="⏰ 時間", value=datetime.now().strftime("%Y-%m-%d %H:%M:%S"), inline=False)
-                
-                try:
-                    await notification_channel.send(embed=embed)
-                except Exception as e:
-                    print(f"⚠️ 無法發送指令使用通知: {str(e)}")
+            command_audit_queue.record("/", interaction.command.name, interaction.user, interaction.guild)
         except Exception as e:
             print(f"⚠️ 指令使用監聽錯誤: {str(e)}")
         
         return True  # 允許指令執行
 
-bot = commands.Bot(command_prefix='!', intents=intents, tree_cls=NotifyingCommandTree)
+class ModerationBot(commands.Bot):
+    async def close(self):
+        """關閉前先寫入延遲中的包廂資料（包廂資料改為批次寫入後，不在這裡寫入會遺失最後一秒的變更）"""
+        try:
+            await flush_booth_state_stores()
+        except Exception as e:
+            print(f"⚠️ 關閉前寫入包廂資料失敗：{str(e)}")
+        await super().close()
+
+bot = ModerationBot(command_prefix='!', intents=intents, tree_cls=NotifyingCommandTree)
 
 # ====== 包廂系統 ======
+# 包廂資料保存在記憶體中，變更記錄成操作、短暫延遲後批次附加到日誌檔（在專用執行緒寫入，不阻塞事件循環）；
+# 日誌累積一定數量後壓縮回快照檔。啟動時先載入快照再重播日誌（快照格式與舊版 JSON 檔相同）
 BOOTH_FILE = 'booths.json'
-
-def load_booths():
-    """載入包廂資料"""
-    if os.path.exists(BOOTH_FILE):
-        with open(BOOTH_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {}
-
-def save_booths(booths):
-    """儲存包廂資料"""
-    with open(BOOTH_FILE, 'w', encoding='utf-8') as f:
-        json.dump(booths, f, ensure_ascii=False, indent=2)
-
-booths = load_booths()
-
-# 包廂頻道資料結構 - 存儲每個包廂的詳細資訊
 BOOTH_CHANNELS_FILE = 'booth_channels.json'
+BOOTH_STATE_FLUSH_DELAY = 1  # 變更合併寫入的等待時間（秒）
+BOOTH_STATE_COMPACT_OPS = 500  # 日誌累積多少筆操作後壓縮成快照
+BOOTH_STATE_RETRY_DELAY = 10  # 寫入失敗後重試的等待時間（秒）
+booth_state_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="booth-state")
+
+class BoothStateStore:
+    """key -> dict 的包廂資料；讀取方式與 dict 相同，修改必須透過 set / update / pop 才會寫入。
+    指定 index_field 時另外維護 欄位值 -> key 的索引，供 lookup 以 O(1) 查詢"""
+    
+    def __init__(self, path, index_field=None):
+        self.path = path
+        self.log_path = path + '.log'
+        self.index_field = index_field
+        self._data = {}
+        self._index = {}
+        self._pending = []
+        self._flush_scheduled = False
+        self._log_ops = 0
+        self.writes = 0
+        self.compactions = 0
+        self.failures = 0
+        self._load()
+    
+    def _load(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self._data = json.load(f)
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        op = json.loads(line)
+                    except ValueError:
+                        break  # 最後一行寫到一半（程序中斷），忽略
+                    self._apply(op)
+                    self._log_ops += 1
+        if self.index_field:
+            for key, value in self._data.items():
+                self._index_add(key, value)
+    
+    def _index_add(self, key, value):
+        if self.index_field and value.get(self.index_field) is not None:
+            self._index[str(value[self.index_field])] = key
+    
+    def _index_remove(self, value):
+        if self.index_field and value is not None:
+            self._index.pop(str(value.get(self.index_field)), None)
+    
+    def _apply(self, op):
+        key = op['key']
+        self._index_remove(self._data.get(key))
+        if op['op'] == 'set':
+            self._data[key] = dict(op['value'])
+        elif op['op'] == 'update':
+            if key in self._data:
+                # 以新的 dict 取代而不是原地修改，壓縮時交給寫入執行緒的淺複製快照才不會被改動
+                self._data[key] = dict(self._data[key], **op['fields'])
+        elif op['op'] == 'pop':
+            self._data.pop(key, None)
+        if key in self._data:
+            self._index_add(key, self._data[key])
+    
+    def __contains__(self, key):
+        return key in self._data
+    
+    def __getitem__(self, key):
+        return self._data[key]
+    
+    def __iter__(self):
+        return iter(self._data)
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+    
+    def lookup(self, value):
+        """以索引欄位的值查詢，回傳 (key, 資料)，找不到時回傳 (None, None)"""
+        key = self._index.get(str(value))
+        return (key, self._data[key]) if key is not None else (None, None)
+    
+    def items(self):
+        return self._data.items()
+    
+    def values(self):
+        return self._data.values()
+    
+    def set(self, key, value):
+        self._record({'op': 'set', 'key': key, 'value': dict(value)})
+    
+    def update(self, key, **fields):
+        if key in self._data:
+            self._record({'op': 'update', 'key': key, 'fields': fields})
+    
+    def pop(self, key):
+        value = self._data.get(key)
+        if value is not None:
+            self._record({'op': 'pop', 'key': key})
+        return value
+    
+    def pending(self):
+        return len(self._pending)
+    
+    def _record(self, op):
+        self._apply(op)
+        self._pending.append(op)
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            expiry_scheduler.schedule(BOOTH_STATE_FLUSH_DELAY, self.flush)
+    
+    def _write(self, ops, snapshot):
+        """在寫入執行緒執行；snapshot 為 _data 的淺複製，在這裡才序列化"""
+        if snapshot is None:
+            with open(self.log_path, 'a', encoding='utf-8') as f:
+                for op in ops:
+                    f.write(json.dumps(op, ensure_ascii=False) + '\n')
+            return
+        # 快照已包含這批操作：寫入暫存檔後原子替換，再清空日誌
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        open(self.log_path, 'w').close()
+    
+    async def flush(self):
+        self._flush_scheduled = False
+        if not self._pending and self._log_ops < BOOTH_STATE_COMPACT_OPS:
+            return
+        ops, self._pending = self._pending, []
+        self._log_ops += len(ops)
+        snapshot = None
+        if self._log_ops >= BOOTH_STATE_COMPACT_OPS:
+            snapshot = dict(self._data)
+            self._log_ops = 0
+        try:
+            await asyncio.get_running_loop().run_in_executor(booth_state_executor, self._write, ops, snapshot)
+            self.writes += 1
+            if snapshot is not None:
+                self.compactions += 1
+        except Exception as e:
+            # 稍後重試並改為寫入完整快照，記憶體中的資料不會遺失
+            self.failures += 1
+            self._log_ops = BOOTH_STATE_COMPACT_OPS
+            print(f"⚠️ 無法寫入包廂資料 {self.path}：{str(e)}")
+            if not self._flush_scheduled:
+                self._flush_scheduled = True
+                expiry_scheduler.schedule(BOOTH_STATE_RETRY_DELAY, self.flush)
 
-def load_booth_channels():
-    """載入包廂頻道資料"""
-    if os.path.exists(BOOTH_CHANNELS_FILE):
-        with open(BOOTH_CHANNELS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {}
-
-def save_booth_channels(data):
-    """儲存包廂頻道資料"""
-    with open(BOOTH_CHANNELS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+booths = BoothStateStore(BOOTH_FILE, index_field='entry_channel')  # 類別 ID -> 包廂系統設定（以入口頻道 ID 索引）
 
-booth_channels = load_booth_channels()
+# 包廂頻道資料結構 - 存儲每個包廂的詳細資訊
+booth_channels = BoothStateStore(BOOTH_CHANNELS_FILE)
+booth_state_stores = [booths, booth_channels]
+
+async def flush_booth_state_stores():
+    """關閉前寫入所有尚未寫入的包廂資料"""
+    for store in booth_state_stores:
+        await store.flush()
+
+# ====== 包廂預熱池 ======
+# 可選：每個包廂類別預先建立隱藏的待命包廂，成員進入入口時直接認領（改名、設定權限並移入），
+# 省去即時建立頻道的時間；認領後在背景補回。待命包廂記錄在 booth_channels（pooled=True），重啟後仍可使用
+BOOTH_POOL_MAX = 5  # 每個類別最多待命包廂數
+BOOTH_POOL_CHANNEL_NAME = "🗣️包廂-待命"
+
+def booth_overwrites(member, guild):
+    """包廂主人的頻道權限（其他人預設無法加入）"""
+    return {
+        member: discord.PermissionOverwrite(
+            connect=True, speak=True, stream=True,
+            use_voice_activation=True, move_members=True,
+            manage_channels=True
+        ),
+        guild.default_role: discord.PermissionOverwrite(connect=False)
+    }
+
+class BoothPool:
+    """類別 ID -> 待命包廂；另記錄認領（pooled）與即時建立（on_demand）的延遲以便比較"""
+    
+    def __init__(self):
+        self._idle = defaultdict(deque)  # 類別 ID -> 待命包廂頻道 ID
+        self._refilling = set()
+        self.latency = {mode: {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0} for mode in ('pooled', 'on_demand')}
+    
+    def load(self):
+        """從 booth_channels 重建待命清單（啟動時）"""
+        self._idle.clear()
+        for channel_id, data in booth_channels.items():
+            if data.get('pooled'):
+                self._idle[data['category_id']].append(channel_id)
+    
+    def idle_count(self, category_id):
+        return len(self._idle.get(category_id, ()))
+    
+    def record_latency(self, mode, seconds):
+        stats = self.latency[mode]
+        elapsed_ms = seconds * 1000
+        stats['count'] += 1
+        stats['total_ms'] += elapsed_ms
+        if elapsed_ms > stats['max_ms']:
+            stats['max_ms'] = elapsed_ms
+    
+    async def claim(self, category_id, member):
+        """認領一個待命包廂並把成員移入；沒有可用的待命包廂時回傳 None"""
+        idle = self._idle.get(category_id)
+        while idle:
+            channel_id = idle.popleft()
+            channel = member.guild.get_channel(int(channel_id))
+            if channel is None:
+                booth_channels.pop(channel_id)
+                continue
+            # 先設定權限再移入：改名或權限設定失敗時成員還沒進入這個沒有主人的頻道
+            try:
+                await channel.edit(name=f"🗣️包廂-{member.display_name}", overwrites=booth_overwrites(member, member.guild))
+            except Exception as e:
+                print(f"⚠️ 無法認領待命包廂 {channel_id}：{str(e)}")
+                await self._discard(channel_id, channel)
+                continue
+            try:
+                await member.move_to(channel)
+            except Exception as e:
+                # 成員已離開語音或無法移動：刪除已設定給此成員的頻道，改由即時建立處理
+                print(f"⚠️ 無法移入待命包廂 {channel_id}：{str(e)}")
+                await self._discard(channel_id, channel)
+                return None
+            return channel
+        return None
+    
+    async def _discard(self, channel_id, channel):
+        """移除記錄並刪除頻道（只移除記錄會留下永遠不會被回收的隱藏頻道）"""
+        booth_channels.pop(channel_id)
+        try:
+            await channel.delete(reason="待命包廂認領失敗")
+        except discord.NotFound:
+            pass
+        except Exception as e:
+            print(f"⚠️ 無法刪除待命包廂 {channel_id}：{str(e)}")
+    
+    def request_refill(self, category_id):
+        if category_id in self._refilling:
+            return
+        self._refilling.add(category_id)
+        bot.loop.create_task(self._refill(category_id))
+    
+    async def _refill(self, category_id):
+        try:
+            data = booths.get(category_id)
+            category = bot.get_channel(int(category_id))
+            if not data or not category:
+                return
+            target = min(data.get('pool_size', 0), BOOTH_POOL_MAX)
+            while self.idle_count(category_id) < target:
+                channel = await category.create_voice_channel(
+                    BOOTH_POOL_CHANNEL_NAME,
+                    user_limit=5,
+                    overwrites={category.guild.default_role: discord.PermissionOverwrite(view_channel=False, connect=False)},
+                    reason="包廂預熱池"
+                )
+                booth_channels.set(str(channel.id), {
+                    'owner_id': None,
+                    'password': None,
+                    'is_locked': False,
+                    'guild_id': category.guild.id,
+                    'category_id': category_id,
+                    'pooled': True,
+                    'created_at': datetime.now().isoformat()
+                })
+                self._idle[category_id].append(str(channel.id))
+        except Exception as e:
+            print(f"⚠️ 包廂預熱池補充失敗：{str(e)}")
+        finally:
+            self._refilling.discard(category_id)
+    
+    def discard_category(self, category_id):
+        """移除類別的待命記錄（頻道已由呼叫端刪除）"""
+        for channel_id in self._idle.pop(category_id, ()):
+            booth_channels.pop(channel_id)
+    
+    async def shrink(self, category_id, target=0):
+        """刪除多出的待命包廂"""
+        idle = self._idle.get(category_id)
+        while idle and len(idle) > target:
+            channel_id = idle.pop()
+            booth_channels.pop(channel_id)
+            channel = bot.get_channel(int(channel_id))
+            if channel:
+                try:
+                    await channel.delete(reason="包廂預熱池縮減")
+                except Exception as e:
+                    print(f"⚠️ 無法刪除待命包廂：{str(e)}")
+
+booth_pool = BoothPool()
+
+# ====== 空包廂回收 ======
+# 包廂變空後先等待寬限期，期間有人回來就取消刪除，避免快速離開/重新加入時反覆建立與刪除頻道；
+# 到期的包廂依伺服器合併成一批刪除。啟動時一次比對 booth_channels 與實際頻道，清掉重啟期間遺留的包廂
+BOOTH_REAP_GRACE = 30  # 包廂變空後保留的秒數
+
+class BoothReaper:
+    """guild_id -> {包廂頻道 ID: 刪除期限}"""
+    
+    def __init__(self):
+        self._pending = defaultdict(dict)
+        self._scheduled = set()  # 已排定回收的伺服器
+        self.reaped = 0
+        self.rescued = 0
+        self.failed = 0
+        self.orphans = 0
+    
+    def pending(self):
+        return sum(len(channels) for channels in self._pending.values())
+    
+    def mark_empty(self, channel):
+        """包廂變空：寬限期後回收"""
+        channels = self._pending[channel.guild.id]
+        channels.setdefault(str(channel.id), monotonic() + BOOTH_REAP_GRACE)
+        self._schedule(channel.guild.id, BOOTH_REAP_GRACE)
+    
+    def cancel(self, channel):
+        """有人回到包廂：取消回收"""
+        channels = self._pending.get(channel.guild.id)
+        if channels and channels.pop(str(channel.id), None) is not None:
+            self.rescued += 1
+    
+    def forget(self, channel):
+        """包廂已由其他地方刪除：移除待回收項目（不計入取消次數）"""
+        channels = self._pending.get(channel.guild.id)
+        if channels:
+            channels.pop(str(channel.id), None)
+    
+    def _schedule(self, guild_id, delay):
+        if guild_id in self._scheduled:
+            return
+        self._scheduled.add(guild_id)
+        expiry_scheduler.schedule(delay, lambda: self._reap(guild_id))
+    
+    async def _reap(self, guild_id):
+        self._scheduled.discard(guild_id)
+        channels = self._pending.get(guild_id)
+        if not channels:
+            self._pending.pop(guild_id, None)
+            return
+        now = monotonic()
+        due = [channel_id for channel_id, deadline in channels.items() if deadline <= now]
+        for channel_id in due:
+            del channels[channel_id]
+        await self._delete_batch(bot.get_guild(guild_id), due)
+        if channels:
+            self._schedule(guild_id, max(min(channels.values()) - now, 0))
+        else:
+            self._pending.pop(guild_id, None)
+    
+    async def _delete_batch(self, guild, channel_ids):
+        """一次刪除同一伺服器的多個空包廂（期間又有人加入的略過）"""
+        channels = []
+        for channel_id in channel_ids:
+            channel = guild.get_channel(int(channel_id)) if guild else None
+            if channel and channel.members:
+                continue
+            booth_channels.pop(channel_id)
+            if channel:
+                channels.append(channel)
+        if not channels:
+            return
+        results = await asyncio.gather(*(channel.delete(reason="空包廂回收") for channel in channels), return_exceptions=True)
+        for channel, result in zip(channels, results):
+            if isinstance(result, Exception) and not isinstance(result, discord.NotFound):
+                self.failed += 1
+                print(f"⚠️ 無法刪除包廂 {channel.name}：{str(result)}")
+            else:
+                self.reaped += 1
+        print(f"🧹 已回收 {guild.name} 的 {len(channels)} 個空包廂")
+    
+    def reconcile(self):
+        """啟動時比對一次：頻道已不存在的記錄直接移除，沒有成員的包廂排入回收（待命包廂除外）"""
+        for channel_id, data in list(booth_channels.items()):
+            guild = bot.get_guild(data['guild_id']) if data.get('guild_id') else None
+            if guild is not None and guild.unavailable:
+                continue
+            channel = bot.get_channel(int(channel_id))
+            if channel is None:
+                booth_channels.pop(channel_id)
+                self.orphans += 1
+            elif not channel.members and not data.get('pooled'):
+                self.mark_empty(channel)
+        if self.orphans or self.pending():
+            print(f"🧹 包廂比對完成：移除 {self.orphans} 筆失效記錄，{self.pending()} 個空包廂待回收")
+
+booth_reaper = BoothReaper()
 
 # ====== 包廂控制面板 UI 類 ======
 
@@ -291,9 +1008,7 @@ class PasswordModal(ui.Modal, title='🔒 設置包廂密碼'):
         channel_id_str = str(self.voice_channel_id)
         
         if channel_id_str in booth_channels:
-            booth_channels[channel_id_str]['password'] = self.password.value
-            booth_channels[channel_id_str]['is_locked'] = True
-            save_booth_channels(booth_channels)
+            booth_channels.update(channel_id_str, password=self.password.value, is_locked=True)
             
             embed = discord.Embed(
                 title='🔒 包廂已上鎖',
@@ -406,9 +1121,7 @@ class BoothControlView(ui.View):
         channel_id_str = str(self.voice_channel_id)
         if channel_id_str in booth_channels:
             if booth_channels[channel_id_str].get('is_locked'):
-                booth_channels[channel_id_str]['is_locked'] = False
-                booth_channels[channel_id_str]['password'] = None
-                save_booth_channels(booth_channels)
+                booth_channels.update(channel_id_str, is_locked=False, password=None)
                 
                 voice_channel = interaction.guild.get_channel(self.voice_channel_id)
                 if voice_channel:
@@ -469,9 +1182,7 @@ class BoothControlView(ui.View):
         if voice_channel:
             try:
                 channel_id_str = str(self.voice_channel_id)
-                if channel_id_str in booth_channels:
-                    del booth_channels[channel_id_str]
-                    save_booth_channels(booth_channels)
+                booth_channels.pop(channel_id_str)
                 
                 await voice_channel.delete(reason=f'包廂主人 {interaction.user} 關閉了包廂')
                 
@@ -503,61 +1214,324 @@ class BoothControlView(ui.View):
 # 前缀命令使用通知
 @bot.before_invoke
 async def notify_prefix_command_usage(ctx):
-    """監聽前缀命令使用並發送通知"""
+    """監聽前缀命令使用並放入審計佇列"""
     try:
-        notification_channel = bot.get_channel(1446485737166995478)
-        if notification_channel:
-            embed = discord.Embed(title="📢 指令被使用", color=discord.Color.blurple())
-            embed.add_field(name="📋 指令名稱", value=f"`?{ctx.command.name}`", inline=False)
-            embed.add_field(name="👤 用戶", value=f"{ctx.author.mention} ({ctx.author.id})", inline=False)
-            embed.add_field(name="🏘️ 伺服器", value=ctx.guild.name if ctx.guild else "❌ 私人訊息", inline=False)
-            if ctx.guild:
-                embed.add_field(name="🏘️ 伺服器ID", value=f"`{ctx.guild.id}`", inline=False)
-            embed.add_field(name="⏰ 時間", value=datetime.now().strftime("%Y-%m-%d %H:%M:%S"), inline=False)
-            
-            try:
-                await notification_channel.send(embed=embed)
-            except Exception as e:
-                print(f"⚠️ 無法發送前缀命令通知: {str(e)}")
+        command_audit_queue.record("?", ctx.command.name, ctx.author, ctx.guild)
     except Exception as e:
         print(f"⚠️ 前缀命令使用監聽錯誤: {str(e)}")
 
-# 防刷屏追蹤
-spam_tracker = defaultdict(lambda: {'messages': [], 'muted': False})
+# ====== 延遲清理排程 ======
+# 所有「N 秒後清理」的工作共用一個最小堆 + 單一背景任務，取代每個鍵各開一個 sleep 任務
+class ExpiryScheduler:
+    """到期排程：schedule(delay, callback, key) 於 delay 秒後呼叫 callback；同 key 重新排程會取代舊的"""
+    
+    def __init__(self):
+        self._heap = []  # (到期時間, 序號, key, callback)
+        self._keys = {}  # key -> 目前有效的序號
+        self._seq = 0
+        self._stale = 0  # 堆中已被取消 / 取代的項目數
+        self._wakeup = None
+        self.scheduled = 0
+        self.fired = 0
+        self.cancelled = 0
+        self.max_lateness_ms = 0.0
+        self.total_lateness_ms = 0.0
+    
+    def schedule(self, delay, callback, key=None):
+        self._seq += 1
+        heapq.heappush(self._heap, (monotonic() + delay, self._seq, key, callback))
+        if key is not None:
+            if key in self._keys:
+                self._stale += 1
+                self.cancelled += 1
+            self._keys[key] = self._seq
+        self.scheduled += 1
+        # 新項目比原本最早的還早到期時，喚醒背景任務重新計算等待時間
+        if self._wakeup is not None and self._heap[0][1] == self._seq:
+            self._wakeup.set()
+    
+    def cancel(self, key):
+        if self._keys.pop(key, None) is not None:
+            self._stale += 1
+            self.cancelled += 1
+    
+    def pending(self):
+        return len(self._heap) - self._stale
+    
+    async def _run_callback(self, coro):
+        try:
+            await coro
+        except Exception as e:
+            print(f"⚠️ 延遲清理工作失敗：{str(e)}")
+    
+    def _fire(self, callback, lateness_ms):
+        self.fired += 1
+        self.total_lateness_ms += lateness_ms
+        if lateness_ms > self.max_lateness_ms:
+            self.max_lateness_ms = lateness_ms
+        try:
+            result = callback()
+            if asyncio.iscoroutine(result):
+                asyncio.get_running_loop().create_task(self._run_callback(result))
+        except Exception as e:
+            print(f"⚠️ 延遲清理工作失敗：{str(e)}")
+    
+    async def run(self):
+        """背景任務：睡到最早的到期時間，執行所有已到期的工作"""
+        self._wakeup = asyncio.Event()
+        while True:
+            now = monotonic()
+            while self._heap and self._heap[0][0] <= now:
+                deadline, seq, key, callback = heapq.heappop(self._heap)
+                if key is not None:
+                    if self._keys.get(key) != seq:
+                        self._stale -= 1
+                        continue
+                    del self._keys[key]
+                self._fire(callback, (now - deadline) * 1000)
+            
+            timeout = self._heap[0][0] - now if self._heap else None
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+expiry_scheduler = ExpiryScheduler()
+
+# ====== 用戶狀態儲存（防刷屏用） ======
+# 以用戶為鍵的狀態有 TTL（閒置多久後移除）與 LRU 上限，避免記憶體隨見過的用戶數無限增長
+USER_STATE_MAX_ENTRIES = 100000  # 每個儲存最多保留的用戶數
+USER_STATE_SWEEP_SECONDS = 60  # 清理過期狀態的間隔
+
+class _StateSlot:
+    __slots__ = ('value', 'touched')
+    
+    def __init__(self, value, touched):
+        self.value = value
+        self.touched = touched
+
+class UserStateStore:
+    """TTL + LRU 的狀態儲存：get() 不存在時以 factory 建立，並更新最後使用時間"""
+    
+    def __init__(self, name, factory, ttl, max_entries=USER_STATE_MAX_ENTRIES):
+        self.name = name
+        self._factory = factory
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # 依最後使用時間排序（最舊在前）
+        self.evicted = 0
+        self.expired = 0
+        user_state_stores.append(self)
+    
+    def _touch(self, key, value):
+        slot = self._entries.get(key)
+        if slot is None:
+            self._entries[key] = _StateSlot(value, monotonic())
+            if len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+        else:
+            slot.value = value
+            slot.touched = monotonic()
+            self._entries.move_to_end(key)
+    
+    def get(self, key):
+        slot = self._entries.get(key)
+        if slot is None:
+            value = self._factory()
+            self._touch(key, value)
+            return value
+        slot.touched = monotonic()
+        self._entries.move_to_end(key)
+        return slot.value
+    
+    def peek(self, key, default=None):
+        """讀取但不建立、不更新使用時間"""
+        slot = self._entries.get(key)
+        return default if slot is None else slot.value
+    
+    def set(self, key, value):
+        self._touch(key, value)
+    
+    def incr(self, key, amount=1):
+        value = self.get(key) + amount
+        self._touch(key, value)
+        return value
+    
+    def pop(self, key, default=None):
+        slot = self._entries.pop(key, None)
+        return default if slot is None else slot.value
+    
+    def discard_where(self, predicate):
+        """移除所有 predicate(key) 為 True 的狀態"""
+        for key in [key for key in self._entries if predicate(key)]:
+            del self._entries[key]
+    
+    def sweep(self):
+        """移除閒置超過 TTL 的狀態（依使用時間排序，只需從最舊的開始檢查）"""
+        cutoff = monotonic() - self.ttl
+        while self._entries:
+            key, slot = next(iter(self._entries.items()))
+            if slot.touched >= cutoff:
+                break
+            del self._entries[key]
+            self.expired += 1
+    
+    def __contains__(self, key):
+        return key in self._entries
+    
+    def __len__(self):
+        return len(self._entries)
 
-# 追蹤每個成員的訊息歷史 (最近50條) - 用於刷頻偵測
-message_history = defaultdict(lambda: deque(maxlen=50))
+user_state_stores = []
+
+@tasks.loop(seconds=USER_STATE_SWEEP_SECONDS)
+async def sweep_user_state_stores():
+    """定期清理所有用戶狀態儲存中的過期項目"""
+    for store in user_state_stores:
+        try:
+            store.sweep()
+        except Exception as e:
+            print(f"⚠️ 清理用戶狀態 {store.name} 失敗：{str(e)}")
+
+class SlidingWindowCounter:
+    """滑動窗口計數器：把窗口分成固定數量的桶，每次事件只更新當前桶，成本與窗口內事件數無關"""
+    __slots__ = ('window', 'bucket_width', 'buckets', 'current', 'total')
+    
+    def __init__(self, window, bucket_count=20):
+        self.window = window
+        self.bucket_width = window / bucket_count
+        self.buckets = [0] * bucket_count
+        self.current = None  # 當前桶的序號（monotonic 時間 // 桶寬）
+        self.total = 0
+    
+    def _advance(self, now):
+        index = int(now // self.bucket_width)
+        if self.current is None:
+            self.current = index
+            return
+        # 清空從上次事件到現在之間經過的桶（最多清空整個環）
+        size = len(self.buckets)
+        steps = min(index - self.current, size)
+        for i in range(1, steps + 1):
+            slot = (self.current + i) % size
+            self.total -= self.buckets[slot]
+            self.buckets[slot] = 0
+        self.current = max(self.current, index)
+    
+    def hit(self, now=None):
+        """記錄一次事件並回傳窗口內的事件數"""
+        self._advance(monotonic() if now is None else now)
+        self.buckets[self.current % len(self.buckets)] += 1
+        self.total += 1
+        return self.total
+    
+    def count(self, now=None):
+        self._advance(monotonic() if now is None else now)
+        return self.total
+    
+    def clear(self):
+        self.buckets = [0] * len(self.buckets)
+        self.current = None
+        self.total = 0
+
+class SpamWindowState:
+    __slots__ = ('messages', 'muted')
+    
+    def __init__(self):
+        self.messages = []
+        self.muted = False
+
+class RateLimitState:
+    __slots__ = ('messages', 'warning_triggered', 'warnings', 'muted_until')
+    
+    def __init__(self):
+        self.messages = SlidingWindowCounter(RATE_LIMIT_WINDOW)  # 窗口內消息數
+        self.warning_triggered = False  # 本次窗口是否已警告
+        self.warnings = 0  # 累積警告次數
+        self.muted_until = None  # 禁言截止時間
+
+def content_fingerprint(content):
+    """把訊息內容壓縮成 64 位元整數（合併連續空白後雜湊），用於重複訊息比對"""
+    normalized = " ".join(content.split())
+    return int.from_bytes(hashlib.blake2b(normalized.encode(), digest_size=8).digest(), 'little')
+
+class RecentFingerprints:
+    """最近 N 條訊息的指紋與出現次數，新增時增量更新，查詢重複次數為 O(1)"""
+    __slots__ = ('order', 'counts')
+    
+    def __init__(self, maxlen=50):
+        self.order = deque(maxlen=maxlen)
+        self.counts = {}
+    
+    def add(self, fingerprint):
+        """加入一條訊息指紋，回傳該指紋在最近 N 條中的出現次數"""
+        if len(self.order) == self.order.maxlen:
+            oldest = self.order[0]
+            remaining = self.counts[oldest] - 1
+            if remaining:
+                self.counts[oldest] = remaining
+            else:
+                del self.counts[oldest]
+        self.order.append(fingerprint)
+        count = self.counts.get(fingerprint, 0) + 1
+        self.counts[fingerprint] = count
+        return count
+    
+    def clear(self):
+        self.order.clear()
+        self.counts.clear()
+
+# 防刷屏追蹤 ("guild_id_user_id" -> SpamWindowState)
+spam_tracker = UserStateStore('spam_tracker', SpamWindowState, ttl=3600)
+
+# 追蹤每個成員的訊息指紋 (最近50條) - 用於刷頻偵測
+message_history = UserStateStore('message_history', RecentFingerprints, ttl=3600)
 
 # 刷頻控制
 spam_stop_flag = {'stop': False}
 spam_count = {'current': 0, 'total': 0, 'active': False}
 
 # ====== 防炸群防護系統 ======
-# 監測設定（可調整）
+# 監測設定預設值（各伺服器可用 /設定防炸 調整，存於 Guild 表）
 MAX_JOINS_PER_10MIN = 5  # 10分鐘內最多加入人數
 MAX_MSGS_PER_MINUTE = 5  # 1分鐘內最多訊息數
 SPAM_THRESHOLD = 3  # 相同訊息重複次數
 MIN_ACCOUNT_AGE_DAYS = 7  # 帳號至少7天才允許
 
-# 儲存加入記錄
-join_times = defaultdict(deque)
-# 儲存訊息計數
-message_counts = defaultdict(lambda: defaultdict(deque))
+RaidPolicy = namedtuple('RaidPolicy', ['max_joins_per_10min', 'max_msgs_per_minute', 'spam_threshold', 'min_account_age_days'])
+DEFAULT_RAID_POLICY = RaidPolicy(MAX_JOINS_PER_10MIN, MAX_MSGS_PER_MINUTE, SPAM_THRESHOLD, MIN_ACCOUNT_AGE_DAYS)
+
+def raid_policy_from_config(guild_config):
+    """從伺服器設定快照取出防炸群參數（沒有設定時使用預設值）"""
+    if guild_config is None:
+        return DEFAULT_RAID_POLICY
+    return RaidPolicy(
+        guild_config.raid_max_joins_per_10min or MAX_JOINS_PER_10MIN,
+        guild_config.raid_max_msgs_per_minute or MAX_MSGS_PER_MINUTE,
+        guild_config.raid_spam_threshold or SPAM_THRESHOLD,
+        guild_config.raid_min_account_age_days if guild_config.raid_min_account_age_days is not None else MIN_ACCOUNT_AGE_DAYS,
+    )
+
+async def get_raid_policy(guild_id):
+    """取得伺服器的防炸群參數（經由伺服器設定快取，不會每次查詢數據庫；沒有設定記錄時使用預設值，不建立記錄）"""
+    return raid_policy_from_config(await guild_config_cache.get(guild_id))
+
+# 儲存加入記錄 (guild_id -> 10 分鐘滑動窗口計數)
+join_times = defaultdict(lambda: SlidingWindowCounter(600))
+# 儲存訊息計數 ((guild_id, user_id) -> 1 分鐘滑動窗口計數)
+message_counts = UserStateStore('message_counts', lambda: SlidingWindowCounter(60), ttl=120)
 # 儲存 spam 訊息計數
 spam_messages = defaultdict(int)
 
 # ====== 速率限制系統 ======
-# 追蹤用戶的速率限制 (user_id -> {'messages': deque(timestamps), 'warning_triggered': False, 'warnings': 0, 'muted_until': None})
-rate_limit_tracker = defaultdict(lambda: {
-    'messages': deque(),  # 儲存消息時間戳
-    'warning_triggered': False,  # 本次窗口是否已警告
-    'warnings': 0,  # 累積警告次數
-    'muted_until': None  # 禁言截止時間
-})
 RATE_LIMIT_WINDOW = 20  # 20秒窗口
 RATE_LIMIT_MSG_THRESHOLD = 10  # 20秒內超過 10 條消息觸發警告
 RATE_LIMIT_WARNINGS_FOR_MUTE = 3  # 3 次警告後禁言
 RATE_LIMIT_MUTE_DURATION = 600  # 禁言 10 分鐘
+# 追蹤用戶的速率限制 (user_id -> RateLimitState)；閒置 6 小時後警告次數歸零
+rate_limit_tracker = UserStateStore('rate_limit_tracker', RateLimitState, ttl=6 * 3600)
 
 # 定時關閉追蹤
 scheduled_shutdown_task = None
@@ -565,46 +1539,251 @@ scheduled_shutdown_task = None
 # 開發者用戶列表
 DEVELOPER_USERS = {1406241569669120041,1437267041248743426}
 
-def get_or_create_guild(guild_id):
-    session = SessionLocal()
+def _get_or_create_guild(session, guild_id):
     guild = session.query(Guild).filter_by(guild_id=guild_id).first()
     if not guild:
         guild = Guild(guild_id=guild_id)
         session.add(guild)
         session.commit()
-    session.close()
     return guild
 
+def _add_and_commit(session, obj):
+    session.add(obj)
+    session.commit()
+    return obj
+
+def _delete_all_and_commit(session, model):
+    count = session.query(model).delete()
+    session.commit()
+    return count
+
+# ====== 伺服器設定快取 ======
+# Guild 欄位的不可變快照，熱路徑（每條訊息、每條日誌）只讀快取，不再每次查詢數據庫
+GuildConfig = namedtuple('GuildConfig', [column.name for column in Guild.__table__.columns])
+
+def _load_guild_config(session, guild_id, create=False):
+    if create:
+        guild = _get_or_create_guild(session, guild_id)
+    else:
+        guild = session.query(Guild).filter_by(guild_id=guild_id).first()
+    if not guild:
+        return None
+    return GuildConfig(**{name: getattr(guild, name) for name in GuildConfig._fields})
+
+class GuildConfigCache:
+    """guild_id -> GuildConfig 快取，延遲載入；修改 Guild 的指令必須呼叫 invalidate()"""
+    _MISSING = object()  # 數據庫中沒有此伺服器（負快取）
+    
+    def __init__(self):
+        self._configs = {}
+        self._generation = 0  # 每次失效遞增，避免載入途中被失效的舊資料寫回快取
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+    
+    async def get(self, guild_id, create=False):
+        """取得伺服器設定快照；create=True 時若不存在則建立預設記錄"""
+        config = self._configs.get(guild_id)
+        if config is not None and not (create and config is self._MISSING):
+            self.hits += 1
+            return None if config is self._MISSING else config
+        
+        self.misses += 1
+        generation = self._generation
+        config = await run_db(_load_guild_config, guild_id, create)
+        if generation == self._generation:
+            self._configs[guild_id] = self._MISSING if config is None else config
+        return config
+    
+    def invalidate(self, guild_id=None):
+        """使單一伺服器（或全部）的快取失效"""
+        self._generation += 1
+        self.invalidations += 1
+        if guild_id is None:
+            self._configs.clear()
+        else:
+            self._configs.pop(guild_id, None)
+    
+    def stats(self):
+        total = self.hits + self.misses
+        hit_rate = self.hits / total * 100 if total else 0.0
+        return {'size': len(self._configs), 'hits': self.hits, 'misses': self.misses,
+                'invalidations': self.invalidations, 'hit_rate': hit_rate}
+
+guild_config_cache = GuildConfigCache()
+
+# ====== 黑名單記憶體索引 ======
+# 啟動時載入整份黑名單，interaction_check / on_member_join 的檢查變成 O(1) 字典查詢，不需數據庫 I/O
+BLACKLIST_BLOOM_THRESHOLD = 500000  # 超過此筆數改用 Bloom filter（只存位元，命中時再查數據庫確認）
+BLACKLIST_BLOOM_ERROR_RATE = 0.001
+BLACKLIST_RECONCILE_MINUTES = 10
+
+class BloomFilter:
+    """簡易 Bloom filter：不存在的鍵一定回傳 False，存在時有極小機率誤判"""
+    
+    def __init__(self, capacity, error_rate=BLACKLIST_BLOOM_ERROR_RATE):
+        capacity = max(1, capacity)
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+    
+    def _positions(self, key):
+        digest = hashlib.blake2b(str(key).encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+    
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+    
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+class BlacklistIndex:
+    """黑名單成員索引：user_id -> {guild_id: 原因}；超大名單時改為 Bloom filter 模式"""
+    
+    def __init__(self):
+        self.loaded = False
+        self._reasons = {}
+        self._user_bloom = None
+        self._pair_bloom = None
+        self._epoch = 0  # 每次增刪遞增，重新載入期間若有變動則放棄該次快照
+        self.entry_count = 0
+    
+    @property
+    def exact(self):
+        return self._user_bloom is None
+    
+    def load(self, rows):
+        """以 (user_id, guild_id, reason) 列表重建索引"""
+        if len(rows) > BLACKLIST_BLOOM_THRESHOLD:
+            self._reasons = {}
+            self._user_bloom = BloomFilter(len(rows) * 2)
+            self._pair_bloom = BloomFilter(len(rows) * 2)
+            for user_id, guild_id, _ in rows:
+                self._user_bloom.add(user_id)
+                self._pair_bloom.add((guild_id, user_id))
+        else:
+            reasons = {}
+            for user_id, guild_id, reason in rows:
+                reasons.setdefault(user_id, {})[guild_id] = reason
+            self._reasons = reasons
+            self._user_bloom = None
+            self._pair_bloom = None
+        self.entry_count = len(rows)
+        self.loaded = True
+    
+    def add(self, user_id, guild_id, reason):
+        self._epoch += 1
+        if self.exact:
+            guilds = self._reasons.setdefault(user_id, {})
+            if guild_id not in guilds:
+                self.entry_count += 1
+            guilds[guild_id] = reason
+        else:
+            self.entry_count += 1
+            self._user_bloom.add(user_id)
+            self._pair_bloom.add((guild_id, user_id))
+    
+    def remove(self, user_id, guild_id=None):
+        """移除用戶（guild_id 為 None 時移除所有伺服器）；Bloom 模式無法刪除，由數據庫確認處理"""
+        self._epoch += 1
+        if not self.exact:
+            return
+        if guild_id is None:
+            self.entry_count -= len(self._reasons.pop(user_id, {}))
+            return
+        guilds = self._reasons.get(user_id)
+        if guilds and guild_id in guilds:
+            del guilds[guild_id]
+            self.entry_count -= 1
+            if not guilds:
+                del self._reasons[user_id]
+    
+    def clear(self):
+        self._epoch += 1
+        self.load([])
+    
+    def might_contain(self, user_id, guild_id=None):
+        """False 代表一定不在黑名單中"""
+        if self.exact:
+            guilds = self._reasons.get(user_id)
+            return bool(guilds) and (guild_id is None or guild_id in guilds)
+        if guild_id is None:
+            return user_id in self._user_bloom
+        return (guild_id, user_id) in self._pair_bloom
+    
+    def reason(self, user_id, guild_id=None):
+        guilds = self._reasons.get(user_id, {})
+        if guild_id is not None:
+            return guilds.get(guild_id)
+        return next(iter(guilds.values()), None)
+
+blacklist_index = BlacklistIndex()
+
+def _load_blacklist_rows(session):
+    return [tuple(row) for row in session.query(Blacklist.user_id, Blacklist.guild_id, Blacklist.reason).all()]
+
+async def reload_blacklist_index():
+    """從數據庫重新載入黑名單索引"""
+    epoch = blacklist_index._epoch
+    rows = await run_db(_load_blacklist_rows)
+    if blacklist_index.loaded and epoch != blacklist_index._epoch:
+        print("⚠️ 黑名單索引重新載入期間有變動，等待下一次同步")
+        return
+    blacklist_index.load(rows)
+    mode = "精確" if blacklist_index.exact else "Bloom filter"
+    print(f"✅ 黑名單索引已載入 {len(rows)} 筆記錄（{mode}模式）")
+
+async def find_blacklist_entry(user_id, guild_id=None):
+    """檢查用戶是否在黑名單中，回傳 (是否命中, 原因)；索引載入前退回數據庫查詢"""
+    if blacklist_index.loaded:
+        if not blacklist_index.might_contain(user_id, guild_id):
+            return False, None
+        if blacklist_index.exact:
+            return True, blacklist_index.reason(user_id, guild_id)
+    
+    def _query(session):
+        query = session.query(Blacklist).filter_by(user_id=user_id)
+        if guild_id is not None:
+            query = query.filter_by(guild_id=guild_id)
+        return query.first()
+    
+    entry = await run_db(_query)
+    return (True, entry.reason) if entry else (False, None)
+
+@tasks.loop(minutes=BLACKLIST_RECONCILE_MINUTES)
+async def reconcile_blacklist_index():
+    """定期與數據庫同步黑名單索引（處理其他程序直接修改數據庫的情況）"""
+    try:
+        await reload_blacklist_index()
+    except Exception as e:
+        print(f"⚠️ 黑名單索引同步失敗：{str(e)}")
+
 def is_bot_admin(user_id: int) -> bool:
     """檢查用戶是否是開發者或副主人"""
     bot_owner_id = int(os.environ.get('BOT_OWNER_ID', 0))
     return user_id == bot_owner_id or user_id in DEVELOPER_USERS
 
-def can_use_dangerous_commands(user_id: int) -> bool:
+async def can_use_dangerous_commands(user_id: int) -> bool:
     """檢查用戶是否可以使用危險指令（開發者、副主人或授權人員）"""
     if is_bot_admin(user_id):
         return True
     
-    session = SessionLocal()
-    authorized = session.query(AuthorizedUser).filter_by(user_id=user_id).first()
-    session.close()
+    authorized = await run_db(lambda session: session.query(AuthorizedUser).filter_by(user_id=user_id).first())
     return authorized is not None
 
-def has_permission(interaction: Interaction) -> bool:
+async def has_permission(interaction: Interaction) -> bool:
     if not interaction.guild or not interaction.member:
         return False
     if interaction.member.guild_permissions.administrator:
         return True
     
-    session = SessionLocal()
-    guild = session.query(Guild).filter_by(guild_id=interaction.guild_id).first()
-    if guild:
-        for approved_role in guild.approved_roles:
-            if interaction.user.get_role(approved_role.role_id):
-                session.close()
-                return True
-    session.close()
-    return False
+    approved_role_ids = await run_db(
+        lambda session: [r.role_id for r in session.query(ApprovedRole).filter_by(guild_id=interaction.guild_id).all()]
+    )
+    return any(interaction.user.get_role(role_id) for role_id in approved_role_ids)
 
 # 設定機器人語言為繁體中文
 LANGUAGE = "zh_TW"
@@ -615,27 +1794,31 @@ PROTECTED_GUILDS = {1426496974265258017, 1431918791025098817}
 # 受保護的伺服器 ID（不能使用危險指令）
 PROTECTED_SERVERS = {1442032146482073834}
 
+def _add_protected_server_blacklist(session, guild_id, user_id, reason):
+    """若用戶尚未在全域黑名單中則加入，回傳是否新增"""
+    existing = session.query(Blacklist).filter_by(user_id=user_id).first()
+    if existing:
+        return False
+    session.add(Blacklist(guild_id=guild_id, user_id=user_id, reason=reason))
+    session.commit()
+    return True
+
+async def add_protected_server_blacklist(guild_id, user_id, reason):
+    added = await run_db(_add_protected_server_blacklist, guild_id, user_id, reason)
+    if added:
+        blacklist_index.add(user_id, guild_id, reason)
+    return added
+
 async def check_dangerous_command(interaction: Interaction) -> bool:
     """檢查用戶是否可以使用危險指令，並在受保護伺服器自動添加到黑名單"""
-    if not can_use_dangerous_commands(interaction.user.id):
+    if not await can_use_dangerous_commands(interaction.user.id):
         return False
     
     # 檢查是否在受保護伺服器使用危險指令
     if interaction.guild_id in PROTECTED_SERVERS:
         # 自動添加到全域黑名單
-        session = SessionLocal()
-        try:
-            existing = session.query(Blacklist).filter_by(user_id=interaction.user.id).first()
-            if not existing:
-                blacklist_entry = Blacklist(
-                    guild_id=interaction.guild_id if interaction.guild else 0,
-                    user_id=interaction.user.id,
-                    reason="在受保護伺服器嘗試使用危險指令"
-                )
-                session.add(blacklist_entry)
-                session.commit()
-        finally:
-            session.close()
+        await add_protected_server_blacklist(interaction.guild_id if interaction.guild else 0,
+                                             interaction.user.id, "在受保護伺服器嘗試使用危險指令")
         
         return False
     
@@ -643,7 +1826,7 @@ async def check_dangerous_command(interaction: Interaction) -> bool:
 
 async def check_authorized_command(interaction: Interaction) -> bool:
     """檢查用戶是否可以使用授權人員指令，並在受保護伺服器自動添加到黑名單"""
-    if not can_use_dangerous_commands(interaction.user.id):
+    if not await can_use_dangerous_commands(interaction.user.id):
         print(f"⚠️ 用戶 {interaction.user.id} 沒有授權人員權限")
         return False
     
@@ -652,20 +1835,9 @@ async def check_authorized_command(interaction: Interaction) -> bool:
     if interaction.guild_id in PROTECTED_SERVERS:
         print(f"🚫 用戶 {interaction.user.id} 在受保護伺服器 {interaction.guild_id} 嘗試使用危險指令！")
         # 自動添加到全域黑名單
-        session = SessionLocal()
-        try:
-            existing = session.query(Blacklist).filter_by(user_id=interaction.user.id).first()
-            if not existing:
-                blacklist_entry = Blacklist(
-                    guild_id=interaction.guild_id if interaction.guild else 0,
-                    user_id=interaction.user.id,
-                    reason="在受保護伺服器嘗試使用授權人員指令"
-                )
-                session.add(blacklist_entry)
-                session.commit()
-                print(f"✅ 用戶 {interaction.user.id} 已添加到黑名單")
-        finally:
-            session.close()
+        if await add_protected_server_blacklist(interaction.guild_id if interaction.guild else 0,
+                                                interaction.user.id, "在受保護伺服器嘗試使用授權人員指令"):
+            print(f"✅ 用戶 {interaction.user.id} 已添加到黑名單")
         
         return False
     
@@ -717,6 +1889,52 @@ async def on_ready():
     if not heartbeat_ping_bot1.is_running():
         heartbeat_ping_bot1.start()
         print("✅ Bot1 心跳監測已啟動")
+    
+    if not command_audit_flush_task.is_running():
+        command_audit_flush_task.start()
+        print("✅ 指令使用審計佇列已啟動")
+    
+    if not sweep_user_state_stores.is_running():
+        sweep_user_state_stores.start()
+        print("✅ 用戶狀態清理任務已啟動")
+    
+    if not reconcile_blacklist_index.is_running():
+        reconcile_blacklist_index.start()  # 首次執行即完成初始載入
+        print("✅ 黑名單索引同步任務已啟動")
+    
+    if not getattr(bot, 'broadcast_resumed', False):
+        bot.broadcast_resumed = True
+        try:
+            await broadcast_jobs.resume_all()
+        except Exception as e:
+            print(f"⚠️ 無法繼續未完成的廣播任務：{str(e)}")
+    
+    if not getattr(bot, 'booth_pool_loaded', False):
+        bot.booth_pool_loaded = True
+        booth_reaper.reconcile()
+        booth_pool.load()
+        for category_id, data in booths.items():
+            if data.get('pool_size'):
+                booth_pool.request_refill(category_id)
+    
+    if not getattr(bot, 'backup_catalog_synced', False):
+        bot.backup_catalog_synced = True
+        try:
+            await import_untracked_backups()
+        except Exception as e:
+            print(f"⚠️ 無法同步備份目錄：{str(e)}")
+    
+    if not compact_server_backups.is_running():
+        compact_server_backups.start()
+        print("✅ 備份壓縮任務已啟動")
+    
+    if not getattr(bot, 'loop_lag_task', None):
+        bot.loop_lag_task = bot.loop.create_task(monitor_event_loop_lag())
+        print("✅ 事件循環延遲監測已啟動")
+    
+    if not getattr(bot, 'expiry_task', None):
+        bot.expiry_task = bot.loop.create_task(expiry_scheduler.run())
+        print("✅ 延遲清理排程已啟動")
 
 @tasks.loop(minutes=5)
 async def heartbeat_ping_bot1():
@@ -742,6 +1960,30 @@ async def heartbeat_ping_bot1():
     except Exception as e:
         print(f"❌ Bot1 心跳發送失敗：{str(e)}")
 
+def _save_heartbeat(session, bot_id, guild_count, total_members, ping_ms, guild_member_counts):
+    heartbeat = session.query(BotHeartbeat).filter_by(bot_id=bot_id).first()
+    if not heartbeat:
+        heartbeat = BotHeartbeat(
+            bot_id=bot_id,
+            guild_count=guild_count,
+            member_count=total_members,
+            latency=ping_ms
+        )
+        session.add(heartbeat)
+    else:
+        heartbeat.last_heartbeat = datetime.utcnow()
+        heartbeat.guild_count = guild_count
+        heartbeat.member_count = total_members
+        heartbeat.latency = ping_ms
+        heartbeat.updated_at = datetime.utcnow()
+    
+    # 同時更新每個伺服器的成員數到數據庫
+    for guild_db in session.query(Guild).filter(Guild.guild_id.in_(list(guild_member_counts))).all():
+        # 存儲成員數到專用欄位
+        guild_db.member_count = guild_member_counts[guild_db.guild_id]
+    
+    session.commit()
+
 @tasks.loop(minutes=1)
 async def update_bot_status():
     """每分鐘更新機器人的活動狀態和心跳"""
@@ -760,34 +2002,8 @@ async def update_bot_status():
         await bot.change_presence(activity=activity)
         
         # 更新心跳到數據庫
-        session = SessionLocal()
-        try:
-            heartbeat = session.query(BotHeartbeat).filter_by(bot_id=bot.user.id).first()
-            if not heartbeat:
-                heartbeat = BotHeartbeat(
-                    bot_id=bot.user.id,
-                    guild_count=guild_count,
-                    member_count=total_members,
-                    latency=ping_ms
-                )
-                session.add(heartbeat)
-            else:
-                heartbeat.last_heartbeat = datetime.utcnow()
-                heartbeat.guild_count = guild_count
-                heartbeat.member_count = total_members
-                heartbeat.latency = ping_ms
-                heartbeat.updated_at = datetime.utcnow()
-            
-            # 同時更新每個伺服器的成員數到數據庫
-            for guild in bot.guilds:
-                guild_db = session.query(Guild).filter_by(guild_id=guild.id).first()
-                if guild_db:
-                    # 存儲成員數到專用欄位
-                    guild_db.member_count = guild.member_count or 0
-            
-            session.commit()
-        finally:
-            session.close()
+        guild_member_counts = {guild.id: guild.member_count or 0 for guild in bot.guilds}
+        await run_db(_save_heartbeat, bot.user.id, guild_count, total_members, ping_ms, guild_member_counts)
     except Exception as e:
         print(f"❌ 更新機器人狀態失敗: {e}")
 
@@ -817,205 +2033,768 @@ async def remove_developer_permission_sunday():
         except Exception as e:
             print(f"❌ 移除授權失敗: {str(e)}")
 
-async def handle_spam_detection(message):
-    """異步後台執行防刷屏檢測，不阻塞事件循環"""
+# ====== 用戶資料快取 ======
+# 名單類指令顯示用戶名稱時依序查詢：bot.get_user -> 快取 -> 有限並行數的 fetch_user，
+# 查不到的用戶也會快取（避免每次列表都重新請求）
+USER_PROFILE_TTL = 3600  # 用戶資料快取保留時間（秒）
+USER_FETCH_CONCURRENCY = 5  # 同時進行的 fetch_user 請求數
+_PROFILE_MISSING = object()
+
+user_profile_cache = UserStateStore('user_profiles', lambda: None, ttl=USER_PROFILE_TTL)
+user_profile_stats = {'hits': 0, 'fetches': 0, 'not_found': 0}
+
+async def resolve_users(user_ids):
+    """批次取得用戶資料，回傳 {user_id: User 或 None}"""
+    users = {}
+    missing = []
+    for user_id in dict.fromkeys(user_ids):
+        user = bot.get_user(user_id)
+        if user is None:
+            user = user_profile_cache.peek(user_id, _PROFILE_MISSING)
+            if user is _PROFILE_MISSING:
+                missing.append(user_id)
+                continue
+        user_profile_stats['hits'] += 1
+        users[user_id] = user
+    
+    if missing:
+        semaphore = asyncio.Semaphore(USER_FETCH_CONCURRENCY)
+        
+        async def _fetch(user_id):
+            async with semaphore:
+                try:
+                    user = await bot.fetch_user(user_id)
+                except discord.NotFound:
+                    user_profile_stats['not_found'] += 1
+                    user_profile_cache.set(user_id, None)
+                    return None
+                except Exception as e:
+                    print(f"⚠️ 無法取得用戶 {user_id}：{str(e)}")
+                    return None
+                user_profile_stats['fetches'] += 1
+                user_profile_cache.set(user_id, user)
+                return user
+        
+        results = await asyncio.gather(*(_fetch(user_id) for user_id in missing))
+        users.update(zip(missing, results))
+    return users
+
+# ====== 名單分頁檢視 ======
+# 黑名單 / 白名單 / 警告列表以主鍵做 keyset 分頁（WHERE id > 游標 ORDER BY id LIMIT n），
+# 每次翻頁只查一頁，不再一次載入整張表
+LISTING_PAGE_SIZE = 10
+LISTING_VIEW_TIMEOUT = 300
+
+def reason_filter(model, reason):
+    """原因關鍵字過濾（跳脫 LIKE 萬用字元；PostgreSQL 上由 trigram 索引支援）"""
+    escaped = reason.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return model.reason.ilike(f"%{escaped}%", escape='\\')
+
+def _keyset_page(session, model, filters, cursor, descending=False):
+    """取得游標之後的一頁，多取一筆用來判斷是否還有下一頁"""
+    query = session.query(model).filter(*filters)
+    if cursor is not None:
+        query = query.filter(model.id < cursor if descending else model.id > cursor)
+    rows = query.order_by(model.id.desc() if descending else model.id).limit(LISTING_PAGE_SIZE + 1).all()
+    return rows[:LISTING_PAGE_SIZE], len(rows) > LISTING_PAGE_SIZE
+
+class KeysetPaginatorView(ui.View):
+    """上一頁 / 下一頁按鈕；記錄每頁的起始游標，返回上一頁時不需要 OFFSET"""
+    
+    def __init__(self, author_id: int, model, filters, render, descending: bool = False):
+        super().__init__(timeout=LISTING_VIEW_TIMEOUT)
+        self.author_id = author_id
+        self.model = model
+        self.filters = list(filters)
+        self.render = render  # async (entries, 頁碼, 總筆數) -> Embed
+        self.descending = descending
+        self.cursors = [None]
+        self.entries = []
+        self.has_next = False
+        self.total = 0
+    
+    async def load(self, count=False):
+        """查詢目前游標所在的一頁並產生 embed（count=True 時一併統計總筆數）"""
+        cursor = self.cursors[-1]
+        
+        def _query(session):
+            entries, has_next = _keyset_page(session, self.model, self.filters, cursor, self.descending)
+            total = session.query(func.count(self.model.id)).filter(*self.filters).scalar() if count else None
+            return entries, has_next, total
+        
+        self.entries, self.has_next, total = await run_db(_query)
+        if total is not None:
+            self.total = total
+        self.previous_page.disabled = len(self.cursors) == 1
+        self.next_page.disabled = not self.has_next
+        return await self.render(self.entries, len(self.cursors), self.total)
+    
+    async def interaction_check(self, interaction: Interaction):
+        if interaction.user.id != self.author_id:
+            await interaction.response.send_message('❌ 只有使用指令的人可以翻頁', ephemeral=True)
+            return False
+        return True
+    
+    @ui.button(label='◀ 上一頁', style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: Interaction, button: ui.Button):
+        await interaction.response.defer()
+        if len(self.cursors) > 1:
+            self.cursors.pop()
+        embed = await self.load()
+        await interaction.edit_original_response(embed=embed, view=self)
+    
+    @ui.button(label='下一頁 ▶', style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: Interaction, button: ui.Button):
+        await interaction.response.defer()
+        if self.has_next and self.entries:
+            self.cursors.append(self.entries[-1].id)
+        embed = await self.load()
+        await interaction.edit_original_response(embed=embed, view=self)
+
+def listing_page_footer(embed, page, total):
+    pages = max(1, math.ceil(total / LISTING_PAGE_SIZE))
+    embed.set_footer(text=f"第 {page} / {pages} 頁・共 {total} 筆")
+    return embed
+
+def member_list_renderer(title, color, show_guild=True):
+    """黑名單 / 白名單頁面：用戶、所屬伺服器、原因、時間"""
+    async def render(entries, page, total):
+        embed = discord.Embed(title=title, color=color)
+        users = await resolve_users(entry.user_id for entry in entries)
+        for entry in entries:
+            u = users.get(entry.user_id)
+            user_info = f"👤 {u} (ID: {entry.user_id})" if u else f"👤 ID: {entry.user_id}"
+            value = f"原因: {entry.reason or '無'}\n時間: {entry.added_at.strftime('%Y-%m-%d %H:%M:%S') if entry.added_at else '未知'}"
+            if show_guild:
+                guild = bot.get_guild(entry.guild_id)
+                value = f"伺服器: {guild.name if guild else f'未知伺服器 ({entry.guild_id})'}\n" + value
+            embed.add_field(name=user_info, value=value, inline=False)
+        return listing_page_footer(embed, page, total)
+    return render
+
+async def send_paginated_listing(interaction: Interaction, model, filters, render, empty_message, descending=False, ephemeral=True):
+    """回應第一頁（empty_message 可為文字或 Embed）；只有一頁時不附加翻頁按鈕。查詢與取得用戶資料可能超過 3 秒，先 defer 再以 followup 回覆"""
+    await interaction.response.defer(ephemeral=ephemeral)
     try:
-        if not message.guild:
+        view = KeysetPaginatorView(interaction.user.id, model, filters, render, descending)
+        embed = await view.load(count=True)
+        if not view.entries:
+            if isinstance(empty_message, discord.Embed):
+                await interaction.followup.send(embed=empty_message, ephemeral=ephemeral)
+            else:
+                await interaction.followup.send(empty_message, ephemeral=ephemeral)
             return
+        if view.has_next:
+            await interaction.followup.send(embed=embed, view=view, ephemeral=ephemeral)
+        else:
+            await interaction.followup.send(embed=embed, ephemeral=ephemeral)
+    except Exception as e:
+        await interaction.followup.send(f"❌ 查詢失敗：{str(e)}", ephemeral=True)
+
+# ====== 審核動作執行器 ======
+# 刪訊息 / 踢人 / 禁言 / 通知依伺服器排隊執行：同頻道的刪除合併成批量刪除，同路由的請求保持最小間隔
+MODERATION_ROUTE_INTERVALS = {  # 各類請求在同一路由上的最小間隔（秒）
+    'delete': 0.3,
+    'send': 0.5,
+    'kick': 0.3,
+    'timeout': 0.3,
+}
+MODERATION_BULK_DELETE_MAX = 100  # Discord 批量刪除上限
+
+class ModerationAction:
+    __slots__ = ('kind', 'route', 'target', 'kwargs', 'future', 'queued_at')
+    
+    def __init__(self, kind, route, target, kwargs):
+        self.kind = kind
+        self.route = route
+        self.target = target
+        self.kwargs = kwargs
+        self.future = asyncio.get_running_loop().create_future()
+        self.queued_at = monotonic()
+
+class ModerationExecutor:
+    """每個伺服器一個佇列與背景 worker；enqueue 系列方法回傳 Future，需要結果時可 await"""
+    
+    def __init__(self):
+        self._queues = {}  # guild_id -> deque[ModerationAction]
+        self._workers = {}  # guild_id -> asyncio.Task
+        self._route_ready_at = {}  # 路由 -> 下次可發送的 monotonic 時間
+        self.completed = defaultdict(int)
+        self.failed = defaultdict(int)
+        self.bulk_deletes = 0
+        self.rate_limited = 0
+        self.total_latency_ms = 0.0
+        self.max_latency_ms = 0.0
+    
+    def _enqueue(self, guild_id, kind, route, target, **kwargs):
+        action = ModerationAction(kind, route, target, kwargs)
+        self._queues.setdefault(guild_id, deque()).append(action)
+        worker = self._workers.get(guild_id)
+        if worker is None or worker.done():
+            self._workers[guild_id] = asyncio.get_running_loop().create_task(self._worker(guild_id))
+        return action.future
+    
+    def delete(self, message):
+        return self._enqueue(message.guild.id, 'delete', ('delete', message.channel.id), message)
+    
+    def send(self, channel, content=None, **kwargs):
+        return self._enqueue(channel.guild.id, 'send', ('send', channel.id), channel, content=content, **kwargs)
+    
+    def kick(self, member, reason=None):
+        return self._enqueue(member.guild.id, 'kick', ('kick', member.guild.id), member, reason=reason)
+    
+    def timeout(self, member, duration, reason=None):
+        return self._enqueue(member.guild.id, 'timeout', ('timeout', member.guild.id), member, duration=duration, reason=reason)
+    
+    def queue_depth(self):
+        return sum(len(queue) for queue in self._queues.values())
+    
+    async def _wait_for_route(self, route):
+        delay = self._route_ready_at.get(route, 0) - monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        self._route_ready_at[route] = monotonic() + MODERATION_ROUTE_INTERVALS[route[0]]
+    
+    def _finish(self, action, error=None, result=None):
+        latency_ms = (monotonic() - action.queued_at) * 1000
+        self.total_latency_ms += latency_ms
+        if latency_ms > self.max_latency_ms:
+            self.max_latency_ms = latency_ms
+        if error is None:
+            self.completed[action.kind] += 1
+            if not action.future.done():
+                action.future.set_result(result)
+        else:
+            self.failed[action.kind] += 1
+            if not action.future.done():
+                action.future.set_exception(error)
+                action.future.exception()  # 沒有人 await 時不顯示未取得例外的警告
+    
+    async def _call(self, action, coro_factory):
+        """執行一個請求；遇到 429 依 retry_after 暫停該路由後重試一次"""
+        await self._wait_for_route(action.route)
+        try:
+            return await coro_factory()
+        except discord.HTTPException as e:
+            if e.status != 429:
+                raise
+            self.rate_limited += 1
+            retry_after = getattr(e, 'retry_after', None) or 1.0
+            self._route_ready_at[action.route] = monotonic() + retry_after
+            await self._wait_for_route(action.route)
+            return await coro_factory()
+    
+    async def _bulk_delete(self, channel_id, actions):
+        """同一頻道的刪除合併成批量刪除（失敗時逐則刪除）"""
+        unique = list({action.target.id: action.target for action in actions}.values())
+        channel = actions[0].target.channel
+        for i in range(0, len(unique), MODERATION_BULK_DELETE_MAX):
+            chunk = unique[i:i + MODERATION_BULK_DELETE_MAX]
+            chunk_ids = {message.id for message in chunk}
+            chunk_actions = [action for action in actions if action.target.id in chunk_ids]
+            try:
+                if len(chunk) == 1:
+                    await self._call(chunk_actions[0], chunk[0].delete)
+                else:
+                    await self._call(chunk_actions[0], lambda: channel.delete_messages(chunk))
+                    self.bulk_deletes += 1
+                for action in chunk_actions:
+                    self._finish(action)
+            except discord.NotFound:
+                for action in chunk_actions:
+                    self._finish(action)  # 訊息已被刪除
+            except Exception:
+                for action in chunk_actions:
+                    try:
+                        await self._call(action, action.target.delete)
+                        self._finish(action)
+                    except discord.NotFound:
+                        self._finish(action)
+                    except Exception as e:
+                        self._finish(action, error=e)
+    
+    async def _run_action(self, action):
+        target = action.target
+        kwargs = action.kwargs
+        try:
+            if action.kind == 'send':
+                result = await self._call(action, lambda: target.send(**kwargs))
+            elif action.kind == 'kick':
+                result = await self._call(action, lambda: target.kick(reason=kwargs['reason']))
+            else:
+                result = await self._call(action, lambda: target.timeout(kwargs['duration'], reason=kwargs['reason']))
+            self._finish(action, result=result)
+        except Exception as e:
+            self._finish(action, error=e)
+    
+    async def _worker(self, guild_id):
+        queue = self._queues[guild_id]
+        batch = []
+        try:
+            while queue:
+                # 取出目前排隊中的所有動作：刪除依頻道合併，其餘依序執行
+                batch = list(queue)
+                queue.clear()
+                deletes = defaultdict(list)
+                for action in batch:
+                    if action.kind == 'delete':
+                        deletes[action.route[1]].append(action)
+                for channel_id, actions in deletes.items():
+                    await self._bulk_delete(channel_id, actions)
+                for action in batch:
+                    if action.kind != 'delete':
+                        await self._run_action(action)
+        except Exception as e:
+            print(f"⚠️ 審核動作執行器錯誤：{str(e)}")
+            # 這批尚未完成的動作改為失敗，避免 await 結果的呼叫端永遠等待
+            for action in batch:
+                if not action.future.done():
+                    self._finish(action, error=e)
+        finally:
+            if not queue:
+                self._queues.pop(guild_id, None)
+            self._workers.pop(guild_id, None)
+    
+    def stats(self):
+        completed = sum(self.completed.values())
+        failed = sum(self.failed.values())
+        done = completed + failed
+        return {
+            'queue_depth': self.queue_depth(),
+            'active_guilds': len(self._workers),
+            'completed': completed,
+            'failed': failed,
+            'bulk_deletes': self.bulk_deletes,
+            'rate_limited': self.rate_limited,
+            'avg_latency_ms': self.total_latency_ms / done if done else 0.0,
+            'max_latency_ms': self.max_latency_ms,
+        }
+
+moderation_executor = ModerationExecutor()
+
+# ====== 訊息審核管線 ======
+# 所有防刷屏偵測器在同一次掃描中依序執行（共用同一個訊息上下文），每條訊息最多只執行一個處理動作
+class ModerationContext:
+    __slots__ = ('message', 'guild', 'author', 'now', 'guild_config', 'verdicts')
+    
+    def __init__(self, message, guild_config):
+        self.message = message
+        self.guild = message.guild
+        self.author = message.author
+        self.now = datetime.now()
+        self.guild_config = guild_config
+        self.verdicts = []
+
+class ModerationVerdict:
+    """偵測結果：severity 越高越優先；stop=True 時不再執行後續偵測器"""
+    __slots__ = ('stage', 'severity', 'action', 'details', 'stop')
+    
+    def __init__(self, stage, severity, action, stop=False, **details):
+        self.stage = stage
+        self.severity = severity
+        self.action = action
+        self.details = details
+        self.stop = stop
+
+MODERATION_STAGES = []  # [(名稱, 偵測函數)]，依註冊順序執行
+moderation_stats = {'messages': 0, 'actions': defaultdict(int), 'suppressed': 0, 'stages': {}}
+
+def moderation_stage(name):
+    """註冊偵測器：函數接收 ModerationContext，回傳 ModerationVerdict 或 None"""
+    def decorator(func):
+        MODERATION_STAGES.append((name, func))
+        moderation_stats['stages'][name] = {'calls': 0, 'hits': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+        return func
+    return decorator
+
+async def run_moderation_pipeline(message):
+    """對伺服器訊息執行所有偵測器，並在背景執行最嚴重的一個處理動作"""
+    # 不建立記錄：沒有設定的伺服器為 None，各偵測器改用預設的防炸群參數
+    guild_config = await guild_config_cache.get(message.guild.id)
+    ctx = ModerationContext(message, guild_config)
+    moderation_stats['messages'] += 1
+    
+    for name, detector in MODERATION_STAGES:
+        stage_stats = moderation_stats['stages'][name]
+        start = perf_counter()
+        try:
+            verdict = detector(ctx)
+        except Exception as e:
+            verdict = None
+            print(f"⚠️ 審核階段 {name} 失敗：{str(e)}")
+        elapsed_ms = (perf_counter() - start) * 1000
+        stage_stats['calls'] += 1
+        stage_stats['total_ms'] += elapsed_ms
+        if elapsed_ms > stage_stats['max_ms']:
+            stage_stats['max_ms'] = elapsed_ms
+        if verdict:
+            stage_stats['hits'] += 1
+            ctx.verdicts.append(verdict)
+            if verdict.stop:
+                break
+    
+    if not ctx.verdicts:
+        return
+    verdict = max(ctx.verdicts, key=lambda v: v.severity)
+    moderation_stats['actions'][verdict.stage] += 1
+    moderation_stats['suppressed'] += len(ctx.verdicts) - 1
+    bot.loop.create_task(_run_moderation_action(ctx, verdict))
+
+async def _run_moderation_action(ctx, verdict):
+    try:
+        await verdict.action(ctx, verdict)
+    except Exception as e:
+        print(f"⚠️ 審核處理 {verdict.stage} 失敗：{str(e)}")
+
+# --- 速率限制 (20秒內超過 10 條消息時警告，3 次警告禁言 10 分鐘) ---
+async def _action_rate_limit_muted(ctx, verdict):
+    message = ctx.message
+    remaining_time = verdict.details['remaining']
+    minutes = int(remaining_time) // 60
+    seconds = int(remaining_time) % 60
+    moderation_executor.delete(message)
+    moderation_executor.send(message.channel, f"⏳ {message.author.mention} **您正在禁言中** \n禁言剩餘時間：{minutes} 分 {seconds} 秒", delete_after=5)
+
+async def _action_rate_limit_warn(ctx, verdict):
+    message = ctx.message
+    moderation_executor.delete(message)
+    moderation_executor.send(message.channel, f"⚠️ {message.author.mention} **發送信息過快** (OO發送信息過快)", delete_after=5)
+    print(f"⚠️ 用戶 {message.author} 觸發速率限制警告 (20秒內 {verdict.details['count']} 條消息)")
+
+async def _action_rate_limit_mute(ctx, verdict):
+    await _action_rate_limit_warn(ctx, verdict)
+    message = ctx.message
+    tracker = verdict.details['tracker']
+    now = ctx.now
+    try:
+        await moderation_executor.timeout(
+            message.author,
+            timedelta(seconds=RATE_LIMIT_MUTE_DURATION),
+            reason="速率限制：發送信息過快"
+        )
+        tracker.muted_until = now + timedelta(seconds=RATE_LIMIT_MUTE_DURATION)
+        tracker.warning_triggered = False
         
-        session = SessionLocal()
-        guild_config = session.query(Guild).filter_by(guild_id=message.guild.id).first()
-        session.close()
+        embed = discord.Embed(
+            title="🔇 您已被禁言 10 分鐘",
+            description="因為發送信息過快（速率限制違規）",
+            color=discord.Color.orange()
+        )
+        embed.add_field(name="原因", value="在 20 秒內發送超過 10 條消息，已累積 3 次警告", inline=False)
+        embed.add_field(name="禁言時長", value="10 分鐘", inline=False)
+        embed.add_field(name="⏰ 禁言時間", value=now.strftime("%Y-%m-%d %H:%M:%S"), inline=False)
         
-        if not guild_config:
-            guild_config = Guild(guild_id=message.guild.id)
-            sess = SessionLocal()
-            sess.add(guild_config)
-            sess.commit()
-            sess.close()
+        try:
+            await message.author.send(embed=embed)
+        except:
+            pass
         
-        if not guild_config.anti_spam_enabled:
-            return
+        # 發送日誌
+        embed_log = discord.Embed(
+            title="🔇 用戶因速率限制被禁言 10 分鐘",
+            color=discord.Color.orange()
+        )
+        embed_log.add_field(name="用戶", value=f"{message.author} (ID: {message.author.id})", inline=False)
+        embed_log.add_field(name="原因", value="在 20 秒內發送超過 10 條消息，累積 3 次警告", inline=False)
+        embed_log.add_field(name="觸發警告數", value=f"{tracker.warnings} 次", inline=False)
+        await send_log_to_channel(message.guild, embed_log)
         
-        user_key = f"{message.guild.id}_{message.author.id}"
-        current_time = datetime.now()
+        print(f"🔇 用戶 {message.author} 因速率限制被禁言 10 分鐘")
+    except discord.Forbidden:
+        moderation_executor.send(message.channel, "❌ 無法禁言該成員 (權限不足)", delete_after=10)
+    except Exception as e:
+        print(f"⚠️ 禁言處理失敗: {str(e)}")
+
+@moderation_stage('rate_limit')
+def detect_rate_limit(ctx):
+    tracker = rate_limit_tracker.get(ctx.author.id)
+    now = ctx.now
+    
+    # 禁言期間：刪除訊息並略過其他偵測
+    if tracker.muted_until and now < tracker.muted_until:
+        return ModerationVerdict('rate_limit', 100, _action_rate_limit_muted, stop=True,
+                                 remaining=(tracker.muted_until - now).total_seconds())
+    
+    # 重置禁言狀態如果時間到期
+    if tracker.muted_until and now >= tracker.muted_until:
+        tracker.muted_until = None
+        tracker.warning_triggered = False
+        print(f"✅ 用戶 {ctx.author} 禁言時間已到期，已重置")
+    
+    # 記錄當前消息並取得 20 秒窗口內的消息數
+    msg_count_in_window = tracker.messages.hit()
+    
+    # 如果超過閾值且本窗口還未警告過，發出警告
+    if msg_count_in_window > RATE_LIMIT_MSG_THRESHOLD and not tracker.warning_triggered:
+        tracker.warning_triggered = True
+        tracker.warnings += 1
+        print(f"⚠️ 用戶 {ctx.author} 警告 {tracker.warnings}/{RATE_LIMIT_WARNINGS_FOR_MUTE}")
+        
+        # 達到 3 次警告時禁言 10 分鐘
+        if tracker.warnings >= RATE_LIMIT_WARNINGS_FOR_MUTE:
+            return ModerationVerdict('rate_limit', 40, _action_rate_limit_mute, count=msg_count_in_window, tracker=tracker)
+        return ModerationVerdict('rate_limit', 20, _action_rate_limit_warn, count=msg_count_in_window)
+    
+    # 當窗口內消息數回到閾值以下時，重置警告狀態
+    if msg_count_in_window <= RATE_LIMIT_MSG_THRESHOLD and tracker.warning_triggered:
+        tracker.warning_triggered = False
+        print(f"✅ 用戶 {ctx.author} 消息速率恢復正常，重置本次警告狀態")
+    return None
+
+# --- 刷頻偵測 (最近 50 條中相同訊息達 10 次，禁言 7 天) ---
+async def _action_flood(ctx, verdict):
+    message = ctx.message
+    same_count = verdict.details['same_count']
+    try:
+        # 禁言7天
+        await moderation_executor.timeout(
+            message.author,
+            timedelta(days=7),
+            reason=f"刷頻偵測: 相同訊息 {same_count} 次"
+        )
+        embed = discord.Embed(
+            title="🚫 刷頻偵測",
+            description=f"{message.author.mention} 因刷頻已被禁言 7 天",
+            color=discord.Color.red()
+        )
+        embed.add_field(name="原因", value=f"相同訊息重複 {same_count} 次", inline=False)
+        embed.add_field(name="禁言時長", value="7 天", inline=False)
+        moderation_executor.send(message.channel, embed=embed)
         
-        # 清理過期的消息記錄
-        spam_tracker[user_key]['messages'] = [
-            msg_time for msg_time in spam_tracker[user_key]['messages']
-            if (current_time - msg_time).total_seconds() < guild_config.anti_spam_seconds
-        ]
+        # 發送日誌
+        await send_log_to_channel(message.guild, embed)
         
-        # 添加當前消息時間
-        spam_tracker[user_key]['messages'].append(current_time)
+        # 清除歷史避免重複觸發
+        verdict.details['history'].clear()
+        print(f"🚫 用戶 {message.author} 因刷頻被禁言 7 天")
+    except discord.Forbidden:
+        moderation_executor.send(message.channel, "❌ 無法禁言該成員 (權限不足)", delete_after=10)
+    except Exception as e:
+        print(f"⚠️ 刷頻偵測處理失敗: {str(e)}")
+
+@moderation_stage('flood')
+def detect_flood(ctx):
+    history = message_history.get(ctx.author.id)
+    same_count = history.add(content_fingerprint(ctx.message.content))
+    if ctx.message.content and same_count >= 10:
+        return ModerationVerdict('flood', 50, _action_flood, same_count=same_count, history=history)
+    return None
+
+# --- 防炸群訊息速率 / 重複 spam ---
+async def _action_raid_rate(ctx, verdict):
+    moderation_executor.delete(ctx.message)
+    moderation_executor.send(ctx.message.channel, f"⚠️ {ctx.author.mention} **訊息發送過快！**\n⏰ 請稍後再發送", delete_after=10)
+    print(f"🚫 速率限制: {ctx.author}")
+
+async def _action_raid_duplicate(ctx, verdict):
+    moderation_executor.delete(ctx.message)
+    moderation_executor.send(ctx.message.channel, f"🗑️ {ctx.author.mention} **重複 spam 訊息已刪除**\n💡 請勿發送相同內容", delete_after=5)
+    print(f"🚫 刪除 spam: {ctx.author} - {ctx.message.content[:50]}")
+
+@moderation_stage('raid_rate')
+def detect_raid_rate(ctx):
+    if ctx.author.bot:
+        return None
+    if message_counts.get((ctx.guild.id, ctx.author.id)).hit() > raid_policy_from_config(ctx.guild_config).max_msgs_per_minute:
+        return ModerationVerdict('raid_rate', 10, _action_raid_rate)
+    return None
+
+@moderation_stage('raid_duplicate')
+def detect_raid_duplicate(ctx):
+    # 重複訊息防 spam（按用戶+內容追蹤，只有當內容不為空且未觸發速率限制時才檢查）
+    content = ctx.message.content.lower()
+    if ctx.author.bot or not content or len(content) <= 3:
+        return None
+    if any(verdict.stage == 'raid_rate' for verdict in ctx.verdicts):
+        return None
+    
+    # 使用 guild_id + user_id + 內容指紋作為唯一鍵，避免不同用戶的誤判
+    spam_key = (ctx.guild.id, ctx.author.id, content_fingerprint(content))
+    spam_messages[spam_key] += 1
+    
+    if spam_messages[spam_key] >= raid_policy_from_config(ctx.guild_config).spam_threshold:
+        # 刪除 key 避免累積
+        del spam_messages[spam_key]
+        return ModerationVerdict('raid_duplicate', 15, _action_raid_duplicate)
+    
+    # 只在計數為1時排程清理（1分鐘後）
+    if spam_messages[spam_key] == 1:
+        expiry_scheduler.schedule(60, lambda key=spam_key: spam_messages.pop(key, None), key=('spam', spam_key))
+    return None
+
+# --- 伺服器自訂防刷屏 (anti_spam_messages 條 / anti_spam_seconds 秒，禁言 1 分鐘) ---
+async def _action_anti_spam(ctx, verdict):
+    message = ctx.message
+    guild_config = ctx.guild_config
+    spam_state = verdict.details['spam_state']
+    try:
+        # 記錄到數據庫
+        spam_log = SpamLog(
+            guild_id=message.guild.id,
+            user_id=message.author.id,
+            messages_count=len(spam_state.messages),
+            threshold=guild_config.anti_spam_messages,
+            seconds=guild_config.anti_spam_seconds,
+            action="muted"
+        )
+        await run_db(_add_and_commit, spam_log)
         
-        # 檢查是否超過刷屏閾值
-        if len(spam_tracker[user_key]['messages']) > guild_config.anti_spam_messages:
-            if not spam_tracker[user_key]['muted']:
-                try:
-                    # 記錄到數據庫
-                    spam_session = SessionLocal()
-                    spam_log = SpamLog(
-                        guild_id=message.guild.id,
-                        user_id=message.author.id,
-                        messages_count=len(spam_tracker[user_key]['messages']),
-                        threshold=guild_config.anti_spam_messages,
-                        seconds=guild_config.anti_spam_seconds,
-                        action="muted"
-                    )
-                    spam_session.add(spam_log)
-                    spam_session.commit()
-                    spam_session.close()
-                    
-                    # 禁言該用戶
-                    await message.author.timeout(timedelta(minutes=1), reason="刷屏檢測")
-                    spam_tracker[user_key]['muted'] = True
-                    
-                    # 發送警告信息
-                    embed = discord.Embed(
-                        title="⚠️ 刷屏檢測",
-                        description=f"{message.author.mention} 因為在短時間內發送過多消息而被禁言 1 分鐘",
-                        color=discord.Color.orange()
-                    )
-                    embed.add_field(name="觸發阈值", value=f"{guild_config.anti_spam_messages} 條消息 / {guild_config.anti_spam_seconds} 秒", inline=False)
-                    
-                    # 發送到日誌頻道
-                    await send_log_to_channel(message.guild, embed)
-                    
-                    # 發送通知到指定頻道
-                    notification_channel = bot.get_channel(1441645738747494514)
-                    if notification_channel:
-                        try:
-                            notification_embed = discord.Embed(
-                                title="🚨 刷屏事件警告",
-                                description=f"在伺服器 **{message.guild.name}** 檢測到用戶刷屏",
-                                color=discord.Color.red()
-                            )
-                            notification_embed.add_field(name="用戶", value=f"{message.author.mention} ({message.author.id})", inline=False)
-                            notification_embed.add_field(name="伺服器", value=f"{message.guild.name} ({message.guild.id})", inline=False)
-                            notification_embed.add_field(name="觸發事件", value=f"在 {guild_config.anti_spam_seconds} 秒內發送 {len(spam_tracker[user_key]['messages'])} 條消息", inline=False)
-                            notification_embed.add_field(name="設定閾值", value=f"{guild_config.anti_spam_messages} 條消息 / {guild_config.anti_spam_seconds} 秒", inline=False)
-                            notification_embed.add_field(name="處理方式", value="✅ 已禁言 1 分鐘", inline=False)
-                            notification_embed.add_field(name="發生時間", value=datetime.now().strftime("%Y-%m-%d %H:%M:%S"), inline=False)
-                            
-                            await notification_channel.send(embed=notification_embed)
-                        except Exception as e:
-                            print(f"❌ 無法發送刷屏通知：{str(e)}")
-                    
-                    # 發送通知給伺服器版主（所有者）
-                    if message.guild.owner:
-                        try:
-                            owner_dm_embed = discord.Embed(
-                                title="🚨 伺服器刷屏警告",
-                                description=f"您的伺服器 **{message.guild.name}** 有用戶在使用刷屏指令",
-                                color=discord.Color.red()
-                            )
-                            owner_dm_embed.add_field(name="📝 違規用戶", value=f"{message.author.mention}\nID: {message.author.id}", inline=False)
-                            owner_dm_embed.add_field(name="⚙️ 觸發詳情", value=f"在 {guild_config.anti_spam_seconds} 秒內發送 {len(spam_tracker[user_key]['messages'])} 條消息\n設定閾值：{guild_config.anti_spam_messages} 條消息 / {guild_config.anti_spam_seconds} 秒", inline=False)
-                            owner_dm_embed.add_field(name="✅ 自動處理", value="機器人已對該用戶禁言 1 分鐘並刪除消息", inline=False)
-                            owner_dm_embed.add_field(name="⏰ 發生時間", value=datetime.now().strftime("%Y-%m-%d %H:%M:%S"), inline=False)
-                            owner_dm_embed.set_footer(text=f"伺服器 ID: {message.guild.id}")
-                            
-                            await message.guild.owner.send(embed=owner_dm_embed)
-                        except Exception as e:
-                            print(f"❌ 無法向伺服器版主發送私人訊息：{str(e)}")
-                    
-                    # 刪除刷屏消息
-                    try:
-                        await message.delete()
-                    except:
-                        pass
-                except Exception as e:
-                    print(f"⚠️ 防刷屏處理失敗：{str(e)}")
+        # 禁言該用戶
+        await moderation_executor.timeout(message.author, timedelta(minutes=1), reason="刷屏檢測")
+        spam_state.muted = True
+        
+        # 發送警告信息
+        embed = discord.Embed(
+            title="⚠️ 刷屏檢測",
+            description=f"{message.author.mention} 因為在短時間內發送過多消息而被禁言 1 分鐘",
+            color=discord.Color.orange()
+        )
+        embed.add_field(name="觸發阈值", value=f"{guild_config.anti_spam_messages} 條消息 / {guild_config.anti_spam_seconds} 秒", inline=False)
+        
+        # 發送到日誌頻道
+        await send_log_to_channel(message.guild, embed)
+        
+        # 發送通知到指定頻道
+        notification_channel = bot.get_channel(1441645738747494514)
+        if notification_channel:
+            try:
+                notification_embed = discord.Embed(
+                    title="🚨 刷屏事件警告",
+                    description=f"在伺服器 **{message.guild.name}** 檢測到用戶刷屏",
+                    color=discord.Color.red()
+                )
+                notification_embed.add_field(name="用戶", value=f"{message.author.mention} ({message.author.id})", inline=False)
+                notification_embed.add_field(name="伺服器", value=f"{message.guild.name} ({message.guild.id})", inline=False)
+                notification_embed.add_field(name="觸發事件", value=f"在 {guild_config.anti_spam_seconds} 秒內發送 {len(spam_state.messages)} 條消息", inline=False)
+                notification_embed.add_field(name="設定閾值", value=f"{guild_config.anti_spam_messages} 條消息 / {guild_config.anti_spam_seconds} 秒", inline=False)
+                notification_embed.add_field(name="處理方式", value="✅ 已禁言 1 分鐘", inline=False)
+                notification_embed.add_field(name="發生時間", value=datetime.now().strftime("%Y-%m-%d %H:%M:%S"), inline=False)
+                
+                await notification_channel.send(embed=notification_embed)
+            except Exception as e:
+                print(f"❌ 無法發送刷屏通知：{str(e)}")
+        
+        # 發送通知給伺服器版主（所有者）
+        if message.guild.owner:
+            try:
+                owner_dm_embed = discord.Embed(
+                    title="🚨 伺服器刷屏警告",
+                    description=f"您的伺服器 **{message.guild.name}** 有用戶在使用刷屏指令",
+                    color=discord.Color.red()
+                )
+                owner_dm_embed.add_field(name="📝 違規用戶", value=f"{message.author.mention}\nID: {message.author.id}", inline=False)
+                owner_dm_embed.add_field(name="⚙️ 觸發詳情", value=f"在 {guild_config.anti_spam_seconds} 秒內發送 {len(spam_state.messages)} 條消息\n設定閾值：{guild_config.anti_spam_messages} 條消息 / {guild_config.anti_spam_seconds} 秒", inline=False)
+                owner_dm_embed.add_field(name="✅ 自動處理", value="機器人已對該用戶禁言 1 分鐘並刪除消息", inline=False)
+                owner_dm_embed.add_field(name="⏰ 發生時間", value=datetime.now().strftime("%Y-%m-%d %H:%M:%S"), inline=False)
+                owner_dm_embed.set_footer(text=f"伺服器 ID: {message.guild.id}")
+                
+                await message.guild.owner.send(embed=owner_dm_embed)
+            except Exception as e:
+                print(f"❌ 無法向伺服器版主發送私人訊息：{str(e)}")
+        
+        # 刪除刷屏消息
+        moderation_executor.delete(message)
     except Exception as e:
-        print(f"⚠️ 後台防刷屏檢測失敗：{str(e)}")
+        print(f"⚠️ 防刷屏處理失敗：{str(e)}")
+
+@moderation_stage('anti_spam')
+def detect_anti_spam(ctx):
+    guild_config = ctx.guild_config
+    if not guild_config or not guild_config.anti_spam_enabled:
+        return None
+    
+    spam_state = spam_tracker.get(f"{ctx.guild.id}_{ctx.author.id}")
+    
+    # 清理過期的消息記錄並添加當前消息時間
+    spam_state.messages = [
+        msg_time for msg_time in spam_state.messages
+        if (ctx.now - msg_time).total_seconds() < guild_config.anti_spam_seconds
+    ]
+    spam_state.messages.append(ctx.now)
+    
+    # 檢查是否超過刷屏閾值
+    if len(spam_state.messages) > guild_config.anti_spam_messages and not spam_state.muted:
+        return ModerationVerdict('anti_spam', 30, _action_anti_spam, spam_state=spam_state)
+    return None
 
 @bot.event
 async def on_voice_state_update(member, before, after):
     """處理語音狀態更新 - 包廂系統"""
     global booths, booth_channels
     
-    # 刪除空包廂
-    if before.channel and before.channel.name.startswith('🗣️包廂-'):
-        if len(before.channel.members) == 0:
+    # 空包廂排入回收，寬限期內有人回來就取消（包廂、入口頻道皆以頻道 ID 查詢，不依賴頻道名稱）
+    if before.channel != after.channel:
+        if before.channel and str(before.channel.id) in booth_channels and len(before.channel.members) == 0:
+            booth_reaper.mark_empty(before.channel)
+        if after.channel and str(after.channel.id) in booth_channels:
+            booth_reaper.cancel(after.channel)
+    
+    # 自動建立私人包廂（有預熱池時優先認領待命包廂）
+    category_id, data = booths.lookup(after.channel.id) if after.channel else (None, None)
+    if data:
+        category = bot.get_channel(int(data['category']))
+        if category:
             try:
-                channel_id_str = str(before.channel.id)
-                if channel_id_str in booth_channels:
-                    del booth_channels[channel_id_str]
-                    save_booth_channels(booth_channels)
-                await before.channel.delete()
-                print(f"✅ 已刪除空包廂：{before.channel.name}")
+                started = perf_counter()
+                booth_channel = await booth_pool.claim(category_id, member)
+                mode = 'pooled'
+                if booth_channel is None:
+                    mode = 'on_demand'
+                    booth_channel = await category.create_voice_channel(
+                        f"🗣️包廂-{member.display_name}",
+                        user_limit=5,
+                        overwrites=booth_overwrites(member, category.guild)
+                    )
+                    await member.move_to(booth_channel)
+                booth_pool.record_latency(mode, perf_counter() - started)
+                if data.get('pool_size'):
+                    booth_pool.request_refill(category_id)
+                await after.channel.set_permissions(member, overwrite=None)
+                
+                booth_channels.set(str(booth_channel.id), {
+                    'owner_id': member.id,
+                    'password': None,
+                    'is_locked': False,
+                    'guild_id': category.guild.id,
+                    'created_at': datetime.now().isoformat()
+                })
+                
+                control_embed = discord.Embed(
+                    title='🎛️ 包廂控制面板',
+                    description=f'歡迎來到您的私人包廂！\n👑 包廂主人：{member.mention}',
+                    color=discord.Color.purple()
+                )
+                control_embed.add_field(
+                    name='🔒 上鎖包廂',
+                    value='設置密碼，其他人需輸入密碼才能進入',
+                    inline=True
+                )
+                control_embed.add_field(
+                    name='📊 包廂狀態',
+                    value='查看當前包廂的詳細狀態',
+                    inline=True
+                )
+                control_embed.add_field(
+                    name='❌ 關閉包廂',
+                    value='關閉並刪除此包廂',
+                    inline=True
+                )
+                control_embed.add_field(
+                    name='✏️ 更改名稱',
+                    value='修改包廂的名稱',
+                    inline=True
+                )
+                control_embed.set_footer(text='只有包廂主人可以使用控制按鈕')
+                
+                view = BoothControlView(booth_channel.id, member.id)
+                await booth_channel.send(embed=control_embed, view=view)
+                
+                print(f"✅ 已為 {member.display_name} 建立包廂：{booth_channel.name}（{'預熱池' if mode == 'pooled' else '即時建立'}）")
             except Exception as e:
-                print(f"⚠️ 無法刪除包廂：{str(e)}")
-    
-    # 自動建立私人包廂
-    if after.channel and after.channel.name == "🎪 點擊加入建立包廂":
-        for cat_id, data in booths.items():
-            if str(after.channel.id) == data['entry_channel']:
-                category = bot.get_channel(int(data['category']))
-                if category:
-                    try:
-                        booth_channel = await category.create_voice_channel(
-                            f"🗣️包廂-{member.display_name}",
-                            user_limit=5,
-                            overwrites={
-                                member: discord.PermissionOverwrite(
-                                    connect=True, speak=True, stream=True,
-                                    use_voice_activation=True, move_members=True,
-                                    manage_channels=True
-                                ),
-                                category.guild.default_role: discord.PermissionOverwrite(connect=False)
-                            }
-                        )
-                        await member.move_to(booth_channel)
-                        await after.channel.set_permissions(member, overwrite=None)
-                        
-                        booth_channels[str(booth_channel.id)] = {
-                            'owner_id': member.id,
-                            'password': None,
-                            'is_locked': False,
-                            'guild_id': category.guild.id,
-                            'created_at': datetime.now().isoformat()
-                        }
-                        save_booth_channels(booth_channels)
-                        
-                        control_embed = discord.Embed(
-                            title='🎛️ 包廂控制面板',
-                            description=f'歡迎來到您的私人包廂！\n👑 包廂主人：{member.mention}',
-                            color=discord.Color.purple()
-                        )
-                        control_embed.add_field(
-                            name='🔒 上鎖包廂',
-                            value='設置密碼，其他人需輸入密碼才能進入',
-                            inline=True
-                        )
-                        control_embed.add_field(
-                            name='📊 包廂狀態',
-                            value='查看當前包廂的詳細狀態',
-                            inline=True
-                        )
-                        control_embed.add_field(
-                            name='❌ 關閉包廂',
-                            value='關閉並刪除此包廂',
-                            inline=True
-                        )
-                        control_embed.add_field(
-                            name='✏️ 更改名稱',
-                            value='修改包廂的名稱',
-                            inline=True
-                        )
-                        control_embed.set_footer(text='只有包廂主人可以使用控制按鈕')
-                        
-                        view = BoothControlView(booth_channel.id, member.id)
-                        await booth_channel.send(embed=control_embed, view=view)
-                        
-                        print(f"✅ 已為 {member.display_name} 建立包廂：{booth_channel.name}")
-                    except Exception as e:
-                        print(f"⚠️ 建立包廂失敗：{str(e)}")
-                    break
+                print(f"⚠️ 建立包廂失敗：{str(e)}")
     
     # 密碼驗證 - 當有人嘗試進入上鎖的包廂時
-    if after.channel and after.channel.name.startswith('🗣️包廂-') and before.channel != after.channel:
+    if after.channel and before.channel != after.channel:
         channel_id_str = str(after.channel.id)
         if channel_id_str in booth_channels:
             booth_data = booth_channels[channel_id_str]
@@ -1043,11 +2822,7 @@ async def on_voice_state_update(member, before, after):
                                     embed=embed,
                                     view=view
                                 )
-                                await asyncio.sleep(60)
-                                try:
-                                    await msg.delete()
-                                except:
-                                    pass
+                                expiry_scheduler.schedule(60, msg.delete, key=('booth_prompt', msg.id))
                     except Exception as e:
                         print(f"⚠️ 密碼驗證處理失敗：{str(e)}")
 
@@ -1062,202 +2837,19 @@ async def on_message(message):
             await bot.process_commands(message)
         return
     
-    # ====== 速率限制系統 (20秒內發送超過 3 條消息時警告) ======
-    if message.guild:
-        user_id = message.author.id
-        tracker = rate_limit_tracker[user_id]
-        now = datetime.now()
-        
-        # 檢查是否在禁言期間
-        if tracker['muted_until'] and now < tracker['muted_until']:
-            try:
-                await message.delete()
-                await asyncio.sleep(0.3)
-                remaining_time = (tracker['muted_until'] - now).total_seconds()
-                minutes = int(remaining_time) // 60
-                seconds = int(remaining_time) % 60
-                await message.channel.send(f"⏳ {message.author.mention} **您正在禁言中** \n禁言剩餘時間：{minutes} 分 {seconds} 秒", delete_after=5)
-            except:
-                pass
-            await bot.process_commands(message)
-            return
-        
-        # 重置禁言狀態如果時間到期
-        if tracker['muted_until'] and now >= tracker['muted_until']:
-            tracker['muted_until'] = None
-            tracker['warning_triggered'] = False
-            print(f"✅ 用戶 {message.author} 禁言時間已到期，已重置")
-        
-        # 添加當前消息時間戳到 deque
-        tracker['messages'].append(now)
-        
-        # 清除 20 秒外的舊消息
-        while tracker['messages'] and (now - tracker['messages'][0]).total_seconds() > RATE_LIMIT_WINDOW:
-            tracker['messages'].popleft()
-        
-        # 檢查 20 秒窗口內的消息數
-        msg_count_in_window = len(tracker['messages'])
-        
-        # 如果超過閾值且本窗口還未警告過，發出警告
-        if msg_count_in_window > RATE_LIMIT_MSG_THRESHOLD and not tracker['warning_triggered']:
-            try:
-                await message.delete()
-                await asyncio.sleep(0.3)
-                await message.channel.send(f"⚠️ {message.author.mention} **發送信息過快** (OO發送信息過快)", delete_after=5)
-                print(f"⚠️ 用戶 {message.author} 觸發速率限制警告 (20秒內 {msg_count_in_window} 條消息)")
-            except:
-                pass
-            
-            # 記錄警告狀態
-            tracker['warning_triggered'] = True
-            tracker['warnings'] += 1
-            print(f"⚠️ 用戶 {message.author} 警告 {tracker['warnings']}/{RATE_LIMIT_WARNINGS_FOR_MUTE}")
-            
-            # 達到 3 次警告時禁言 10 分鐘
-            if tracker['warnings'] >= RATE_LIMIT_WARNINGS_FOR_MUTE:
-                try:
-                    await message.author.timeout(
-                        timedelta(seconds=RATE_LIMIT_MUTE_DURATION),
-                        reason="速率限制：發送信息過快"
-                    )
-                    tracker['muted_until'] = now + timedelta(seconds=RATE_LIMIT_MUTE_DURATION)
-                    tracker['warning_triggered'] = False
-                    
-                    embed = discord.Embed(
-                        title="🔇 您已被禁言 10 分鐘",
-                        description="因為發送信息過快（速率限制違規）",
-                        color=discord.Color.orange()
-                    )
-                    embed.add_field(name="原因", value="在 20 秒內發送超過 10 條消息，已累積 3 次警告", inline=False)
-                    embed.add_field(name="禁言時長", value="10 分鐘", inline=False)
-                    embed.add_field(name="⏰ 禁言時間", value=now.strftime("%Y-%m-%d %H:%M:%S"), inline=False)
-                    
-                    try:
-                        await message.author.send(embed=embed)
-                    except:
-                        pass
-                    
-                    # 發送日誌
-                    embed_log = discord.Embed(
-                        title="🔇 用戶因速率限制被禁言 10 分鐘",
-                        color=discord.Color.orange()
-                    )
-                    embed_log.add_field(name="用戶", value=f"{message.author} (ID: {user_id})", inline=False)
-                    embed_log.add_field(name="原因", value="在 20 秒內發送超過 10 條消息，累積 3 次警告", inline=False)
-                    embed_log.add_field(name="觸發警告數", value=f"{tracker['warnings']} 次", inline=False)
-                    await send_log_to_channel(message.guild, embed_log)
-                    
-                    print(f"🔇 用戶 {message.author} 因速率限制被禁言 10 分鐘")
-                except discord.Forbidden:
-                    await message.channel.send("❌ 無法禁言該成員 (權限不足)", delete_after=10)
-                except Exception as e:
-                    print(f"⚠️ 禁言處理失敗: {str(e)}")
-        
-        # 當窗口內消息數回到閾值以下時，重置警告狀態
-        elif msg_count_in_window <= RATE_LIMIT_MSG_THRESHOLD and tracker['warning_triggered']:
-            tracker['warning_triggered'] = False
-            print(f"✅ 用戶 {message.author} 消息速率恢復正常，重置本次警告狀態")
-    
-    # 刷頻偵測 - 更新訊息歷史
-    if message.guild:
-        history = message_history[message.author.id]
-        history.append(message.content)
-        
-        # 檢查相同訊息是否達到10次
-        if message.content:
-            same_count = sum(1 for msg in history if msg == message.content)
-            if same_count >= 10:
-                try:
-                    # 禁言7天
-                    await message.author.timeout(
-                        timedelta(days=7),
-                        reason=f"刷頻偵測: 相同訊息 {same_count} 次"
-                    )
-                    embed = discord.Embed(
-                        title="🚫 刷頻偵測",
-                        description=f"{message.author.mention} 因刷頻已被禁言 7 天",
-                        color=discord.Color.red()
-                    )
-                    embed.add_field(name="原因", value=f"相同訊息重複 {same_count} 次", inline=False)
-                    embed.add_field(name="禁言時長", value="7 天", inline=False)
-                    await message.channel.send(embed=embed)
-                    
-                    # 發送日誌
-                    await send_log_to_channel(message.guild, embed)
-                    
-                    # 清除歷史避免重複觸發
-                    message_history[message.author.id].clear()
-                    print(f"🚫 用戶 {message.author} 因刷頻被禁言 7 天")
-                except discord.Forbidden:
-                    await message.channel.send("❌ 無法禁言該成員 (權限不足)", delete_after=10)
-                except Exception as e:
-                    print(f"⚠️ 刷頻偵測處理失敗: {str(e)}")
-    
-    # ====== 防炸群消息速率檢查 ======
-    raid_action_taken = False
-    if message.guild and not message.author.bot:
-        author = message.author
-        content = message.content.lower()
-        now = datetime.now()
-        guild = message.guild
-        
-        # 訊息速率限制
-        if guild.id not in message_counts:
-            message_counts[guild.id] = defaultdict(deque)
-        
-        message_counts[guild.id][author.id].append(now)
-        message_counts[guild.id][author.id] = deque([t for t in message_counts[guild.id][author.id] if (now - t).seconds < 60])
-        
-        if len(message_counts[guild.id][author.id]) > MAX_MSGS_PER_MINUTE:
-            try:
-                await message.delete()
-                await asyncio.sleep(0.5)
-                await message.channel.send(f"⚠️ {author.mention} **訊息發送過快！**\n⏰ 請稍後再發送", delete_after=10)
-                print(f"🚫 速率限制: {author}")
-                raid_action_taken = True
-            except:
-                pass
-        
-        # 重複訊息防 spam（按用戶+內容追蹤，只有當內容不為空時才檢查）
-        if not raid_action_taken and content and len(content) > 3:
-            # 使用 guild_id + user_id + content 作為唯一鍵，避免不同用戶的誤判
-            spam_key = (guild.id, author.id, content)
-            spam_messages[spam_key] += 1
-            
-            if spam_messages[spam_key] >= SPAM_THRESHOLD:
-                try:
-                    await message.delete()
-                    await asyncio.sleep(0.5)
-                    await message.channel.send(f"🗑️ {author.mention} **重複 spam 訊息已刪除**\n💡 請勿發送相同內容", delete_after=5)
-                    print(f"🚫 刪除 spam: {author} - {content[:50]}")
-                    raid_action_taken = True
-                    # 刪除 key 避免累積
-                    if spam_key in spam_messages:
-                        del spam_messages[spam_key]
-                except:
-                    pass
-            
-            # 使用時間戳清理，只在計數為1時啟動清理（避免重複任務）
-            if spam_key in spam_messages and spam_messages[spam_key] == 1:
-                async def cleanup_spam_key(key=spam_key):
-                    await asyncio.sleep(60)  # 1分鐘後清理
-                    if key in spam_messages:
-                        del spam_messages[key]
-                bot.loop.create_task(cleanup_spam_key())
-    # ====== 防炸群消息速率檢查結束 ======
-    
-    # 將防刷屏檢測改為後台異步執行，不阻塞事件循環
+    # 防刷屏審核管線（速率限制、刷頻、防炸群、伺服器自訂防刷屏）
     if message.guild:
-        bot.loop.create_task(handle_spam_detection(message))
+        try:
+            await run_moderation_pipeline(message)
+        except Exception as e:
+            print(f"⚠️ 訊息審核失敗：{str(e)}")
     
     await bot.process_commands(message)
 
 async def send_log_to_channel(guild, embed):
     """發送日誌到設定的日誌頻道"""
     try:
-        session = SessionLocal()
-        guild_config = session.query(Guild).filter_by(guild_id=guild.id).first()
-        session.close()
+        guild_config = await guild_config_cache.get(guild.id)
         
         if guild_config and guild_config.log_channel:
             log_channel = bot.get_channel(guild_config.log_channel)
@@ -1269,6 +2861,8 @@ async def send_log_to_channel(guild, embed):
 @bot.event
 async def on_member_remove(member):
     """當用戶被踢出/離開時"""
+    if admin_recipient_index.contains(member.guild.id, member.id):
+        admin_recipient_index.invalidate(member.guild.id)
     try:
         # 發送私人訊息
         embed_dm = discord.Embed(
@@ -1293,29 +2887,314 @@ async def on_member_remove(member):
     embed_log.add_field(name="時間", value=datetime.now().strftime("%Y-%m-%d %H:%M:%S"), inline=False)
     await send_log_to_channel(member.guild, embed_log)
 
+# ====== 管理員通知 ======
+# 每個伺服器的通知對象（擁有者 + 管理員角色成員）預先計算並快取，成員/身份組變動時才重建；
+# 私訊先合併（同一對象的多則通知併成一則訊息、重複的通知略過），再以有限並行數發送
+ADMIN_NOTIFY_MAX_ROLES = 5  # 最多通知幾個管理員角色
+ADMIN_NOTIFY_MAX_PER_ROLE = 3  # 每個角色最多通知幾個成員
+ADMIN_DM_CONCURRENCY = 5  # 同時發送的私訊數
+ADMIN_DM_COALESCE_SECONDS = 2  # 合併通知的等待時間
+ADMIN_DM_EMBEDS_PER_MESSAGE = 10
+
+class AdminRecipientIndex:
+    """guild_id -> 通知對象 member_id 列表（延遲建立，相關事件時失效）"""
+    
+    def __init__(self):
+        self._recipients = {}
+        self.rebuilds = 0
+    
+    def get(self, guild):
+        recipient_ids = self._recipients.get(guild.id)
+        if recipient_ids is None:
+            recipient_ids = self._build(guild)
+            self._recipients[guild.id] = recipient_ids
+        return [member for member in map(guild.get_member, recipient_ids) if member]
+    
+    def _build(self, guild):
+        self.rebuilds += 1
+        recipient_ids = []
+        if guild.owner_id:
+            recipient_ids.append(guild.owner_id)
+        admin_roles = [role for role in guild.roles if role.permissions.administrator and not role.managed]
+        for role in admin_roles[:ADMIN_NOTIFY_MAX_ROLES]:
+            for member in role.members[:ADMIN_NOTIFY_MAX_PER_ROLE]:
+                if not member.bot and member.id not in recipient_ids:
+                    recipient_ids.append(member.id)
+        return recipient_ids
+    
+    def invalidate(self, guild_id):
+        self._recipients.pop(guild_id, None)
+    
+    def contains(self, guild_id, member_id):
+        return member_id in self._recipients.get(guild_id, ())
+
+class AdminNotificationFanout:
+    """合併並行發送管理員私訊"""
+    
+    def __init__(self):
+        self._pending = {}  # recipient_id -> (member, {通知鍵: embed})
+        self._flush_scheduled = False
+        self.sent = 0
+        self.failed = 0
+        self.deduplicated = 0
+    
+    def notify(self, recipients, key, embed):
+        """排入通知；同一對象在合併期間收到相同 key 的通知只會發送一次"""
+        for recipient in recipients:
+            _, embeds = self._pending.setdefault(recipient.id, (recipient, {}))
+            if key in embeds:
+                self.deduplicated += 1
+                continue
+            embeds[key] = embed
+        if self._pending and not self._flush_scheduled:
+            self._flush_scheduled = True
+            expiry_scheduler.schedule(ADMIN_DM_COALESCE_SECONDS, self.flush)
+    
+    def pending(self):
+        return sum(len(embeds) for _, embeds in self._pending.values())
+    
+    async def _send(self, semaphore, recipient, embeds):
+        async with semaphore:
+            for i in range(0, len(embeds), ADMIN_DM_EMBEDS_PER_MESSAGE):
+                try:
+                    await recipient.send(embeds=embeds[i:i + ADMIN_DM_EMBEDS_PER_MESSAGE])
+                    self.sent += 1
+                except Exception:
+                    self.failed += 1
+    
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        self._flush_scheduled = False
+        semaphore = asyncio.Semaphore(ADMIN_DM_CONCURRENCY)
+        await asyncio.gather(*(
+            self._send(semaphore, recipient, list(embeds.values()))
+            for recipient, embeds in pending.values()
+        ))
+
+admin_recipient_index = AdminRecipientIndex()
+admin_notifier = AdminNotificationFanout()
+
+@bot.event
+async def on_member_update(before, after):
+    """管理員角色成員變動時重建通知對象"""
+    if before.roles != after.roles:
+        changed = set(before.roles) ^ set(after.roles)
+        if any(role.permissions.administrator for role in changed):
+            admin_recipient_index.invalidate(after.guild.id)
+
+@bot.event
+async def on_guild_update(before, after):
+    """伺服器擁有者轉移時重建通知對象"""
+    if before.owner_id != after.owner_id:
+        admin_recipient_index.invalidate(after.id)
+
+@bot.event
+async def on_guild_role_update(before, after):
+    """身份組的管理員權限變動時重建通知對象"""
+    if before.permissions.administrator != after.permissions.administrator:
+        admin_recipient_index.invalidate(after.guild.id)
+
+# ====== 防炸群封鎖模式 ======
+# 加入速率超標時整個伺服器進入封鎖模式：提高驗證等級、開啟慢速模式，新成員累積後分批踢出，
+# 每個週期只發一則摘要；加入速率回到門檻以下後冷卻一段時間自動解除並還原設定
+RAID_MODE_INTERVAL = 15  # 處理週期（秒）：踢出累積的成員並發送摘要
+RAID_MODE_COOLDOWN = 600  # 加入速率最後一次超標後多久自動解除（秒）
+RAID_MODE_SLOWMODE = 30  # 封鎖期間文字頻道的慢速模式（秒）
+RAID_JOIN_WINDOW = 600  # 觸發時回溯的加入記錄範圍（秒）
+
+class RaidModeState:
+    __slots__ = ('active', 'started_at', 'last_surge_at', 'recent_joins', 'cohort',
+                 'previous_verification', 'slowmode_channels', 'kicked', 'failed', 'task')
+    
+    def __init__(self):
+        self.active = False
+        self.started_at = None
+        self.last_surge_at = 0.0  # 加入速率最後一次超標的 monotonic 時間
+        self.recent_joins = deque()  # (monotonic 時間, member_id)，用於觸發時找出同批加入的成員
+        self.cohort = {}  # member_id -> 踢出原因，等待下個週期批次處理
+        self.previous_verification = None
+        self.slowmode_channels = []
+        self.kicked = 0
+        self.failed = 0
+        self.task = None
+
+class RaidModeManager:
+    """各伺服器的封鎖模式狀態機：正常 -> 封鎖（批次處理）-> 冷卻後自動回到正常"""
+    
+    def __init__(self):
+        self._states = {}
+        self.activations = 0
+    
+    def _state(self, guild_id):
+        state = self._states.get(guild_id)
+        if state is None:
+            state = self._states[guild_id] = RaidModeState()
+        return state
+    
+    def is_active(self, guild_id):
+        state = self._states.get(guild_id)
+        return bool(state and state.active)
+    
+    def active_guilds(self):
+        return [guild_id for guild_id, state in self._states.items() if state.active]
+    
+    def record_join(self, member, surging):
+        """記錄加入（只保留 RAID_JOIN_WINDOW 內的記錄）；surging 表示這次加入時速率超標，冷卻時間從此重新計算"""
+        state = self._state(member.guild.id)
+        now = monotonic()
+        state.recent_joins.append((now, member.id))
+        while state.recent_joins and now - state.recent_joins[0][0] > RAID_JOIN_WINDOW:
+            state.recent_joins.popleft()
+        if surging:
+            state.last_surge_at = now
+    
+    @staticmethod
+    def is_new_account(member, policy):
+        return (datetime.now() - member.created_at.replace(tzinfo=None)).days < policy.min_account_age_days
+    
+    @classmethod
+    def _kick_reason(cls, member, policy):
+        if cls.is_new_account(member, policy):
+            return "新帳號大量加入 - 防炸群保護"
+        return "大量加入 - 防炸群保護"
+    
+    def add_to_cohort(self, member, policy):
+        self._state(member.guild.id).cohort[member.id] = self._kick_reason(member, policy)
+    
+    def enter(self, guild, policy):
+        """進入封鎖模式：同一時段加入的新帳號一併列入待踢出名單"""
+        state = self._state(guild.id)
+        if state.active:
+            return
+        state.active = True
+        state.started_at = datetime.now()
+        state.kicked = 0
+        state.failed = 0
+        self.activations += 1
+        for _, member_id in state.recent_joins:
+            member = guild.get_member(member_id)
+            if member and self.is_new_account(member, policy):
+                state.cohort[member_id] = "新帳號大量加入 - 防炸群保護"
+        state.task = bot.loop.create_task(self._run(guild.id))
+        print(f"🚨 伺服器 {guild.name} 進入防炸群封鎖模式")
+    
+    async def _lock_guild(self, guild, state):
+        try:
+            if guild.verification_level < discord.VerificationLevel.high:
+                state.previous_verification = guild.verification_level
+                await guild.edit(verification_level=discord.VerificationLevel.high, reason="防炸群封鎖模式")
+        except Exception as e:
+            print(f"⚠️ 無法提高驗證等級：{str(e)}")
+        for channel in guild.text_channels:
+            if channel.slowmode_delay == 0 and channel.permissions_for(guild.me).manage_channels:
+                try:
+                    await channel.edit(slowmode_delay=RAID_MODE_SLOWMODE, reason="防炸群封鎖模式")
+                    state.slowmode_channels.append(channel.id)
+                except Exception as e:
+                    print(f"⚠️ 無法開啟慢速模式 {channel.name}：{str(e)}")
+    
+    async def _unlock_guild(self, guild, state, previous_verification, slowmode_channels):
+        """還原封鎖前的設定（傳入的是解除前取下的快照）；還原途中又進入封鎖模式時，尚未還原的設定交給新的封鎖週期"""
+        if previous_verification is not None:
+            if state.active:
+                if state.previous_verification is None:
+                    state.previous_verification = previous_verification
+            else:
+                try:
+                    await guild.edit(verification_level=previous_verification, reason="防炸群封鎖模式解除")
+                except Exception as e:
+                    print(f"⚠️ 無法還原驗證等級：{str(e)}")
+        for channel_id in slowmode_channels:
+            if state.active:
+                if channel_id not in state.slowmode_channels:
+                    state.slowmode_channels.append(channel_id)
+                continue
+            channel = guild.get_channel(channel_id)
+            if channel:
+                try:
+                    await channel.edit(slowmode_delay=0, reason="防炸群封鎖模式解除")
+                except Exception as e:
+                    print(f"⚠️ 無法關閉慢速模式 {channel.name}：{str(e)}")
+    
+    async def _flush_cohort(self, guild, state):
+        """批次踢出累積的成員，回傳本週期踢出 / 失敗人數"""
+        cohort, state.cohort = state.cohort, {}
+        futures = []
+        for member_id, reason in cohort.items():
+            member = guild.get_member(member_id)
+            if member:
+                futures.append(moderation_executor.kick(member, reason=reason))
+        results = await asyncio.gather(*futures, return_exceptions=True)
+        failed = sum(1 for result in results if isinstance(result, Exception))
+        state.kicked += len(results) - failed
+        state.failed += failed
+        return len(results) - failed, failed
+    
+    async def _send_summary(self, guild, state, kicked, failed, title, color):
+        embed = discord.Embed(title=title, color=color)
+        embed.add_field(name="本週期踢出", value=f"{kicked} 人" + (f"（失敗 {failed} 人）" if failed else ""), inline=True)
+        embed.add_field(name="累計踢出", value=f"{state.kicked} 人", inline=True)
+        embed.add_field(name="開始時間", value=state.started_at.strftime("%Y-%m-%d %H:%M:%S"), inline=False)
+        embed.add_field(name="時間", value=datetime.now().strftime("%Y-%m-%d %H:%M:%S"), inline=False)
+        await send_log_to_channel(guild, embed)
+        if guild.system_channel:
+            moderation_executor.send(guild.system_channel, embed=embed)
+    
+    async def _run(self, guild_id):
+        state = self._states[guild_id]
+        guild = bot.get_guild(guild_id)
+        try:
+            if guild:
+                await self._lock_guild(guild, state)
+                await self._send_summary(guild, state, 0, 0, "🚨 防炸群封鎖模式啟動", discord.Color.red())
+            while guild and state.active:
+                await asyncio.sleep(RAID_MODE_INTERVAL)
+                kicked, failed = await self._flush_cohort(guild, state)
+                if kicked or failed:
+                    await self._send_summary(guild, state, kicked, failed, "🚨 防炸群封鎖模式 - 批次處理", discord.Color.orange())
+                if monotonic() - state.last_surge_at > RAID_MODE_COOLDOWN and not state.cohort:
+                    break
+        except Exception as e:
+            print(f"⚠️ 防炸群封鎖模式錯誤：{str(e)}")
+        finally:
+            # 先取下要還原的設定再解除，之後重新進入封鎖模式時會使用新的記錄
+            previous_verification, slowmode_channels = state.previous_verification, state.slowmode_channels
+            state.previous_verification = None
+            state.slowmode_channels = []
+            state.active = False
+            state.task = None
+            if guild:
+                await self._unlock_guild(guild, state, previous_verification, slowmode_channels)
+                await self._send_summary(guild, state, 0, 0, "✅ 防炸群封鎖模式已解除", discord.Color.green())
+                print(f"✅ 伺服器 {guild.name} 已解除防炸群封鎖模式")
+    
+    def exit(self, guild_id):
+        """手動解除封鎖模式（背景任務結束時會還原設定）"""
+        state = self._states.get(guild_id)
+        if not state or not state.active:
+            return False
+        state.active = False
+        state.cohort = {}
+        if state.task:
+            state.task.cancel()
+        return True
+
+raid_mode = RaidModeManager()
+
 @bot.event
 async def on_member_join(member):
     """當成員加入伺服器時"""
     try:
         # 檢查成員是否在全域黑名單中
-        session = SessionLocal()
-        blacklist_entry = session.query(Blacklist).filter_by(
-            guild_id=member.guild.id,
-            user_id=member.id
-        ).first()
-        session.close()
+        is_blacklisted, blacklist_reason = await find_blacklist_entry(member.id, member.guild.id)
         
-        if blacklist_entry:
+        if is_blacklisted:
             # 成員在黑名單中，立即踢出並停權
             try:
-                ban_reason = f"全域黑名單用戶 - 原因：{blacklist_entry.reason}"
+                ban_reason = f"全域黑名單用戶 - 原因：{blacklist_reason}"
                 await member.ban(reason=ban_reason)
                 print(f"✅ 已停權全域黑名單用戶 {member} (ID: {member.id})")
                 
-                # 通知伺服器版主/管理員
-                owner = member.guild.owner
-                admin_roles = [role for role in member.guild.roles if role.permissions.administrator]
-                
                 # 構建詳細的停權通知
                 embed_notice = discord.Embed(
                     title="🚫 全域黑名單用戶已被停權",
@@ -1324,26 +3203,17 @@ async def on_member_join(member):
                 embed_notice.description = "用戶因在全域黑名單中已被自動停權（封禁）"
                 embed_notice.add_field(name="👤 用戶資訊", value=f"{member.mention}\n名稱: {member}\nID: {member.id}", inline=False)
                 embed_notice.add_field(name="🚫 停權原因", value=f"用戶在全域黑名單中", inline=False)
-                embed_notice.add_field(name="📋 黑名單詳細原因", value=blacklist_entry.reason or "未提供", inline=False)
+                embed_notice.add_field(name="📋 黑名單詳細原因", value=blacklist_reason or "未提供", inline=False)
                 embed_notice.add_field(name="⏱️ 停權時間", value=datetime.now().strftime("%Y-%m-%d %H:%M:%S"), inline=False)
                 embed_notice.add_field(name="📊 處理狀態", value="✅ 已封禁", inline=False)
                 embed_notice.set_footer(text="此用戶無法加入本伺服器，並在伺服器中被列為停權成員")
                 
-                # 發送給伺服器擁有者
-                if owner:
-                    try:
-                        await owner.send(embed=embed_notice)
-                    except:
-                        pass
-                
-                # 發送給管理員
-                for role in admin_roles[:5]:  # 最多通知5個管理員角色
-                    try:
-                        members_with_role = [m for m in member.guild.members if role in m.roles]
-                        for admin_member in members_with_role[:3]:  # 每個角色最多3個成員
-                            await admin_member.send(embed=embed_notice)
-                    except:
-                        pass
+                # 通知伺服器擁有者與管理員（背景合併發送）
+                admin_notifier.notify(
+                    admin_recipient_index.get(member.guild),
+                    ('blacklist_ban', member.guild.id, member.id),
+                    embed_notice
+                )
                 
                 # 發送日誌
                 embed_log = discord.Embed(
@@ -1352,7 +3222,7 @@ async def on_member_join(member):
                 )
                 embed_log.add_field(name="用戶", value=f"{member} (ID: {member.id})", inline=False)
                 embed_log.add_field(name="停權原因", value="用戶在全域黑名單中", inline=False)
-                embed_log.add_field(name="詳細原因", value=blacklist_entry.reason or "未提供", inline=False)
+                embed_log.add_field(name="詳細原因", value=blacklist_reason or "未提供", inline=False)
                 embed_log.add_field(name="時間", value=datetime.now().strftime("%Y-%m-%d %H:%M:%S"), inline=False)
                 embed_log.add_field(name="處理狀態", value="✅ 已封禁", inline=False)
                 await send_log_to_channel(member.guild, embed_log)
@@ -1367,60 +3237,20 @@ async def on_member_join(member):
     
     # ====== 防炸群加入速率檢查 ======
     guild = member.guild
-    now = datetime.now()
-    
-    # 記錄加入時間
-    if guild.id not in join_times:
-        join_times[guild.id] = deque()
-    
-    join_times[guild.id].append(now)
     
-    # 清理10分鐘前記錄
-    join_times[guild.id] = deque([t for t in join_times[guild.id] if (now - t).seconds < 600])
-    
-    # 檢查加入速率
-    if len(join_times[guild.id]) > MAX_JOINS_PER_10MIN:
+    # 記錄加入並檢查 10 分鐘內的加入速率；超標時進入封鎖模式，由封鎖模式分批處理新成員。
+    # 封鎖期間速率已回到門檻以下時，只處理不符合規則的新帳號，一般成員正常加入
+    raid_policy = await get_raid_policy(guild.id)
+    surging = join_times[guild.id].hit() > raid_policy.max_joins_per_10min
+    raid_mode.record_join(member, surging)
+    if surging or (raid_mode.is_active(guild.id) and raid_mode.is_new_account(member, raid_policy)):
         try:
-            # 檢查帳號年齡
-            account_age = (now - member.created_at.replace(tzinfo=None)).days
-            if account_age < MIN_ACCOUNT_AGE_DAYS:
-                await member.kick(reason="新帳號大量加入 - 防炸群保護")
-                print(f"🚫 踢出可疑新帳號: {member} (帳號年齡: {account_age}天)")
-                
-                # 發送日誌
-                embed_raid = discord.Embed(
-                    title="🚨 防炸群啟動 - 新帳號被踢出",
-                    color=discord.Color.red()
-                )
-                embed_raid.add_field(name="用戶", value=f"{member} (ID: {member.id})", inline=False)
-                embed_raid.add_field(name="帳號年齡", value=f"{account_age} 天", inline=False)
-                embed_raid.add_field(name="原因", value="新帳號大量加入 - 防炸群保護", inline=False)
-                embed_raid.add_field(name="時間", value=now.strftime("%Y-%m-%d %H:%M:%S"), inline=False)
-                await send_log_to_channel(guild, embed_raid)
-                
-                # 通知系統頻道
-                if guild.system_channel:
-                    await guild.system_channel.send(f"🚨 **防炸群啟動！** 已踢出可疑成員 {member.mention}\n📅 帳號建立時間: {member.created_at.strftime('%Y-%m-%d')}")
-                return
-            else:
-                # 帳號年齡足夠但加入速率過快
-                await member.kick(reason="大量加入 - 防炸群保護")
-                print(f"🚫 踢出可疑成員（加入速率過快）: {member}")
-                
-                embed_raid = discord.Embed(
-                    title="🚨 防炸群啟動 - 加入速率過快",
-                    color=discord.Color.orange()
-                )
-                embed_raid.add_field(name="用戶", value=f"{member} (ID: {member.id})", inline=False)
-                embed_raid.add_field(name="原因", value="大量加入 - 防炸群保護", inline=False)
-                embed_raid.add_field(name="時間", value=now.strftime("%Y-%m-%d %H:%M:%S"), inline=False)
-                await send_log_to_channel(guild, embed_raid)
-                
-                if guild.system_channel:
-                    await guild.system_channel.send(f"🚨 **防炸群啟動！** 已踢出可疑成員 {member.mention}\n📅 帳號建立時間: {member.created_at.strftime('%Y-%m-%d')}")
-                return
+            raid_mode.enter(guild, raid_policy)
+            raid_mode.add_to_cohort(member, raid_policy)
+            print(f"🚫 可疑成員已列入封鎖模式待踢出名單: {member}")
+            return
         except Exception as e:
-            print(f"⚠️ 防炸群踢人失敗: {e}")
+            print(f"⚠️ 防炸群封鎖模式處理失敗: {e}")
     # ====== 防炸群加入速率檢查結束 ======
     
     # 正常加入日誌
@@ -1501,6 +3331,8 @@ async def on_guild_channel_delete(channel):
 @bot.event
 async def on_guild_role_create(role):
     """當建立新身份組時"""
+    if role.permissions.administrator:
+        admin_recipient_index.invalidate(role.guild.id)
     embed = discord.Embed(
         title="➕ 新身份組已建立",
         color=discord.Color.blue()
@@ -1514,6 +3346,8 @@ async def on_guild_role_create(role):
 @bot.event
 async def on_guild_role_delete(role):
     """當刪除身份組時"""
+    if role.permissions.administrator:
+        admin_recipient_index.invalidate(role.guild.id)
     embed = discord.Embed(
         title="❌ 身份組已刪除",
         color=discord.Color.red()
@@ -1559,6 +3393,7 @@ async def help_command(interaction: Interaction):
   • 例如：`/設定防炸 類型:加入 值:10` - 10分鐘內最多10人加入
 `/防炸統計` - 查看防炸群即時統計資訊（需要管理員）
 `/清除防炸記錄` - 清除所有防炸群記錄（需要管理員）
+`/解除防炸模式` - 手動解除防炸群封鎖模式（需要管理員）
         """,
         inline=False
     )
@@ -1585,6 +3420,7 @@ async def help_command(interaction: Interaction):
 `/廣播 <訊息> [圖片URL]` - 發送廣播到所有伺服器（限開發者）
 `/指定公告發送伺服器` - 設定此伺服器是否接收公告（需要管理員）
 `/發送版主通知` - 向所有伺服器版主發送通知（限開發者）
+`/廣播狀態` - 查看 / 取消廣播任務（限開發者）
         """,
         inline=False
     )
@@ -1776,10 +3612,8 @@ async def dashboard_view(interaction: Interaction):
     
     # 防炸群管理
     try:
-        session = SessionLocal()
-        anti_spam_enabled_count = session.query(Guild).filter_by(anti_spam_enabled=True).count()
+        anti_spam_enabled_count = await run_db(lambda session: session.query(Guild).filter_by(anti_spam_enabled=True).count())
         total_guilds = len(bot.guilds)
-        session.close()
         
         dashboard_embed.add_field(
             name="🛡️ 防炸群管理",
@@ -1858,13 +3692,13 @@ async def logs_command(interaction: Interaction, channel: discord.TextChannel):
         return
     
     try:
-        session = SessionLocal()
-        guild = get_or_create_guild(interaction.guild.id)
+        def _set_log_channel(session):
+            guild = _get_or_create_guild(session, interaction.guild.id)
+            guild.log_channel = channel.id
+            session.commit()
         
-        guild.log_channel = channel.id
-        session.add(guild)
-        session.commit()
-        session.close()
+        await run_db(_set_log_channel)
+        guild_config_cache.invalidate(interaction.guild.id)
         
         embed = discord.Embed(title="✅ 日誌頻道已設定", color=discord.Color.green())
         embed.add_field(name="頻道", value=channel.mention, inline=False)
@@ -1888,9 +3722,7 @@ async def test_logs_command(interaction: Interaction):
         return
     
     try:
-        session = SessionLocal()
-        guild_config = session.query(Guild).filter_by(guild_id=interaction.guild.id).first()
-        session.close()
+        guild_config = await guild_config_cache.get(interaction.guild.id)
         
         if not guild_config or not guild_config.log_channel:
             await interaction.response.send_message("❌ 未設定日誌頻道，請先使用 `/日誌 <頻道>` 設定", ephemeral=True)
@@ -2202,9 +4034,7 @@ async def welcome_cmd(interaction: Interaction, message: str, channel: discord.T
     if not caller or not caller.guild_permissions.manage_guild:
         await interaction.response.send_message("❌ 您沒有管理伺服器的權限", ephemeral=True)
         return
-    session = SessionLocal()
-    guild = session.query(Guild).filter_by(guild_id=interaction.guild_id).first()
-    session.close()
+    guild = await guild_config_cache.get(interaction.guild_id)
     
     target_channel = channel or interaction.guild.system_channel
     if not target_channel:
@@ -2276,27 +4106,26 @@ async def test_status(interaction: Interaction):
 @app_commands.describe(title="圖片標題")
 async def meme(interaction: Interaction, title: str = None):
     try:
-        session = SessionLocal()
         if title:
-            meme = session.query(Meme).filter_by(guild_id=interaction.guild_id, title=title, status="approved").first()
+            meme = await run_db(
+                lambda session: session.query(Meme).filter_by(guild_id=interaction.guild_id, title=title, status="approved").first()
+            )
         else:
-            memes = session.query(Meme).filter_by(guild_id=interaction.guild_id, status="approved").all()
-            if not memes:
+            meme = await run_db(
+                lambda session: session.query(Meme).filter_by(guild_id=interaction.guild_id, status="approved").first()
+            )
+            if not meme:
                 await interaction.response.send_message("❌ 沒有可用的迷因", ephemeral=True)
-                session.close()
                 return
-            meme = memes[0]
         
         if not meme:
             await interaction.response.send_message(f"❌ 找不到標題為 '{title}' 的迷因", ephemeral=True)
-            session.close()
             return
         
         embed = discord.Embed(title=meme.title or "迷因", color=discord.Color.random())
         embed.set_image(url=meme.image_url)
         embed.set_footer(text=f"上傳者: {meme.uploaded_by}")
         await interaction.response.send_message(embed=embed, ephemeral=True)
-        session.close()
     except Exception as e:
         await interaction.response.send_message(f"❌ 操作失敗：{str(e)}", ephemeral=True)
 
@@ -2304,7 +4133,6 @@ async def meme(interaction: Interaction, title: str = None):
 @app_commands.describe(image_url="圖片URL", title="圖片標題")
 async def submit(interaction: Interaction, image_url: str, title: str = "未命名"):
     try:
-        session = SessionLocal()
         submission = Submission(
             guild_id=interaction.guild_id,
             image_url=image_url,
@@ -2312,9 +4140,7 @@ async def submit(interaction: Interaction, image_url: str, title: str = "未命
             submitted_by=interaction.user.id,
             status="pending"
         )
-        session.add(submission)
-        session.commit()
-        session.close()
+        await run_db(_add_and_commit, submission)
         
         embed = discord.Embed(title="✅ 圖片已提交審核", color=discord.Color.green())
         embed.add_field(name="標題", value=title, inline=False)
@@ -2391,9 +4217,17 @@ async def poll(interaction: Interaction, question: str, option1: str, option2: s
         await msg.add_reaction(reactions[i])
 
 verification_codes = {}
-verification_attempt_tracker = defaultdict(list)  # 用戶ID -> [時間戳]
-verification_warning_count = defaultdict(lambda: defaultdict(int))  # guild_id -> {user_id: 警告次數}
-verification_password_attempts = defaultdict(lambda: defaultdict(int))  # guild_id -> {user_id: 密碼輸入錯誤次數}
+VERIFICATION_CODE_TTL = 300  # 驗證密碼有效期 5 分鐘
+
+def schedule_verification_code_expiry(guild_id, code):
+    """驗證密碼到期後刪除（若期間已被新密碼取代則不動）"""
+    def _expire():
+        if verification_codes.get(guild_id) == code:
+            del verification_codes[guild_id]
+    expiry_scheduler.schedule(VERIFICATION_CODE_TTL, _expire, key=('verification_code', guild_id))
+verification_attempt_tracker = UserStateStore('verification_attempts', list, ttl=3600)  # 用戶ID -> [時間戳]
+verification_warning_count = UserStateStore('verification_warnings', int, ttl=24 * 3600)  # (guild_id, user_id) -> 警告次數
+verification_password_attempts = UserStateStore('verification_password_attempts', int, ttl=24 * 3600)  # (guild_id, user_id) -> 密碼輸入錯誤次數
 
 def check_verification_spam(user_id: int, guild_id: int, is_already_verified: bool = False):
     """檢查驗證按鈕是否被濫用（最多只能按3次），達到3次警告則踢出"""
@@ -2401,11 +4235,11 @@ def check_verification_spam(user_id: int, guild_id: int, is_already_verified: bo
     WINDOW = 3600  # 1小時時間窗口（改為追蹤更長時間以統計總按鈕次數）
     MAX_ATTEMPTS = 3  # 最多3次按鈕
     
-    user_attempts = verification_attempt_tracker[user_id]
+    user_attempts = verification_attempt_tracker.get(user_id)
     
     # 清理超過時間窗口的舊記錄 - 使用 total_seconds() 而不是 .seconds
     user_attempts = [timestamp for timestamp in user_attempts if (current_time - timestamp).total_seconds() < WINDOW]
-    verification_attempt_tracker[user_id] = user_attempts
+    verification_attempt_tracker.set(user_id, user_attempts)
     
     # 添加新的嘗試記錄
     user_attempts.append(current_time)
@@ -2414,13 +4248,24 @@ def check_verification_spam(user_id: int, guild_id: int, is_already_verified: bo
     is_spam = False
     if len(user_attempts) > MAX_ATTEMPTS or is_already_verified:
         # 增加警告計數
-        verification_warning_count[guild_id][user_id] += 1
-        warning_count = verification_warning_count[guild_id][user_id]
+        warning_count = verification_warning_count.incr((guild_id, user_id))
         
         # 檢查是否達到 3 次警告
         should_kick = warning_count >= 3
         return True, len(user_attempts), warning_count, should_kick
-    return False, len(user_attempts), verification_warning_count[guild_id][user_id], False
+    return False, len(user_attempts), verification_warning_count.peek((guild_id, user_id), 0), False
+
+def _mark_verified(session, guild_id, user_id):
+    verification = session.query(Verification).filter_by(guild_id=guild_id, user_id=user_id).first()
+    
+    if not verification:
+        verification = Verification(guild_id=guild_id, user_id=user_id, verified=True, verified_at=datetime.utcnow())
+        session.add(verification)
+    else:
+        verification.verified = True
+        verification.verified_at = datetime.utcnow()
+    
+    session.commit()
 
 class QuickVerificationModal(ui.Modal, title="身份驗證"):
     password = ui.TextInput(label="請輸入 6 位數驗證密碼", placeholder="例如: 123456", max_length=6, min_length=6)
@@ -2436,20 +4281,9 @@ class QuickVerificationModal(ui.Modal, title="身份驗證"):
         
         if entered_code == self.correct_code:
             # 驗證成功，重置錯誤計數
-            verification_password_attempts[self.guild_id][self.user_id] = 0
-            
-            session = SessionLocal()
-            verification = session.query(Verification).filter_by(guild_id=self.guild_id, user_id=self.user_id).first()
+            verification_password_attempts.pop((self.guild_id, self.user_id))
             
-            if not verification:
-                verification = Verification(guild_id=self.guild_id, user_id=self.user_id, verified=True, verified_at=datetime.utcnow())
-                session.add(verification)
-            else:
-                verification.verified = True
-                verification.verified_at = datetime.utcnow()
-            
-            session.commit()
-            session.close()
+            await run_db(_mark_verified, self.guild_id, self.user_id)
             
             # 刪除驗證碼
             if self.guild_id in verification_codes:
@@ -2488,8 +4322,7 @@ class QuickVerificationModal(ui.Modal, title="身份驗證"):
                 await interaction.response.send_message(embed=embed, ephemeral=True)
         else:
             # 密碼錯誤，增加錯誤計數
-            verification_password_attempts[self.guild_id][self.user_id] += 1
-            error_count = verification_password_attempts[self.guild_id][self.user_id]
+            error_count = verification_password_attempts.incr((self.guild_id, self.user_id))
             
             # 如果錯誤3次，刪除驗證碼，讓用戶重新開始
             if error_count >= 3:
@@ -2550,10 +4383,10 @@ class QuickVerificationButtonView(ui.View):
                 return
             
             # 先檢查是否已驗證
-            session_check = SessionLocal()
-            verification_check = session_check.query(Verification).filter_by(guild_id=self.guild_id, user_id=interaction.user.id).first()
+            verification_check = await run_db(
+                lambda session: session.query(Verification).filter_by(guild_id=self.guild_id, user_id=interaction.user.id).first()
+            )
             is_already_verified = verification_check and verification_check.verified
-            session_check.close()
             
             # 檢查是否濫用
             is_spam, attempt_count, warning_count, should_kick = check_verification_spam(interaction.user.id, self.guild_id, is_already_verified)
@@ -2637,8 +4470,7 @@ class QuickVerificationButtonView(ui.View):
                                 await member.kick(reason="驗證功能濫用（3次警告）")
                                 print(f"🔴 已踢出用戶 {interaction.user.id}，原因：驗證功能濫用")
                                 
-                                session = SessionLocal()
-                                try:
+                                def _blacklist_abuser(session):
                                     existing = session.query(Blacklist).filter_by(
                                         guild_id=self.guild_id,
                                         user_id=interaction.user.id
@@ -2652,9 +4484,12 @@ class QuickVerificationButtonView(ui.View):
                                         )
                                         session.add(blacklist_entry)
                                         session.commit()
-                                        print(f"⛔ 用戶 {interaction.user.id} 已添加到黑名單")
-                                finally:
-                                    session.close()
+                                        return True
+                                    return False
+                                
+                                if await run_db(_blacklist_abuser):
+                                    blacklist_index.add(interaction.user.id, self.guild_id, "驗證功能濫用（3次警告自動踢出）")
+                                    print(f"⛔ 用戶 {interaction.user.id} 已添加到黑名單")
                         except Exception as e:
                             print(f"❌ 踢出用戶或添加黑名單時發生錯誤: {str(e)}")
                     
@@ -2665,6 +4500,7 @@ class QuickVerificationButtonView(ui.View):
             # 交互已經在函數開始時 defer 了，不需要再 defer
             verification_code = str(random.randint(100000, 999999))
             verification_codes[self.guild_id] = verification_code
+            schedule_verification_code_expiry(self.guild_id, verification_code)
             
             try:
                 dm_embed = discord.Embed(title="🔐 驗證密碼", color=discord.Color.blurple())
@@ -2727,18 +4563,7 @@ class VerificationModal(ui.Modal, title="身份驗證"):
         entered_code = str(self.password.value)
         
         if entered_code == self.correct_code:
-            session = SessionLocal()
-            verification = session.query(Verification).filter_by(guild_id=self.guild_id, user_id=self.user_id).first()
-            
-            if not verification:
-                verification = Verification(guild_id=self.guild_id, user_id=self.user_id, verified=True, verified_at=datetime.utcnow())
-                session.add(verification)
-            else:
-                verification.verified = True
-                verification.verified_at = datetime.utcnow()
-            
-            session.commit()
-            session.close()
+            await run_db(_mark_verified, self.guild_id, self.user_id)
             
             if self.guild_id in verification_codes:
                 del verification_codes[self.guild_id]
@@ -2849,9 +4674,7 @@ async def restart_bot(interaction: Interaction):
 
 @bot.tree.command(name="announcement", description="查看公告頻道設定")
 async def announcement(interaction: Interaction):
-    session = SessionLocal()
-    guild = session.query(Guild).filter_by(guild_id=interaction.guild_id).first()
-    session.close()
+    guild = await guild_config_cache.get(interaction.guild_id)
     
     embed = discord.Embed(title="📢 公告頻道設定", color=discord.Color.blue())
     
@@ -2881,14 +4704,13 @@ async def set_announcement_channel(interaction: Interaction, channel: discord.Te
         await interaction.response.send_message("❌ 此指令只有管理員可以使用", ephemeral=True)
         return
     
-    session = SessionLocal()
-    guild = session.query(Guild).filter_by(guild_id=interaction.guild_id).first()
-    if not guild:
-        guild = Guild(guild_id=interaction.guild_id)
-        session.add(guild)
-    guild.announcement_channel = channel.id
-    session.commit()
-    session.close()
+    def _set_announcement_channel(session):
+        guild = _get_or_create_guild(session, interaction.guild_id)
+        guild.announcement_channel = channel.id
+        session.commit()
+    
+    await run_db(_set_announcement_channel)
+    guild_config_cache.invalidate(interaction.guild_id)
     
     embed = discord.Embed(title="✅ 公告頻道已設定", color=discord.Color.green())
     embed.add_field(name="頻道", value=channel.mention, inline=False)
@@ -2907,19 +4729,21 @@ async def remove_announcement_channel(interaction: Interaction, guild_id: str):
         await interaction.response.send_message("❌ 無效的伺服器ID", ephemeral=True)
         return
     
-    session = SessionLocal()
-    guild = session.query(Guild).filter_by(guild_id=guild_id_int).first()
+    def _clear_announcement_channel(session):
+        guild = session.query(Guild).filter_by(guild_id=guild_id_int).first()
+        if not guild:
+            return False, None
+        old_channel_id = guild.announcement_channel
+        guild.announcement_channel = None
+        session.commit()
+        return True, old_channel_id
     
-    if not guild:
-        session.close()
+    found, old_channel_id = await run_db(_clear_announcement_channel)
+    guild_config_cache.invalidate(guild_id_int)
+    if not found:
         await interaction.response.send_message(f"❌ 未找到伺服器 {guild_id}", ephemeral=True)
         return
     
-    old_channel_id = guild.announcement_channel
-    guild.announcement_channel = None
-    session.commit()
-    session.close()
-    
     embed = discord.Embed(title="✅ 公告設置已移除", color=discord.Color.green())
     embed.add_field(name="伺服器ID", value=f"`{guild_id}`", inline=False)
     if old_channel_id:
@@ -2932,48 +4756,26 @@ async def remove_announcement_channel(interaction: Interaction, guild_id: str):
 @bot.tree.command(name="發送版主通知", description="向所有伺服器的版主發送通知（只有開發者可用）")
 @app_commands.describe(message="通知內容", title="通知標題")
 async def send_owner_notification(interaction: Interaction, title: str, message: str):
-    if not can_use_dangerous_commands(interaction.user.id):
+    if not await can_use_dangerous_commands(interaction.user.id):
         await interaction.response.send_message("❌ 您沒有權限使用此危險指令", ephemeral=True)
         return
     
     await interaction.response.defer(ephemeral=True)
     
-    try:
-        success_count = 0
-        fail_count = 0
-        
-        for guild in bot.guilds:
-            try:
-                owner = guild.owner
-                if owner:
-                    # 發送私人信息給伺服器版主
-                    embed = discord.Embed(title=title, color=discord.Color.blue())
-                    embed.description = message
-                    embed.add_field(name="伺服器", value=guild.name, inline=False)
-                    embed.add_field(name="伺服器ID", value=f"`{guild.id}`", inline=False)
-                    embed.add_field(name="成員數", value=f"{guild.member_count} 人", inline=False)
-                    embed.add_field(name="發送時間", value=f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", inline=False)
-                    embed.set_footer(text="此訊息來自開發者")
-                    
-                    await owner.send(embed=embed)
-                    success_count += 1
-                    print(f"✅ 版主通知已發送給伺服器 {guild.name} ({guild.id})")
-                else:
-                    fail_count += 1
-                    print(f"⚠️ 無法找到伺服器 {guild.name} ({guild.id}) 的版主")
-            except Exception as e:
-                fail_count += 1
-                print(f"❌ 無法發送版主通知到伺服器 {guild.id}: {str(e)}")
-        
+    async def _report(job_id, progress):
         embed = discord.Embed(title="✅ 版主通知已發送", color=discord.Color.green())
-        embed.description = f"已向 {success_count} 個伺服器的版主發送通知"
+        embed.description = f"已向 {progress['sent']} 個伺服器的版主發送通知"
         embed.add_field(name="通知標題", value=title, inline=False)
         embed.add_field(name="通知內容", value=message[:500], inline=False)
-        embed.add_field(name="成功", value=f"{success_count} 個伺服器", inline=False)
-        if fail_count > 0:
-            embed.add_field(name="失敗", value=f"{fail_count} 個伺服器", inline=False)
-        
-        await interaction.followup.send(embed=embed, ephemeral=True)
+        embed.add_field(name="成功", value=f"{progress['sent']} 個伺服器", inline=False)
+        if progress['failed'] > 0:
+            embed.add_field(name="失敗", value=f"{progress['failed']} 個伺服器", inline=False)
+        embed.set_footer(text=f"任務 #{job_id}")
+        await send_broadcast_report(interaction, embed)
+    
+    try:
+        job_id = await broadcast_jobs.start('owner_notice', {'title': title, 'message': message}, interaction.user.id, _report)
+        await interaction.followup.send(f"📨 版主通知任務 #{job_id} 已開始在背景發送（共 {len(bot.guilds)} 個伺服器），可用 `/廣播狀態` 查看進度", ephemeral=True)
     except Exception as e:
         await interaction.followup.send(f"❌ 發送版主通知失敗：{str(e)}", ephemeral=True)
 
@@ -2992,15 +4794,13 @@ async def set_announcement_server(interaction: Interaction, enabled: bool):
         return
     
     try:
-        session = SessionLocal()
-        guild = session.query(Guild).filter_by(guild_id=interaction.guild_id).first()
-        if not guild:
-            guild = Guild(guild_id=interaction.guild_id)
-            session.add(guild)
+        def _set_receive_announcements(session):
+            guild = _get_or_create_guild(session, interaction.guild_id)
+            guild.receive_announcements = enabled
+            session.commit()
         
-        guild.receive_announcements = enabled
-        session.commit()
-        session.close()
+        await run_db(_set_receive_announcements)
+        guild_config_cache.invalidate(interaction.guild_id)
         
         status = "✅ 已啟用" if enabled else "❌ 已禁用"
         embed = discord.Embed(title="📢 公告接收設定", color=discord.Color.green() if enabled else discord.Color.red())
@@ -3163,6 +4963,7 @@ async def set_announcement_server(interaction: Interaction, enabled: bool):
 `/廣播 <訊息> [圖片URL]` - 發送廣播到所有伺服器（限開發者）
 `/指定公告發送伺服器` - 設定此伺服器是否接收公告（需要管理員）
 `/發送版主通知` - 向所有伺服器版主發送通知（限開發者）
+`/廣播狀態` - 查看 / 取消廣播任務（限開發者）
         """,
         inline=False
     )
@@ -3273,23 +5074,21 @@ async def add_blacklist(interaction: Interaction, user: discord.User, reason: st
         return
     
     try:
-        session = SessionLocal()
-        guild_obj = session.query(Guild).filter_by(guild_id=interaction.guild.id).first()
-        if not guild_obj:
-            guild_obj = Guild(guild_id=interaction.guild.id)
-            session.add(guild_obj)
+        def _add_blacklist(session):
+            _get_or_create_guild(session, interaction.guild.id)
+            existing = session.query(Blacklist).filter_by(guild_id=interaction.guild.id, user_id=user.id).first()
+            if existing:
+                return False
+            session.add(Blacklist(guild_id=interaction.guild.id, user_id=user.id, reason=reason))
             session.commit()
+            return True
         
-        existing = session.query(Blacklist).filter_by(guild_id=interaction.guild.id, user_id=user.id).first()
-        if existing:
-            session.close()
+        added = await run_db(_add_blacklist)
+        guild_config_cache.invalidate(interaction.guild.id)  # 可能建立了新的 Guild 記錄
+        if not added:
             await interaction.response.send_message(f"❌ {user.mention} 已在黑名單中", ephemeral=True)
             return
-        
-        blacklist_entry = Blacklist(guild_id=interaction.guild.id, user_id=user.id, reason=reason)
-        session.add(blacklist_entry)
-        session.commit()
-        session.close()
+        blacklist_index.add(user.id, interaction.guild.id, reason)
         
         embed = discord.Embed(title="✅ 用戶已加入黑名單", color=discord.Color.red())
         embed.add_field(name="用戶", value=user.mention, inline=False)
@@ -3312,17 +5111,18 @@ async def remove_blacklist(interaction: Interaction, user: discord.User):
         return
     
     try:
-        session = SessionLocal()
-        blacklist_entry = session.query(Blacklist).filter_by(guild_id=interaction.guild.id, user_id=user.id).first()
+        def _remove_blacklist(session):
+            blacklist_entry = session.query(Blacklist).filter_by(guild_id=interaction.guild.id, user_id=user.id).first()
+            if not blacklist_entry:
+                return False
+            session.delete(blacklist_entry)
+            session.commit()
+            return True
         
-        if not blacklist_entry:
-            session.close()
+        if not await run_db(_remove_blacklist):
             await interaction.response.send_message(f"❌ {user.mention} 不在黑名單中", ephemeral=True)
             return
-        
-        session.delete(blacklist_entry)
-        session.commit()
-        session.close()
+        blacklist_index.remove(user.id, interaction.guild.id)
         
         embed = discord.Embed(title="✅ 用戶已從黑名單移除", color=discord.Color.green())
         embed.add_field(name="用戶", value=user.mention, inline=False)
@@ -3343,9 +5143,7 @@ async def view_blacklist(interaction: Interaction):
         return
     
     try:
-        session = SessionLocal()
-        blacklist_entries = session.query(Blacklist).filter_by(guild_id=interaction.guild.id).all()
-        session.close()
+        blacklist_entries = await run_db(lambda session: session.query(Blacklist).filter_by(guild_id=interaction.guild.id).all())
         
         if not blacklist_entries:
             await interaction.response.send_message("✅ 黑名單為空", ephemeral=True)
@@ -3353,11 +5151,12 @@ async def view_blacklist(interaction: Interaction):
         
         embed = discord.Embed(title=f"📋 黑名單 ({len(blacklist_entries)} 個用戶)", color=discord.Color.red())
         
+        users = await resolve_users(entry.user_id for entry in blacklist_entries)
         for entry in blacklist_entries:
-            try:
-                u = await bot.fetch_user(entry.user_id)
+            u = users.get(entry.user_id)
+            if u:
                 embed.add_field(name=f"👤 {u}", value=f"原因: {entry.reason}\n時間: {entry.added_at.strftime('%Y-%m-%d %H:%M:%S')}", inline=False)
-            except:
+            else:
                 embed.add_field(name=f"👤 ID: {entry.user_id}", value=f"原因: {entry.reason}\n時間: {entry.added_at.strftime('%Y-%m-%d %H:%M:%S')}", inline=False)
         
         await interaction.response.send_message(embed=embed, ephemeral=True)
@@ -3372,33 +5171,34 @@ async def add_global_blacklist(interaction: Interaction, user: discord.User, rea
         return
     
     try:
-        session = SessionLocal()
+        guild_ids = [guild.id for guild in bot.guilds]
+        
+        def _add_global_blacklist(session):
+            # 檢查用戶是否已在全域黑名單中
+            existing = session.query(Blacklist).filter_by(user_id=user.id).first()
+            if existing:
+                return None
+            
+            # 在所有伺服器中添加黑名單
+            added_count = 0
+            for guild_id in guild_ids:
+                try:
+                    _get_or_create_guild(session, guild_id)
+                    session.add(Blacklist(guild_id=guild_id, user_id=user.id, reason=reason))
+                    added_count += 1
+                except:
+                    pass
+            
+            session.commit()
+            return added_count
         
-        # 檢查用戶是否已在全域黑名單中
-        existing = session.query(Blacklist).filter_by(user_id=user.id).first()
-        if existing:
+        added_count = await run_db(_add_global_blacklist)
+        guild_config_cache.invalidate()  # 可能建立了新的 Guild 記錄
+        if added_count is None:
             await interaction.response.send_message(f"❌ {user.mention} 已在全域黑名單中", ephemeral=False)
-            session.close()
             return
-        
-        # 在所有伺服器中添加黑名單
-        added_count = 0
-        for guild in bot.guilds:
-            try:
-                guild_obj = session.query(Guild).filter_by(guild_id=guild.id).first()
-                if not guild_obj:
-                    guild_obj = Guild(guild_id=guild.id)
-                    session.add(guild_obj)
-                    session.commit()
-                
-                blacklist_entry = Blacklist(guild_id=guild.id, user_id=user.id, reason=reason)
-                session.add(blacklist_entry)
-                added_count += 1
-            except:
-                pass
-        
-        session.commit()
-        session.close()
+        for guild_id in guild_ids:
+            blacklist_index.add(user.id, guild_id, reason)
         
         # 發送私訊給被加入黑名單的用戶
         try:
@@ -3431,8 +5231,6 @@ async def query_global_blacklist(interaction: Interaction, guild_id: str = None,
         return
     
     try:
-        session = SessionLocal()
-        
         # 驗證伺服器ID
         target_guild_id = None
         if guild_id:
@@ -3441,24 +5239,24 @@ async def query_global_blacklist(interaction: Interaction, guild_id: str = None,
                 target_guild = bot.get_guild(target_guild_id)
                 if not target_guild:
                     await interaction.response.send_message(f"❌ 找不到伺服器 ID: {guild_id}", ephemeral=True)
-                    session.close()
                     return
             except ValueError:
                 await interaction.response.send_message("❌ 無效的伺服器ID", ephemeral=True)
-                session.close()
                 return
         
         # 按優先級進行查詢
         if user:
             # 查詢特定用戶的黑名單記錄
-            query = session.query(Blacklist).filter_by(user_id=user.id)
-            if target_guild_id:
-                query = query.filter_by(guild_id=target_guild_id)
-            blacklist_entries = query.all()
+            def _query_user(session):
+                query = session.query(Blacklist).filter_by(user_id=user.id)
+                if target_guild_id:
+                    query = query.filter_by(guild_id=target_guild_id)
+                return query.all()
+            
+            blacklist_entries = await run_db(_query_user)
             
             if not blacklist_entries:
                 await interaction.response.send_message(f"✅ 用戶 {user.mention} 不在黑名單中", ephemeral=True)
-                session.close()
                 return
             
             # 按伺服器分組
@@ -3479,161 +5277,35 @@ async def query_global_blacklist(interaction: Interaction, guild_id: str = None,
                 )
             
             await interaction.response.send_message(embed=embed, ephemeral=True)
-            session.close()
             return
         
-        elif reason:
-            # 查詢特定原因的黑名單記錄
-            query = session.query(Blacklist).filter(Blacklist.reason.ilike(f"%{reason}%"))
-            if target_guild_id:
-                query = query.filter_by(guild_id=target_guild_id)
-            blacklist_entries = query.all()
-            
-            if not blacklist_entries:
-                await interaction.response.send_message(f"✅ 沒有找到原因包含 '{reason}' 的黑名單記錄", ephemeral=True)
-                session.close()
-                return
-            
-            # 按伺服器分組
-            blacklist_by_guild = {}
-            for entry in blacklist_entries:
-                if entry.guild_id not in blacklist_by_guild:
-                    blacklist_by_guild[entry.guild_id] = []
-                blacklist_by_guild[entry.guild_id].append(entry)
-            
-            embeds = []
-            for gid, entries in blacklist_by_guild.items():
-                guild = bot.get_guild(gid)
-                guild_name = guild.name if guild else f"未知伺服器 ({gid})"
-                
-                embed = discord.Embed(
-                    title=f"📋 {guild_name} 的黑名單 (原因: {reason})",
-                    description=f"共 {len(entries)} 個用戶",
-                    color=discord.Color.red()
-                )
-                
-                for entry in entries:
-                    try:
-                        u = await bot.fetch_user(entry.user_id)
-                        user_info = f"👤 {u} (ID: {entry.user_id})"
-                    except:
-                        user_info = f"👤 ID: {entry.user_id}"
-                    
-                    embed.add_field(
-                        name=user_info,
-                        value=f"時間: {entry.added_at.strftime('%Y-%m-%d %H:%M:%S')}",
-                        inline=False
-                    )
-                
-                embeds.append(embed)
-            
-            await interaction.response.send_message(embeds=embeds[:10] if len(embeds, ephemeral=True) > 10 else embeds)
-            
-            if len(embeds) > 10:
-                for i in range(10, len(embeds), 10):
-                    await interaction.followup.send(embeds=embeds[i:i+10])
-            
-            session.close()
-            return
+        # 依原因 / 伺服器過濾，分頁顯示
+        filters = []
+        if target_guild_id:
+            filters.append(Blacklist.guild_id == target_guild_id)
+        if reason:
+            filters.append(reason_filter(Blacklist, reason))
         
-        # 查詢伺服器或所有黑名單
         if target_guild_id:
-            blacklist_entries = session.query(Blacklist).filter_by(guild_id=target_guild_id).all()
             guild = bot.get_guild(target_guild_id)
-            guild_name = guild.name if guild else f"伺服器 {target_guild_id}"
-            
-            if not blacklist_entries:
-                embed = discord.Embed(
-                    title=f"✅ {guild_name} - 全域黑名單",
-                    description="此伺服器沒有黑名單用戶",
-                    color=discord.Color.green()
-                )
-                await interaction.response.send_message(embed=embed, ephemeral=True)
-                session.close()
-                return
-            
-            embed = discord.Embed(
-                title=f"📋 {guild_name} 的黑名單",
-                description=f"共 {len(blacklist_entries)} 個用戶",
-                color=discord.Color.red()
-            )
-            
-            for entry in blacklist_entries[:25]:
-                try:
-                    u = await bot.fetch_user(entry.user_id)
-                    user_info = f"👤 {u} (ID: {entry.user_id})"
-                except:
-                    user_info = f"👤 ID: {entry.user_id}"
-                
-                embed.add_field(
-                    name=user_info,
-                    value=f"原因: {entry.reason}\n時間: {entry.added_at.strftime('%Y-%m-%d %H:%M:%S')}",
-                    inline=False
-                )
-            
-            if len(blacklist_entries) > 25:
-                embed.add_field(name="⚠️ 提示", value=f"還有 {len(blacklist_entries) - 25} 個用戶未顯示", inline=False)
-            
-            await interaction.response.send_message(embed=embed, ephemeral=True)
-            session.close()
-            return
-        
-        # 查詢所有黑名單
-        all_blacklist_entries = session.query(Blacklist).all()
-        session.close()
-        
-        if not all_blacklist_entries:
-            await interaction.response.send_message("✅ 全域黑名單為空", ephemeral=True)
-            return
-        
-        # 按伺服器分組
-        blacklist_by_guild = {}
-        for entry in all_blacklist_entries:
-            if entry.guild_id not in blacklist_by_guild:
-                blacklist_by_guild[entry.guild_id] = []
-            blacklist_by_guild[entry.guild_id].append(entry)
+            title = f"📋 {guild.name if guild else f'伺服器 {target_guild_id}'} 的黑名單"
+        else:
+            title = "🌍 全域黑名單"
+        if reason:
+            title += f" (原因: {reason})"
         
-        embeds = []
-        for guild_id, entries in blacklist_by_guild.items():
-            guild = bot.get_guild(guild_id)
-            guild_name = guild.name if guild else f"未知伺服器 ({guild_id})"
-            
-            embed = discord.Embed(
-                title=f"📋 {guild_name} 的黑名單",
-                description=f"共 {len(entries)} 個用戶",
-                color=discord.Color.red()
-            )
-            
-            for entry in entries:
-                try:
-                    u = await bot.fetch_user(entry.user_id)
-                    user_info = f"👤 {u} (ID: {entry.user_id})"
-                except:
-                    user_info = f"👤 ID: {entry.user_id}"
-                
-                embed.add_field(
-                    name=user_info,
-                    value=f"原因: {entry.reason}\n時間: {entry.added_at.strftime('%Y-%m-%d %H:%M:%S')}",
-                    inline=False
-                )
-            
-            embeds.append(embed)
+        if reason:
+            empty_message = f"✅ 沒有找到原因包含 '{reason}' 的黑名單記錄"
+        elif target_guild_id:
+            empty_message = "✅ 此伺服器沒有黑名單用戶"
+        else:
+            empty_message = "✅ 全域黑名單為空"
         
-        # 添加總結 embed
-        summary_embed = discord.Embed(
-            title="🌍 全域黑名單總結",
-            color=discord.Color.red()
+        await send_paginated_listing(
+            interaction, Blacklist, filters,
+            member_list_renderer(title, discord.Color.red(), show_guild=not target_guild_id),
+            empty_message
         )
-        summary_embed.add_field(name="涉及伺服器", value=f"{len(blacklist_by_guild)} 個", inline=False)
-        summary_embed.add_field(name="黑名單用戶總數", value=f"{len(all_blacklist_entries)} 個", inline=False)
-        
-        embeds.insert(0, summary_embed)
-        
-        await interaction.response.send_message(embeds=embeds[:10] if len(embeds, ephemeral=True) > 10 else embeds)
-        
-        if len(embeds) > 10:
-            for i in range(10, len(embeds), 10):
-                await interaction.followup.send(embeds=embeds[i:i+10])
     
     except Exception as e:
         await interaction.response.send_message(f"❌ 查詢失敗：{str(e)}", ephemeral=True)
@@ -3646,8 +5318,6 @@ async def remove_global_blacklist(interaction: Interaction, user: discord.User,
         return
     
     try:
-        session = SessionLocal()
-        
         # 驗證伺服器ID
         target_guild_id = None
         if guild_id:
@@ -3656,30 +5326,27 @@ async def remove_global_blacklist(interaction: Interaction, user: discord.User,
                 target_guild = bot.get_guild(target_guild_id)
                 if not target_guild:
                     await interaction.response.send_message(f"❌ 找不到伺服器 ID: {guild_id}", ephemeral=True)
-                    session.close()
                     return
             except ValueError:
                 await interaction.response.send_message("❌ 無效的伺服器ID", ephemeral=True)
-                session.close()
                 return
         
-        # 查詢黑名單
-        query = session.query(Blacklist).filter_by(user_id=user.id)
-        if target_guild_id:
-            query = query.filter_by(guild_id=target_guild_id)
+        # 查詢並刪除黑名單
+        def _remove_entries(session):
+            query = session.query(Blacklist).filter_by(user_id=user.id)
+            if target_guild_id:
+                query = query.filter_by(guild_id=target_guild_id)
+            count = query.delete()
+            session.commit()
+            return count
         
-        entries = query.all()
+        count = await run_db(_remove_entries)
+        blacklist_index.remove(user.id, target_guild_id)
         
-        if not entries:
+        if not count:
             await interaction.response.send_message(f"✅ 用戶 {user.mention} 不在黑名單中", ephemeral=False)
-            session.close()
             return
         
-        count = len(entries)
-        query.delete()
-        session.commit()
-        session.close()
-        
         location = f"伺服器 {target_guild_id}" if target_guild_id else "全域黑名單"
         embed = discord.Embed(title="✅ 已移除用戶", color=discord.Color.green())
         embed.add_field(name="用戶", value=user.mention, inline=False)
@@ -3714,10 +5381,8 @@ async def set_global_blacklist(interaction: Interaction, action: str = ""):
     
     if action.lower() == "clear":
         try:
-            session = SessionLocal()
-            session.query(Blacklist).delete()
-            session.commit()
-            session.close()
+            await run_db(_delete_all_and_commit, Blacklist)
+            blacklist_index.clear()
             
             embed = discord.Embed(title="✅ 全域黑名單已清空", color=discord.Color.green())
             await interaction.response.send_message(embed=embed, ephemeral=True)
@@ -3739,17 +5404,14 @@ async def global_blacklist(interaction: Interaction, user: discord.User = None,
         return
     
     try:
-        session = SessionLocal()
-        
         # 如果指定了用戶或原因，進行過濾查詢
         if user or reason:
             if user:
                 # 查詢特定用戶的黑名單記錄
-                blacklist_entries = session.query(Blacklist).filter_by(user_id=user.id).all()
+                blacklist_entries = await run_db(lambda session: session.query(Blacklist).filter_by(user_id=user.id).all())
                 
                 if not blacklist_entries:
                     await interaction.response.send_message(f"✅ 用戶 {user.mention} 不在任何黑名單中", ephemeral=True)
-                    session.close()
                     return
                 
                 embed = discord.Embed(title=f"📋 用戶 {user.name} 的黑名單記錄", color=discord.Color.red())
@@ -3760,42 +5422,16 @@ async def global_blacklist(interaction: Interaction, user: discord.User = None,
                         inline=False
                     )
                 await interaction.response.send_message(embed=embed, ephemeral=True)
-                session.close()
                 return
             
-            if reason:
-                blacklist_entries = session.query(Blacklist).filter(Blacklist.reason.contains(reason)).all()
-                if not blacklist_entries:
-                    await interaction.response.send_message(f"✅ 沒有找到包含原因 '{reason}' 的黑名單記錄", ephemeral=True)
-                    session.close()
-                    return
-                
-                embed = discord.Embed(title=f"📋 包含 '{reason}' 的黑名單記錄", color=discord.Color.red())
-                for entry in blacklist_entries[:25]:
-                    embed.add_field(
-                        name=f"用戶 ID: {entry.user_id}",
-                        value=f"原因: {entry.reason or '無'}",
-                        inline=True
-                    )
-                await interaction.response.send_message(embed=embed, ephemeral=True)
-                session.close()
-                return
-        
-        blacklist_entries = session.query(Blacklist).limit(50).all()
-        session.close()
-        
-        if not blacklist_entries:
-            await interaction.response.send_message("✅ 全域黑名單目前是空的", ephemeral=True)
-            return
-        
-        embed = discord.Embed(title="📋 全域黑名單", description=f"共 {len(blacklist_entries)} 筆記錄（顯示前 50 筆）", color=discord.Color.red())
-        for entry in blacklist_entries[:25]:
-            embed.add_field(
-                name=f"用戶 ID: {entry.user_id}",
-                value=f"原因: {entry.reason or '無'}",
-                inline=True
-            )
-        await interaction.response.send_message(embed=embed, ephemeral=True)
+        filters = [reason_filter(Blacklist, reason)] if reason else []
+        title = f"📋 包含 '{reason}' 的黑名單記錄" if reason else "📋 全域黑名單"
+        empty_message = f"✅ 沒有找到包含原因 '{reason}' 的黑名單記錄" if reason else "✅ 全域黑名單目前是空的"
+        await send_paginated_listing(
+            interaction, Blacklist, filters,
+            member_list_renderer(title, discord.Color.red()),
+            empty_message
+        )
         
     except Exception as e:
         await interaction.response.send_message(f"❌ 查詢失敗：{str(e)}", ephemeral=True)
@@ -3830,11 +5466,10 @@ async def setup_booth(interaction: Interaction, category: discord.CategoryChanne
             overwrites={interaction.guild.default_role: discord.PermissionOverwrite(connect=True)}
         )
         
-        booths[category_id] = {
+        booths.set(category_id, {
             'entry_channel': str(entry_channel.id),
             'category': category_id
-        }
-        save_booths(booths)
+        })
         
         embed = discord.Embed(title="✅ 包廂系統已設置", color=discord.Color.green())
         embed.add_field(name="類別", value=category.name, inline=False)
@@ -3868,9 +5503,12 @@ async def booth_status(interaction: Interaction):
         category = interaction.guild.get_channel(int(data['category']))
         entry = interaction.guild.get_channel(int(data['entry_channel']))
         if category and entry:
-            booth_count = len([ch for ch in category.voice_channels if ch.name.startswith('🗣️包廂-')])
+            booth_count = len([ch for ch in category.voice_channels if ch.name.startswith('🗣️包廂-') and ch.name != BOOTH_POOL_CHANNEL_NAME])
             active_booths += booth_count
-            status_list.append(f"**{category.name}**\n└ 入口：{entry.mention}\n└ 活躍包廂：{booth_count} 個")
+            status = f"**{category.name}**\n└ 入口：{entry.mention}\n└ 活躍包廂：{booth_count} 個"
+            if data.get('pool_size'):
+                status += f"\n└ 待命包廂：{booth_pool.idle_count(cat_id)}/{data['pool_size']} 個"
+            status_list.append(status)
     
     embed.description = "\n\n".join(status_list) if status_list else "無活躍包廂"
     embed.add_field(name="總計", value=f"共 {len(booths)} 個包廂系統，{active_booths} 個活躍包廂", inline=False)
@@ -3906,16 +5544,19 @@ async def remove_booth(interaction: Interaction, category: discord.CategoryChann
         if entry_channel:
             await entry_channel.delete()
         
-        # 刪除所有包廂頻道
+        # 刪除所有包廂頻道（包含改過名稱的包廂），一併移除包廂記錄與待回收項目
         deleted_count = 0
         for channel in list(category.voice_channels):
-            if channel.name.startswith('🗣️包廂-'):
+            channel_id_str = str(channel.id)
+            if channel_id_str in booth_channels or channel.name.startswith('🗣️包廂-'):
                 await channel.delete()
+                booth_channels.pop(channel_id_str)
+                booth_reaper.forget(channel)
                 deleted_count += 1
         
-        # 從資料中移除
-        del booths[category_id]
-        save_booths(booths)
+        # 從資料中移除（待命包廂已隨上方一併刪除）
+        booth_pool.discard_category(category_id)
+        booths.pop(category_id)
         
         embed = discord.Embed(title="✅ 包廂系統已移除", color=discord.Color.green())
         embed.add_field(name="類別", value=category.name, inline=False)
@@ -3928,6 +5569,44 @@ async def remove_booth(interaction: Interaction, category: discord.CategoryChann
     except Exception as e:
         await interaction.followup.send(f"❌ 移除失敗：{str(e)}", ephemeral=True)
 
+@bot.tree.command(name="包廂預熱", description="設定預先建立的待命包廂數量，加快包廂建立速度（需要管理員）")
+@app_commands.describe(category="包廂類別", size=f"待命包廂數量（0 為關閉，最多 {BOOTH_POOL_MAX} 個）")
+async def booth_prewarm(interaction: Interaction, category: discord.CategoryChannel, size: int):
+    """設定包廂預熱池"""
+    if not interaction.guild:
+        await interaction.response.send_message("❌ 此指令只能在伺服器中使用", ephemeral=True)
+        return
+    
+    if not interaction.user.guild_permissions.manage_channels:
+        await interaction.response.send_message("❌ 您需要管理頻道權限才能使用此指令", ephemeral=True)
+        return
+    
+    category_id = str(category.id)
+    if category_id not in booths:
+        await interaction.response.send_message("❌ 此類別沒有設置包廂系統!", ephemeral=True)
+        return
+    
+    if size < 0 or size > BOOTH_POOL_MAX:
+        await interaction.response.send_message(f"❌ 待命包廂數量必須在 0 到 {BOOTH_POOL_MAX} 之間", ephemeral=True)
+        return
+    
+    try:
+        await interaction.response.defer()
+        booths.update(category_id, pool_size=size)
+        await booth_pool.shrink(category_id, size)
+        booth_pool.request_refill(category_id)
+        
+        embed = discord.Embed(title="✅ 包廂預熱池已更新", color=discord.Color.green())
+        embed.add_field(name="類別", value=category.name, inline=False)
+        embed.add_field(name="待命包廂", value=f"{size} 個" if size else "已關閉", inline=False)
+        embed.set_footer(text=f"執行者：{interaction.user.name}")
+        
+        await interaction.followup.send(embed=embed)
+        print(f"✅ 已將類別 {category.name} 的包廂預熱池設為 {size} 個")
+        
+    except Exception as e:
+        await interaction.followup.send(f"❌ 設定失敗：{str(e)}", ephemeral=True)
+
 # Whitelist Commands
 @bot.tree.command(name="加入白名單", description="將用戶添加到伺服器白名單（需要管理員）")
 @app_commands.describe(user="要添加的用戶", reason="原因")
@@ -3943,18 +5622,18 @@ async def add_whitelist(interaction: Interaction, user: discord.User, reason: st
         return
     
     try:
-        session = SessionLocal()
-        existing = session.query(Whitelist).filter_by(guild_id=interaction.guild.id, user_id=user.id).first()
-        if existing:
+        def _add_whitelist(session):
+            existing = session.query(Whitelist).filter_by(guild_id=interaction.guild.id, user_id=user.id).first()
+            if existing:
+                return False
+            session.add(Whitelist(guild_id=interaction.guild.id, user_id=user.id, reason=reason))
+            session.commit()
+            return True
+        
+        if not await run_db(_add_whitelist):
             await interaction.response.send_message(f"❌ {user.mention} 已在白名單中", ephemeral=True)
-            session.close()
             return
         
-        whitelist_entry = Whitelist(guild_id=interaction.guild.id, user_id=user.id, reason=reason)
-        session.add(whitelist_entry)
-        session.commit()
-        session.close()
-        
         embed = discord.Embed(title="✅ 用戶已添加到白名單", color=discord.Color.green())
         embed.add_field(name="用戶", value=user.mention, inline=False)
         embed.add_field(name="原因", value=reason, inline=False)
@@ -3976,17 +5655,18 @@ async def remove_whitelist(interaction: Interaction, user: discord.User):
         return
     
     try:
-        session = SessionLocal()
-        entry = session.query(Whitelist).filter_by(guild_id=interaction.guild.id, user_id=user.id).first()
-        if not entry:
+        def _remove_whitelist(session):
+            entry = session.query(Whitelist).filter_by(guild_id=interaction.guild.id, user_id=user.id).first()
+            if not entry:
+                return False
+            session.delete(entry)
+            session.commit()
+            return True
+        
+        if not await run_db(_remove_whitelist):
             await interaction.response.send_message(f"❌ {user.mention} 不在白名單中", ephemeral=True)
-            session.close()
             return
         
-        session.delete(entry)
-        session.commit()
-        session.close()
-        
         embed = discord.Embed(title="✅ 已從白名單移除用戶", color=discord.Color.green())
         embed.add_field(name="用戶", value=user.mention, inline=False)
         await interaction.response.send_message(embed=embed, ephemeral=True)
@@ -4006,9 +5686,7 @@ async def view_whitelist(interaction: Interaction):
         return
     
     try:
-        session = SessionLocal()
-        whitelist_entries = session.query(Whitelist).filter_by(guild_id=interaction.guild.id).all()
-        session.close()
+        whitelist_entries = await run_db(lambda session: session.query(Whitelist).filter_by(guild_id=interaction.guild.id).all())
         
         if not whitelist_entries:
             await interaction.response.send_message("✅ 白名單為空", ephemeral=True)
@@ -4016,11 +5694,12 @@ async def view_whitelist(interaction: Interaction):
         
         embed = discord.Embed(title=f"✅ 白名單 ({len(whitelist_entries)} 個用戶)", color=discord.Color.green())
         
+        users = await resolve_users(entry.user_id for entry in whitelist_entries)
         for entry in whitelist_entries:
-            try:
-                u = await bot.fetch_user(entry.user_id)
+            u = users.get(entry.user_id)
+            if u:
                 embed.add_field(name=f"👤 {u}", value=f"原因: {entry.reason}\n時間: {entry.added_at.strftime('%Y-%m-%d %H:%M:%S')}", inline=False)
-            except:
+            else:
                 embed.add_field(name=f"👤 ID: {entry.user_id}", value=f"原因: {entry.reason}\n時間: {entry.added_at.strftime('%Y-%m-%d %H:%M:%S')}", inline=False)
         
         await interaction.response.send_message(embed=embed, ephemeral=True)
@@ -4035,34 +5714,33 @@ async def add_global_whitelist(interaction: Interaction, user: discord.User, rea
         return
     
     try:
-        session = SessionLocal()
+        guild_ids = [guild.id for guild in bot.guilds]
+        
+        def _add_global_whitelist(session):
+            # 檢查用戶是否已在全域白名單中
+            existing = session.query(Whitelist).filter_by(user_id=user.id).first()
+            if existing:
+                return None
+            
+            # 在所有伺服器中添加白名單
+            added_count = 0
+            for guild_id in guild_ids:
+                try:
+                    _get_or_create_guild(session, guild_id)
+                    session.add(Whitelist(guild_id=guild_id, user_id=user.id, reason=reason))
+                    added_count += 1
+                except:
+                    pass
+            
+            session.commit()
+            return added_count
         
-        # 檢查用戶是否已在全域白名單中
-        existing = session.query(Whitelist).filter_by(user_id=user.id).first()
-        if existing:
+        added_count = await run_db(_add_global_whitelist)
+        guild_config_cache.invalidate()  # 可能建立了新的 Guild 記錄
+        if added_count is None:
             await interaction.response.send_message(f"❌ {user.mention} 已在全域白名單中", ephemeral=True)
-            session.close()
             return
         
-        # 在所有伺服器中添加白名單
-        added_count = 0
-        for guild in bot.guilds:
-            try:
-                guild_obj = session.query(Guild).filter_by(guild_id=guild.id).first()
-                if not guild_obj:
-                    guild_obj = Guild(guild_id=guild.id)
-                    session.add(guild_obj)
-                    session.commit()
-                
-                whitelist_entry = Whitelist(guild_id=guild.id, user_id=user.id, reason=reason)
-                session.add(whitelist_entry)
-                added_count += 1
-            except:
-                pass
-        
-        session.commit()
-        session.close()
-        
         embed = discord.Embed(title="✅ 用戶已添加到全域白名單", color=discord.Color.green())
         embed.add_field(name="用戶", value=user.mention, inline=False)
         embed.add_field(name="原因", value=reason, inline=False)
@@ -4080,17 +5758,14 @@ async def query_global_whitelist(interaction: Interaction, user: discord.User =
         return
     
     try:
-        session = SessionLocal()
-        
         # 如果指定了用戶或原因，進行過濾查詢
         if user or reason:
             if user:
                 # 查詢特定用戶的白名單記錄
-                whitelist_entries = session.query(Whitelist).filter_by(user_id=user.id).all()
+                whitelist_entries = await run_db(lambda session: session.query(Whitelist).filter_by(user_id=user.id).all())
                 
                 if not whitelist_entries:
                     await interaction.response.send_message(f"✅ 用戶 {user.mention} 不在任何白名單中", ephemeral=True)
-                    session.close()
                     return
                 
                 # 按伺服器分組
@@ -4111,118 +5786,17 @@ async def query_global_whitelist(interaction: Interaction, user: discord.User =
                     )
                 
                 await interaction.response.send_message(embed=embed, ephemeral=True)
-                session.close()
-                return
-            
-            elif reason:
-                # 查詢特定原因的白名單記錄
-                whitelist_entries = session.query(Whitelist).filter(
-                    Whitelist.reason.ilike(f"%{reason}%")
-                ).all()
-                
-                if not whitelist_entries:
-                    await interaction.response.send_message(f"✅ 沒有找到原因包含 '{reason}' 的白名單記錄", ephemeral=True)
-                    session.close()
-                    return
-                
-                # 按伺服器分組
-                whitelist_by_guild = {}
-                for entry in whitelist_entries:
-                    if entry.guild_id not in whitelist_by_guild:
-                        whitelist_by_guild[entry.guild_id] = []
-                    whitelist_by_guild[entry.guild_id].append(entry)
-                
-                embeds = []
-                for guild_id, entries in whitelist_by_guild.items():
-                    guild = bot.get_guild(guild_id)
-                    guild_name = guild.name if guild else f"未知伺服器 ({guild_id})"
-                    
-                    embed = discord.Embed(
-                        title=f"✅ {guild_name} 的白名單 (原因: {reason})",
-                        description=f"共 {len(entries)} 個用戶",
-                        color=discord.Color.green()
-                    )
-                    
-                    for entry in entries:
-                        try:
-                            u = await bot.fetch_user(entry.user_id)
-                            user_info = f"👤 {u} (ID: {entry.user_id})"
-                        except:
-                            user_info = f"👤 ID: {entry.user_id}"
-                        
-                        embed.add_field(
-                            name=user_info,
-                            value=f"時間: {entry.added_at.strftime('%Y-%m-%d %H:%M:%S')}",
-                            inline=False
-                        )
-                    
-                    embeds.append(embed)
-                
-                await interaction.response.send_message(embeds=embeds[:10] if len(embeds, ephemeral=True) > 10 else embeds)
-                
-                if len(embeds) > 10:
-                    for i in range(10, len(embeds), 10):
-                        await interaction.followup.send(embeds=embeds[i:i+10])
-                
-                session.close()
                 return
-        
-        # 查詢所有白名單
-        all_whitelist_entries = session.query(Whitelist).all()
-        session.close()
-        
-        if not all_whitelist_entries:
-            await interaction.response.send_message("✅ 全域白名單為空", ephemeral=True)
-            return
-        
-        # 按伺服器分組
-        whitelist_by_guild = {}
-        for entry in all_whitelist_entries:
-            if entry.guild_id not in whitelist_by_guild:
-                whitelist_by_guild[entry.guild_id] = []
-            whitelist_by_guild[entry.guild_id].append(entry)
-        
-        embeds = []
-        for guild_id, entries in whitelist_by_guild.items():
-            guild = bot.get_guild(guild_id)
-            guild_name = guild.name if guild else f"未知伺服器 ({guild_id})"
-            
-            embed = discord.Embed(
-                title=f"✅ {guild_name} 的白名單",
-                description=f"共 {len(entries)} 個用戶",
-                color=discord.Color.green()
-            )
-            
-            for entry in entries:
-                try:
-                    u = await bot.fetch_user(entry.user_id)
-                    user_info = f"👤 {u} (ID: {entry.user_id})"
-                except:
-                    user_info = f"👤 ID: {entry.user_id}"
-                
-                embed.add_field(
-                    name=user_info,
-                    value=f"原因: {entry.reason}\n時間: {entry.added_at.strftime('%Y-%m-%d %H:%M:%S')}",
-                    inline=False
-                )
             
-            embeds.append(embed)
-        
-        # 添加總結 embed
-        summary_embed = discord.Embed(
-            title="🌍 全域白名單總結",
-            color=discord.Color.green()
+        # 依原因過濾（未指定則列出全部），分頁顯示
+        filters = [reason_filter(Whitelist, reason)] if reason else []
+        title = f"✅ 全域白名單 (原因: {reason})" if reason else "🌍 全域白名單"
+        empty_message = f"✅ 沒有找到原因包含 '{reason}' 的白名單記錄" if reason else "✅ 全域白名單為空"
+        await send_paginated_listing(
+            interaction, Whitelist, filters,
+            member_list_renderer(title, discord.Color.green()),
+            empty_message
         )
-        summary_embed.add_field(name="涉及伺服器", value=f"{len(whitelist_by_guild)} 個", inline=False)
-        summary_embed.add_field(name="白名單用戶總數", value=f"{len(all_whitelist_entries)} 個", inline=False)
-        
-        embeds.insert(0, summary_embed)
-        
-        await interaction.response.send_message(embeds=embeds[:10] if len(embeds, ephemeral=True) > 10 else embeds)
-        
-        if len(embeds) > 10:
-            for i in range(10, len(embeds), 10):
-                await interaction.followup.send(embeds=embeds[i:i+10])
     
     except Exception as e:
         await interaction.response.send_message(f"❌ 查詢失敗：{str(e)}", ephemeral=True)
@@ -4235,19 +5809,17 @@ async def remove_global_whitelist(interaction: Interaction, user: discord.User):
         return
     
     try:
-        session = SessionLocal()
-        entries = session.query(Whitelist).filter_by(user_id=user.id).all()
+        def _remove_global_whitelist(session):
+            count = session.query(Whitelist).filter_by(user_id=user.id).delete()
+            session.commit()
+            return count
+        
+        count = await run_db(_remove_global_whitelist)
         
-        if not entries:
+        if not count:
             await interaction.response.send_message(f"✅ 用戶 {user.mention} 不在全域白名單中", ephemeral=True)
-            session.close()
             return
         
-        count = len(entries)
-        session.query(Whitelist).filter_by(user_id=user.id).delete()
-        session.commit()
-        session.close()
-        
         embed = discord.Embed(title="✅ 已從全域白名單移除用戶", color=discord.Color.green())
         embed.add_field(name="用戶", value=user.mention, inline=False)
         embed.add_field(name="移除記錄數", value=f"{count} 條", inline=False)
@@ -4264,10 +5836,7 @@ async def set_global_whitelist(interaction: Interaction, action: str = ""):
     
     if action.lower() == "clear":
         try:
-            session = SessionLocal()
-            session.query(Whitelist).delete()
-            session.commit()
-            session.close()
+            await run_db(_delete_all_and_commit, Whitelist)
             
             embed = discord.Embed(title="✅ 全域白名單已清空", color=discord.Color.green())
             await interaction.response.send_message(embed=embed, ephemeral=True)
@@ -4289,17 +5858,14 @@ async def global_whitelist(interaction: Interaction, user: discord.User = None,
         return
     
     try:
-        session = SessionLocal()
-        
         # 如果指定了用戶或原因，進行過濾查詢
         if user or reason:
             if user:
                 # 查詢特定用戶的白名單記錄
-                whitelist_entries = session.query(Whitelist).filter_by(user_id=user.id).all()
+                whitelist_entries = await run_db(lambda session: session.query(Whitelist).filter_by(user_id=user.id).all())
                 
                 if not whitelist_entries:
                     await interaction.response.send_message(f"✅ 用戶 {user.mention} 不在任何白名單中", ephemeral=True)
-                    session.close()
                     return
                 
                 # 按伺服器分組
@@ -4320,118 +5886,17 @@ async def global_whitelist(interaction: Interaction, user: discord.User = None,
                     )
                 
                 await interaction.response.send_message(embed=embed, ephemeral=True)
-                session.close()
-                return
-            
-            elif reason:
-                # 查詢特定原因的白名單記錄
-                whitelist_entries = session.query(Whitelist).filter(
-                    Whitelist.reason.ilike(f"%{reason}%")
-                ).all()
-                
-                if not whitelist_entries:
-                    await interaction.response.send_message(f"✅ 沒有找到原因包含 '{reason}' 的白名單記錄", ephemeral=True)
-                    session.close()
-                    return
-                
-                # 按伺服器分組
-                whitelist_by_guild = {}
-                for entry in whitelist_entries:
-                    if entry.guild_id not in whitelist_by_guild:
-                        whitelist_by_guild[entry.guild_id] = []
-                    whitelist_by_guild[entry.guild_id].append(entry)
-                
-                embeds = []
-                for guild_id, entries in whitelist_by_guild.items():
-                    guild = bot.get_guild(guild_id)
-                    guild_name = guild.name if guild else f"未知伺服器 ({guild_id})"
-                    
-                    embed = discord.Embed(
-                        title=f"✅ {guild_name} 的白名單 (原因: {reason})",
-                        description=f"共 {len(entries)} 個用戶",
-                        color=discord.Color.green()
-                    )
-                    
-                    for entry in entries:
-                        try:
-                            u = await bot.fetch_user(entry.user_id)
-                            user_info = f"👤 {u} (ID: {entry.user_id})"
-                        except:
-                            user_info = f"👤 ID: {entry.user_id}"
-                        
-                        embed.add_field(
-                            name=user_info,
-                            value=f"時間: {entry.added_at.strftime('%Y-%m-%d %H:%M:%S')}",
-                            inline=False
-                        )
-                    
-                    embeds.append(embed)
-                
-                await interaction.response.send_message(embeds=embeds[:10] if len(embeds, ephemeral=True) > 10 else embeds)
-                
-                if len(embeds) > 10:
-                    for i in range(10, len(embeds), 10):
-                        await interaction.followup.send(embeds=embeds[i:i+10])
-                
-                session.close()
                 return
-        
-        # 查詢所有白名單
-        all_whitelist_entries = session.query(Whitelist).all()
-        session.close()
-        
-        if not all_whitelist_entries:
-            await interaction.response.send_message("✅ 全域白名單為空", ephemeral=True)
-            return
-        
-        # 按伺服器分組
-        whitelist_by_guild = {}
-        for entry in all_whitelist_entries:
-            if entry.guild_id not in whitelist_by_guild:
-                whitelist_by_guild[entry.guild_id] = []
-            whitelist_by_guild[entry.guild_id].append(entry)
-        
-        embeds = []
-        for guild_id, entries in whitelist_by_guild.items():
-            guild = bot.get_guild(guild_id)
-            guild_name = guild.name if guild else f"未知伺服器 ({guild_id})"
-            
-            embed = discord.Embed(
-                title=f"✅ {guild_name} 的白名單",
-                description=f"共 {len(entries)} 個用戶",
-                color=discord.Color.green()
-            )
-            
-            for entry in entries:
-                try:
-                    u = await bot.fetch_user(entry.user_id)
-                    user_info = f"👤 {u} (ID: {entry.user_id})"
-                except:
-                    user_info = f"👤 ID: {entry.user_id}"
-                
-                embed.add_field(
-                    name=user_info,
-                    value=f"原因: {entry.reason}\n時間: {entry.added_at.strftime('%Y-%m-%d %H:%M:%S')}",
-                    inline=False
-                )
             
-            embeds.append(embed)
-        
-        # 添加總結 embed
-        summary_embed = discord.Embed(
-            title="🌍 全域白名單總結",
-            color=discord.Color.green()
+        # 依原因過濾（未指定則列出全部），分頁顯示
+        filters = [reason_filter(Whitelist, reason)] if reason else []
+        title = f"✅ 全域白名單 (原因: {reason})" if reason else "🌍 全域白名單"
+        empty_message = f"✅ 沒有找到原因包含 '{reason}' 的白名單記錄" if reason else "✅ 全域白名單為空"
+        await send_paginated_listing(
+            interaction, Whitelist, filters,
+            member_list_renderer(title, discord.Color.green()),
+            empty_message
         )
-        summary_embed.add_field(name="涉及伺服器", value=f"{len(whitelist_by_guild)} 個", inline=False)
-        summary_embed.add_field(name="白名單用戶總數", value=f"{len(all_whitelist_entries)} 個", inline=False)
-        
-        embeds.insert(0, summary_embed)
-        
-        await interaction.response.send_message(embeds=embeds[:10] if len(embeds, ephemeral=True) > 10 else embeds)
-        
-        if len(embeds) > 10:
-            for i in range(10, len(embeds), 10):
-                await interaction.followup.send(embeds=embeds[i:i+10])
     
     except Exception as e:
         await interaction.response.send_message(f"❌ 查詢全域白名單失敗：{str(e)}", ephemeral=True)
@@ -4450,21 +5915,22 @@ async def warn_user(interaction: Interaction, user: discord.User, reason: str =
         return
     
     try:
-        session = SessionLocal()
-        warning = Warning(
-            guild_id=interaction.guild.id,
-            user_id=user.id,
-            warned_by=interaction.user.id,
-            reason=reason
-        )
-        session.add(warning)
-        session.commit()
+        def _add_warning(session):
+            warning = Warning(
+                guild_id=interaction.guild.id,
+                user_id=user.id,
+                warned_by=interaction.user.id,
+                reason=reason
+            )
+            session.add(warning)
+            session.commit()
+            
+            return session.query(Warning).filter(
+                Warning.guild_id == interaction.guild.id,
+                Warning.user_id == user.id
+            ).count()
         
-        warning_count = session.query(Warning).filter(
-            Warning.guild_id == interaction.guild.id,
-            Warning.user_id == user.id
-        ).count()
-        session.close()
+        warning_count = await run_db(_add_warning)
         
         embed = discord.Embed(title="⚠️ 用戶已被警告", color=discord.Color.orange())
         embed.add_field(name="被警告用戶", value=user.mention, inline=False)
@@ -4501,41 +5967,38 @@ async def remove_warning(interaction: Interaction, user: discord.User, warning_i
         return
     
     try:
-        session = SessionLocal()
-        
-        if warning_id:
-            warning = session.query(Warning).filter(
-                Warning.id == warning_id,
-                Warning.guild_id == interaction.guild.id,
-                Warning.user_id == user.id
-            ).first()
+        def _remove_warning(session):
+            if warning_id:
+                warning = session.query(Warning).filter(
+                    Warning.id == warning_id,
+                    Warning.guild_id == interaction.guild.id,
+                    Warning.user_id == user.id
+                ).first()
+            else:
+                warning = session.query(Warning).filter(
+                    Warning.guild_id == interaction.guild.id,
+                    Warning.user_id == user.id
+                ).order_by(Warning.warned_at.desc()).first()
             
             if not warning:
-                await interaction.response.send_message("❌ 找不到該警告記錄", ephemeral=True)
-                session.close()
-                return
+                return None
             
             session.delete(warning)
             session.commit()
-        else:
-            warning = session.query(Warning).filter(
+            
+            return session.query(Warning).filter(
                 Warning.guild_id == interaction.guild.id,
                 Warning.user_id == user.id
-            ).order_by(Warning.warned_at.desc()).first()
-            
-            if not warning:
-                await interaction.response.send_message("❌ 該用戶沒有警告記錄", ephemeral=True)
-                session.close()
-                return
-            
-            session.delete(warning)
-            session.commit()
+            ).count()
         
-        remaining_count = session.query(Warning).filter(
-            Warning.guild_id == interaction.guild.id,
-            Warning.user_id == user.id
-        ).count()
-        session.close()
+        remaining_count = await run_db(_remove_warning)
+        
+        if remaining_count is None:
+            if warning_id:
+                await interaction.response.send_message("❌ 找不到該警告記錄", ephemeral=True)
+            else:
+                await interaction.response.send_message("❌ 該用戶沒有警告記錄", ephemeral=True)
+            return
         
         embed = discord.Embed(title="✅ 警告已移除", color=discord.Color.green())
         embed.add_field(name="用戶", value=user.mention, inline=False)
@@ -4551,39 +6014,32 @@ async def remove_warning(interaction: Interaction, user: discord.User, warning_i
 @app_commands.describe(user="要查詢的用戶")
 async def check_warnings(interaction: Interaction, user: discord.User):
     try:
-        session = SessionLocal()
-        warnings = session.query(Warning).filter(
-            Warning.guild_id == interaction.guild.id,
-            Warning.user_id == user.id
-        ).order_by(Warning.warned_at.desc()).all()
-        session.close()
-        
-        if not warnings:
-            embed = discord.Embed(title="✅ 無警告記錄", color=discord.Color.green())
-            embed.description = f"{user.mention} 在此伺服器沒有警告記錄"
-            await interaction.response.send_message(embed=embed, ephemeral=True)
-            return
-        
-        embed = discord.Embed(
-            title=f"⚠️ {user.name} 的警告記錄",
-            description=f"共 {len(warnings)} 次警告",
-            color=discord.Color.orange()
-        )
-        
-        for i, warning in enumerate(warnings, 1):
-            try:
-                warner = await bot.fetch_user(warning.warned_by)
-                warner_name = str(warner)
-            except:
-                warner_name = f"ID: {warning.warned_by}"
-            
-            embed.add_field(
-                name=f"警告 #{i} (ID: {warning.id})",
-                value=f"原因: {warning.reason}\n警告者: {warner_name}\n時間: {warning.warned_at.strftime('%Y-%m-%d %H:%M:%S')}",
-                inline=False
+        async def render(warnings, page, total):
+            embed = discord.Embed(
+                title=f"⚠️ {user.name} 的警告記錄",
+                description=f"共 {total} 次警告",
+                color=discord.Color.orange()
             )
-        
-        await interaction.response.send_message(embed=embed, ephemeral=True)
+            
+            users = await resolve_users(warning.warned_by for warning in warnings)
+            for i, warning in enumerate(warnings, (page - 1) * LISTING_PAGE_SIZE + 1):
+                warner = users.get(warning.warned_by)
+                warner_name = str(warner) if warner else f"ID: {warning.warned_by}"
+                
+                embed.add_field(
+                    name=f"警告 #{i} (ID: {warning.id})",
+                    value=f"原因: {warning.reason}\n警告者: {warner_name}\n時間: {warning.warned_at.strftime('%Y-%m-%d %H:%M:%S')}",
+                    inline=False
+                )
+            return listing_page_footer(embed, page, total)
+        
+        empty_embed = discord.Embed(title="✅ 無警告記錄", color=discord.Color.green())
+        empty_embed.description = f"{user.mention} 在此伺服器沒有警告記錄"
+        await send_paginated_listing(
+            interaction, Warning,
+            [Warning.guild_id == interaction.guild.id, Warning.user_id == user.id],
+            render, empty_embed, descending=True
+        )
     
     except Exception as e:
         await interaction.response.send_message(f"❌ 查詢失敗：{str(e)}", ephemeral=True)
@@ -4653,7 +6109,7 @@ async def shutdown_bot(interaction: Interaction):
 async def scheduled_shutdown(interaction: Interaction, time: str):
     global scheduled_shutdown_task
     
-    if not can_use_dangerous_commands(interaction.user.id):
+    if not await can_use_dangerous_commands(interaction.user.id):
         await interaction.response.send_message("❌ 您沒有權限使用此危險指令", ephemeral=True)
         return
     
@@ -4894,9 +6350,7 @@ async def settings_cmd(interaction: Interaction):
         await interaction.response.send_message("❌ 此指令只能在伺服器中使用", ephemeral=True)
         return
     
-    session = SessionLocal()
-    guild = session.query(Guild).filter_by(guild_id=interaction.guild.id).first()
-    session.close()
+    guild = await guild_config_cache.get(interaction.guild.id)
     
     if not guild:
         await interaction.response.send_message("❌ 此伺服器尚未設定", ephemeral=True)
@@ -4954,7 +6408,7 @@ async def on_guild_join(guild):
     
     # 【其次】嘗試創建伺服器資料庫記錄 - 如果失敗不影響通知已發送的事實
     try:
-        get_or_create_guild(guild.id)
+        await guild_config_cache.get(guild.id, create=True)
         print(f"✅ 已創建伺服器資料庫記錄: {guild.name}")
     except Exception as e:
         print(f"⚠️ 無法創建伺服器資料庫記錄: {str(e)}")
@@ -4962,6 +6416,7 @@ async def on_guild_join(guild):
 @bot.event
 async def on_guild_remove(guild):
     print(f"❌ 已被踢出伺服器: {guild.name} ({guild.id})")
+    admin_recipient_index.invalidate(guild.id)
     
     # 發送被踢出通知到指定頻道
     try:
@@ -5022,9 +6477,8 @@ async def checkin(interaction: Interaction):
         return
     
     today = datetime.now().strftime("%Y-%m-%d")
-    session = SessionLocal()
     
-    try:
+    def _checkin(session):
         existing_checkin = session.query(DailyCheckin).filter_by(
             guild_id=interaction.guild_id,
             user_id=interaction.user.id,
@@ -5032,12 +6486,7 @@ async def checkin(interaction: Interaction):
         ).first()
         
         if existing_checkin:
-            await interaction.response.send_message(
-                "✅ 你今天已經簽到過了！\n\n💪 明天再來簽到吧！",
-                ephemeral=False
-            )
-            session.close()
-            return
+            return None
         
         # 新增簽到記錄
         checkin = DailyCheckin(
@@ -5046,23 +6495,38 @@ async def checkin(interaction: Interaction):
             checkin_date=today
         )
         session.add(checkin)
-        session.commit()
+        try:
+            session.commit()
+        except IntegrityError:
+            # 同時送出的重複簽到被唯一鍵擋下
+            session.rollback()
+            return None
         
-        # 查詢連續簽到天數
-        all_checkins = session.query(DailyCheckin).filter_by(
+        # 查詢連續簽到天數（由唯一索引依日期倒序讀取）
+        sorted_checkins = session.query(DailyCheckin.checkin_date).filter_by(
             guild_id=interaction.guild_id,
             user_id=interaction.user.id
-        ).all()
+        ).order_by(DailyCheckin.checkin_date.desc()).all()
         
         streak = 1
-        if all_checkins:
-            sorted_checkins = sorted(all_checkins, key=lambda x: x.checkin_date, reverse=True)
+        if sorted_checkins:
             for i, c in enumerate(sorted_checkins[1:]):
                 target_date = datetime.strptime(sorted_checkins[i].checkin_date, "%Y-%m-%d") - timedelta(days=1)
                 if c.checkin_date == target_date.strftime("%Y-%m-%d"):
                     streak += 1
                 else:
                     break
+        return streak
+    
+    try:
+        streak = await run_db(_checkin)
+        
+        if streak is None:
+            await interaction.response.send_message(
+                "✅ 你今天已經簽到過了！\n\n💪 明天再來簽到吧！",
+                ephemeral=False
+            )
+            return
         
         embed = discord.Embed(title="✅ 簽到成功", color=discord.Color.green())
         embed.description = f"歡迎回來，{interaction.user.mention}！"
@@ -5073,8 +6537,8 @@ async def checkin(interaction: Interaction):
         
         await interaction.response.send_message(embed=embed, ephemeral=False)
     
-    finally:
-        session.close()
+    except Exception as e:
+        await interaction.response.send_message(f"❌ 簽到失敗：{str(e)}", ephemeral=True)
 
 @bot.tree.command(name="數數字", description="數字猜謎遊戲")
 async def number_game(interaction: Interaction):
@@ -5153,7 +6617,7 @@ async def number_game(interaction: Interaction):
 @bot.tree.command(name="離開伺服器", description="讓機器人離開指定伺服器（只有主人可用）")
 @app_commands.describe(guild_id="伺服器 ID")
 async def leave_guild(interaction: Interaction, guild_id: str):
-    if not can_use_dangerous_commands(interaction.user.id):
+    if not await can_use_dangerous_commands(interaction.user.id):
         await interaction.response.send_message("❌ 您沒有權限使用此危險指令", ephemeral=True)
         return
     
@@ -5203,28 +6667,29 @@ async def set_user_level(interaction: Interaction, user: discord.User, level: in
         return
     
     try:
-        session = SessionLocal()
-        user_level = session.query(UserLevel).filter_by(
-            guild_id=interaction.guild.id,
-            user_id=user.id
-        ).first()
-        
-        if not user_level:
-            user_level = UserLevel(
+        def _set_level(session):
+            user_level = session.query(UserLevel).filter_by(
                 guild_id=interaction.guild.id,
-                user_id=user.id,
-                level=level,
-                experience=experience,
-                total_experience=experience
-            )
-            session.add(user_level)
-        else:
-            user_level.level = level
-            user_level.experience = experience
-            user_level.total_experience = experience
+                user_id=user.id
+            ).first()
+            
+            if not user_level:
+                user_level = UserLevel(
+                    guild_id=interaction.guild.id,
+                    user_id=user.id,
+                    level=level,
+                    experience=experience,
+                    total_experience=experience
+                )
+                session.add(user_level)
+            else:
+                user_level.level = level
+                user_level.experience = experience
+                user_level.total_experience = experience
+            
+            session.commit()
         
-        session.commit()
-        session.close()
+        await run_db(_set_level)
         
         embed = discord.Embed(title="✅ 等級已設定", color=discord.Color.green())
         embed.description = f"用戶 {user.mention} 的等級已更新"
@@ -5239,6 +6704,161 @@ async def set_user_level(interaction: Interaction, user: discord.User, level: in
     except Exception as e:
         await interaction.response.send_message(f"❌ 設定失敗：{str(e)}", ephemeral=True)
 
+# ====== 廣播背景任務 ======
+# 廣播 / 版主通知改為背景任務：一次預先載入所有伺服器的公告設定，按伺服器 ID 排序分批並行發送，
+# 每批完成後把進度寫回 broadcast_jobs，機器人重啟後從上次的進度繼續
+BROADCAST_CONCURRENCY = 10  # 每批同時發送的伺服器數
+BROADCAST_KINDS = {'announcement': "📢 廣播", 'owner_notice': "📨 版主通知"}
+
+def _create_broadcast_job(session, kind, payload, requested_by, total):
+    job = BroadcastJob(kind=kind, payload=json.dumps(payload, ensure_ascii=False),
+                       requested_by=requested_by, total=total, status='running')
+    session.add(job)
+    session.commit()
+    return job.id
+
+def _load_running_broadcast_jobs(session):
+    return session.query(BroadcastJob).filter_by(status='running').order_by(BroadcastJob.id).all()
+
+def _load_announcement_targets(session):
+    """一次載入所有伺服器的公告頻道與接收設定：guild_id -> (announcement_channel, receive_announcements)"""
+    rows = session.query(Guild.guild_id, Guild.announcement_channel, Guild.receive_announcements).all()
+    return {guild_id: (channel_id, receive) for guild_id, channel_id, receive in rows}
+
+def _save_broadcast_progress(session, job_id, progress, status=None):
+    job = session.query(BroadcastJob).filter_by(id=job_id).first()
+    if not job:
+        return
+    job.last_guild_id = progress['last_guild_id']
+    job.sent = progress['sent']
+    job.failed = progress['failed']
+    job.skipped = progress['skipped']
+    job.updated_at = datetime.utcnow()
+    if status:
+        job.status = status
+    session.commit()
+
+def _load_recent_broadcast_jobs(session, limit=5):
+    return session.query(BroadcastJob).order_by(BroadcastJob.id.desc()).limit(limit).all()
+
+class BroadcastJobRunner:
+    """執行中的廣播任務：job_id -> 進度（存在記憶體中供狀態指令即時查詢）"""
+    
+    def __init__(self):
+        self.progress = {}
+        self._tasks = {}
+    
+    async def start(self, kind, payload, requested_by, on_complete=None):
+        """建立任務記錄並在背景開始發送，回傳 job_id"""
+        job_id = await run_db(_create_broadcast_job, kind, payload, requested_by, len(bot.guilds))
+        self._launch(job_id, kind, payload, 0, {'sent': 0, 'failed': 0, 'skipped': 0}, on_complete)
+        return job_id
+    
+    async def resume_all(self):
+        """重啟後繼續未完成的任務"""
+        for job in await run_db(_load_running_broadcast_jobs):
+            counts = {'sent': job.sent or 0, 'failed': job.failed or 0, 'skipped': job.skipped or 0}
+            self._launch(job.id, job.kind, json.loads(job.payload), job.last_guild_id or 0, counts, None)
+            print(f"🔁 繼續廣播任務 #{job.id}（從伺服器 {job.last_guild_id or 0} 之後）")
+    
+    def _launch(self, job_id, kind, payload, last_guild_id, counts, on_complete):
+        if job_id in self._tasks:
+            return
+        self.progress[job_id] = dict(counts, kind=kind, last_guild_id=last_guild_id, total=len(bot.guilds), status='running')
+        self._tasks[job_id] = bot.loop.create_task(self._run(job_id, kind, payload, on_complete))
+    
+    def cancel(self, job_id):
+        task = self._tasks.get(job_id)
+        if not task:
+            return False
+        task.cancel()
+        return True
+    
+    async def _send_announcement(self, guild, payload, targets):
+        channel_id, receive = targets.get(guild.id, (None, True))
+        if receive is False:
+            return 'skipped'
+        target_channel = bot.get_channel(channel_id) if channel_id else None
+        if not target_channel:
+            target_channel = guild.text_channels[0] if guild.text_channels else None
+        if not target_channel or not target_channel.permissions_for(guild.me).send_messages:
+            return 'failed'
+        embed = discord.Embed(color=discord.Color.gold())
+        embed.description = payload['message']
+        if payload.get('image_url'):
+            embed.set_image(url=payload['image_url'])
+        await target_channel.send(embed=embed)
+        return 'sent'
+    
+    async def _send_owner_notice(self, guild, payload, targets):
+        owner = guild.owner
+        if not owner:
+            print(f"⚠️ 無法找到伺服器 {guild.name} ({guild.id}) 的版主")
+            return 'failed'
+        embed = discord.Embed(title=payload['title'], color=discord.Color.blue())
+        embed.description = payload['message']
+        embed.add_field(name="伺服器", value=guild.name, inline=False)
+        embed.add_field(name="伺服器ID", value=f"`{guild.id}`", inline=False)
+        embed.add_field(name="成員數", value=f"{guild.member_count} 人", inline=False)
+        embed.add_field(name="發送時間", value=f"{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}", inline=False)
+        embed.set_footer(text="此訊息來自開發者")
+        await owner.send(embed=embed)
+        return 'sent'
+    
+    async def _deliver(self, send, guild, payload, targets):
+        try:
+            return await send(guild, payload, targets)
+        except Exception as e:
+            print(f"⚠️ 無法發送到 {guild.name}: {str(e)}")
+            return 'failed'
+    
+    async def _run(self, job_id, kind, payload, on_complete):
+        progress = self.progress[job_id]
+        send = self._send_announcement if kind == 'announcement' else self._send_owner_notice
+        status = 'completed'
+        try:
+            targets = await run_db(_load_announcement_targets) if kind == 'announcement' else {}
+            guilds = sorted((g for g in bot.guilds if g.id > progress['last_guild_id']), key=lambda g: g.id)
+            for i in range(0, len(guilds), BROADCAST_CONCURRENCY):
+                batch = guilds[i:i + BROADCAST_CONCURRENCY]
+                results = await asyncio.gather(*(self._deliver(send, guild, payload, targets) for guild in batch))
+                for result in results:
+                    progress[result] += 1
+                progress['last_guild_id'] = batch[-1].id
+                await run_db(_save_broadcast_progress, job_id, progress)
+        except asyncio.CancelledError:
+            status = 'cancelled'
+        except Exception as e:
+            status = 'failed'
+            print(f"❌ 廣播任務 #{job_id} 失敗：{str(e)}")
+        finally:
+            progress['status'] = status
+            self._tasks.pop(job_id, None)
+            try:
+                await run_db(_save_broadcast_progress, job_id, progress, status)
+            except Exception as e:
+                print(f"⚠️ 無法儲存廣播任務 #{job_id} 狀態：{str(e)}")
+        print(f"✅ 廣播任務 #{job_id} 結束（{status}）：成功 {progress['sent']}、失敗 {progress['failed']}、略過 {progress['skipped']}")
+        if on_complete:
+            try:
+                await on_complete(job_id, progress)
+            except Exception as e:
+                print(f"⚠️ 廣播完成通知失敗：{str(e)}")
+
+broadcast_jobs = BroadcastJobRunner()
+
+async def send_broadcast_report(interaction, embed):
+    """回報廣播結果給發起人：互動權杖 15 分鐘後失效，長時間的任務改用私訊"""
+    try:
+        await interaction.followup.send(embed=embed, ephemeral=True)
+        return
+    except Exception as e:
+        print(f"⚠️ 無法回覆廣播結果，改用私訊：{str(e)}")
+    try:
+        await interaction.user.send(embed=embed)
+    except Exception as e:
+        print(f"⚠️ 無法私訊廣播結果給 {interaction.user}：{str(e)}")
+
 # 圖片選項對應表
 BROADCAST_IMAGES = {
     "none": None,
@@ -5261,53 +6881,25 @@ class BroadcastImageSelect(ui.Select):
     
     async def callback(self, interaction: Interaction):
         selected_image = self.values[0]
-        image_url = BROADCAST_IMAGES.get(selected_image)
-        
-        try:
-            await interaction.response.defer(ephemeral=True)
-            
-            # 準備廣播 Embed
-            embed = discord.Embed(color=discord.Color.gold())
-            embed.description = self.message
-            
-            if image_url:
-                embed.set_image(url=image_url)
-            
-            # 向所有伺服器發送廣播
-            sent_count = 0
-            failed_count = 0
-            
-            for guild in bot.guilds:
-                try:
-                    session = SessionLocal()
-                    guild_config = session.query(Guild).filter_by(guild_id=guild.id).first()
-                    session.close()
-                    
-                    target_channel = None
-                    if guild_config and guild_config.announcement_channel:
-                        target_channel = bot.get_channel(guild_config.announcement_channel)
-                    
-                    if not target_channel:
-                        target_channel = guild.text_channels[0] if guild.text_channels else None
-                    
-                    if target_channel and target_channel.permissions_for(guild.me).send_messages:
-                        await target_channel.send(embed=embed)
-                        sent_count += 1
-                    else:
-                        failed_count += 1
-                except Exception as e:
-                    print(f"⚠️ 無法發送到 {guild.name}: {str(e)}")
-                    failed_count += 1
+        image_url = BROADCAST_IMAGES.get(selected_image)
+        
+        try:
+            await interaction.response.defer(ephemeral=True)
             
-            # 準備回應
-            result_embed = discord.Embed(title="✅ 廣播已發送", color=discord.Color.green())
-            result_embed.description = f"廣播訊息已發送到 {sent_count} 個伺服器"
-            if failed_count > 0:
-                result_embed.add_field(name="⚠️ 失敗伺服器", value=f"{failed_count} 個", inline=False)
-            result_embed.add_field(name="廣播內容", value=self.message[:1024], inline=False)
+            async def _report(job_id, progress):
+                result_embed = discord.Embed(title="✅ 廣播已發送", color=discord.Color.green())
+                result_embed.description = f"廣播訊息已發送到 {progress['sent']} 個伺服器"
+                if progress['failed'] > 0:
+                    result_embed.add_field(name="⚠️ 失敗伺服器", value=f"{progress['failed']} 個", inline=False)
+                if progress['skipped'] > 0:
+                    result_embed.add_field(name="🔕 不接收公告", value=f"{progress['skipped']} 個", inline=False)
+                result_embed.add_field(name="廣播內容", value=self.message[:1024], inline=False)
+                result_embed.set_footer(text=f"任務 #{job_id}")
+                await send_broadcast_report(interaction, result_embed)
             
-            await interaction.followup.send(embed=result_embed, ephemeral=True)
-            print(f"✅ 廣播已發送到 {sent_count} 個伺服器（失敗 {failed_count} 個）")
+            # 向所有伺服器發送廣播（背景任務）
+            job_id = await broadcast_jobs.start('announcement', {'message': self.message, 'image_url': image_url}, interaction.user.id, _report)
+            await interaction.followup.send(f"📢 廣播任務 #{job_id} 已開始在背景發送（共 {len(bot.guilds)} 個伺服器），可用 `/廣播狀態` 查看進度", ephemeral=True)
         
         except Exception as e:
             await interaction.followup.send(f"❌ 廣播失敗：{str(e)}", ephemeral=True)
@@ -5342,6 +6934,40 @@ async def broadcast(interaction: Interaction, message: str):
         await interaction.response.send_message(f"❌ 廣播準備失敗：{str(e)}", ephemeral=True)
         print(f"❌ 廣播準備失敗：{str(e)}")
 
+@bot.tree.command(name="廣播狀態", description="查看廣播 / 版主通知任務進度（限開發者）")
+@app_commands.describe(cancel_job_id="要取消的任務編號")
+async def broadcast_status(interaction: Interaction, cancel_job_id: int = None):
+    if not is_bot_admin(interaction.user.id):
+        await interaction.response.send_message("❌ 此指令只有開發者可以使用", ephemeral=True)
+        return
+    
+    if cancel_job_id is not None:
+        if broadcast_jobs.cancel(cancel_job_id):
+            await interaction.response.send_message(f"🛑 已取消廣播任務 #{cancel_job_id}", ephemeral=True)
+        else:
+            await interaction.response.send_message(f"❌ 找不到執行中的任務 #{cancel_job_id}", ephemeral=True)
+        return
+    
+    try:
+        jobs = await run_db(_load_recent_broadcast_jobs)
+        embed = discord.Embed(title="📊 廣播任務狀態", color=discord.Color.blue())
+        if not jobs:
+            embed.description = "目前沒有廣播任務記錄"
+        for job in jobs:
+            # 執行中的任務以記憶體中的即時進度為準
+            progress = broadcast_jobs.progress.get(job.id) or {
+                'sent': job.sent or 0, 'failed': job.failed or 0, 'skipped': job.skipped or 0, 'status': job.status
+            }
+            done = progress['sent'] + progress['failed'] + progress['skipped']
+            embed.add_field(
+                name=f"#{job.id} {BROADCAST_KINDS.get(job.kind, job.kind)} - {progress['status']}",
+                value=f"進度: {done}/{job.total}\n成功 {progress['sent']} / 失敗 {progress['failed']} / 略過 {progress['skipped']}\n建立時間: {job.created_at.strftime('%Y-%m-%d %H:%M:%S') if job.created_at else '未知'}",
+                inline=False
+            )
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+    except Exception as e:
+        await interaction.response.send_message(f"❌ 查詢廣播任務失敗：{str(e)}", ephemeral=True)
+
 @tasks.loop(minutes=30)
 async def send_bot_status_notification():
     """每30分鐘發送機器人狀態到指定頻道"""
@@ -5552,14 +7178,14 @@ async def user_info(interaction: Interaction, user: discord.User = None):
         # 查詢驗證狀態
         verification_status = "❌ 未驗證"
         if interaction.guild:
-            session = SessionLocal()
-            verification = session.query(Verification).filter_by(
-                guild_id=interaction.guild.id,
-                user_id=target_user.id
-            ).first()
+            verification = await run_db(
+                lambda session: session.query(Verification).filter_by(
+                    guild_id=interaction.guild.id,
+                    user_id=target_user.id
+                ).first()
+            )
             if verification and verification.verified:
                 verification_status = "✅ 已驗證"
-            session.close()
         
         embed = discord.Embed(title=f"👤 用戶資訊 - {target_user.name}", color=discord.Color.blue())
         
@@ -5713,60 +7339,22 @@ async def guild_global_blacklist(interaction: Interaction, guild_id: str = None,
             target_guild_id = interaction.guild.id
             guild_name = interaction.guild.name
         
-        session = SessionLocal()
-        
-        # 構建查詢
-        query = session.query(Blacklist).filter_by(guild_id=target_guild_id)
-        
-        # 如果提供了原因，進行過濾
+        # 依原因過濾，分頁顯示
+        filters = [Blacklist.guild_id == target_guild_id]
         if reason:
-            query = query.filter(Blacklist.reason.ilike(f"%{reason}%"))
-        
-        guild_blacklist = query.all()
-        session.close()
-        
-        if not guild_blacklist:
-            if reason:
-                embed = discord.Embed(
-                    title=f"✅ {guild_name} - 全域黑名單",
-                    description=f"沒有找到原因包含「{reason}」的黑名單記錄",
-                    color=discord.Color.green()
-                )
-            else:
-                embed = discord.Embed(
-                    title=f"✅ {guild_name} - 全域黑名單",
-                    description="此伺服器沒有黑名單用戶",
-                    color=discord.Color.green()
-                )
-            await interaction.response.send_message(embed=embed)
-            return
+            filters.append(reason_filter(Blacklist, reason))
         
         title_suffix = f" (原因: {reason})" if reason else ""
-        embed = discord.Embed(
-            title=f"🚫 {guild_name} - 全域黑名單{title_suffix}",
-            description=f"共 {len(guild_blacklist)} 個用戶",
-            color=discord.Color.red()
+        empty_embed = discord.Embed(
+            title=f"✅ {guild_name} - 全域黑名單",
+            description=f"沒有找到原因包含「{reason}」的黑名單記錄" if reason else "此伺服器沒有黑名單用戶",
+            color=discord.Color.green()
+        )
+        await send_paginated_listing(
+            interaction, Blacklist, filters,
+            member_list_renderer(f"🚫 {guild_name} - 全域黑名單{title_suffix}", discord.Color.red(), show_guild=False),
+            empty_embed, ephemeral=False
         )
-        
-        for entry in guild_blacklist[:25]:
-            try:
-                user = await bot.fetch_user(entry.user_id)
-                user_info = f"👤 {user} (ID: {entry.user_id})"
-            except:
-                user_info = f"👤 ID: {entry.user_id}"
-            
-            embed.add_field(
-                name=user_info,
-                value=f"原因: {entry.reason}\n時間: {entry.added_at.strftime('%Y-%m-%d %H:%M:%S') if entry.added_at else '未知'}",
-                inline=False
-            )
-        
-        if len(guild_blacklist) > 25:
-            embed.add_field(name="⚠️ 提示", value=f"還有 {len(guild_blacklist) - 25} 個用戶未顯示", inline=False)
-        
-        embed.set_footer(text=f"查詢時間：{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        
-        await interaction.response.send_message(embed=embed)
     
     except Exception as e:
         await interaction.response.send_message(f"❌ 查詢失敗：{str(e)}", ephemeral=True)
@@ -5880,73 +7468,753 @@ import json
 import os
 
 BACKUP_DIR = "server_backups"
+BACKUP_MEMBER_BATCH = 1000  # 每批写入的成员数
+BACKUP_FULL_EVERY = 24  # 连续几个增量备份后改做一次完整备份
+BACKUP_RETENTION_DAYS = 7  # 超过此天数的增量备份链会被压缩成一个完整备份
+backup_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="backup")  # 备份文件读写（单线程保证写入顺序）
 
 def ensure_backup_dir():
     """确保备份目录存在"""
     if not os.path.exists(BACKUP_DIR):
         os.makedirs(BACKUP_DIR)
 
-@bot.tree.command(name="備份伺服器", description="备份服务器数据（仅开发者）")
-async def backup_server(interaction: Interaction):
-    """备份服务器的频道、角色和成员信息"""
-    if not is_bot_admin(interaction.user.id):
-        await interaction.response.send_message("❌ 此指令只有开发者可以使用", ephemeral=True)
-        return
-    
-    await interaction.response.defer()
+def backup_record_hash(item):
+    """记录内容的 64 位哈希，用于判断增量备份时记录是否有变更"""
+    encoded = json.dumps(item, ensure_ascii=False, sort_keys=True, separators=(',', ':')).encode()
+    return int.from_bytes(hashlib.blake2b(encoded, digest_size=8).digest(), 'little')
+
+def backup_index_path(path):
+    """备份对应的记录哈希索引文件（备份完成后快照中每条记录的 id -> 内容哈希）"""
+    return path + ".idx"
+
+def load_backup_index(path):
+    with gzip.open(backup_index_path(path), 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+class BackupWriter:
+    """流式写入 gzip 压缩的 JSON Lines 备份：每行一条记录（header / channel / role / member / deleted / footer），
+    写入在 backup_executor 中进行，成员边获取边写入，整份备份不需要留在内存中。
+    提供上一个备份的哈希索引时为增量备份：只写入内容有变更的记录与已删除的记录"""
+    
+    def __init__(self, path, previous=None):
+        self.path = path
+        self.previous = previous
+        self.index = defaultdict(dict)  # 类型 -> {id: 内容哈希}
+        self.counts = defaultdict(int)  # 备份完成后快照中的记录数
+        self.changed = 0  # 实际写入的记录数
+        self._file = None
+        self._pending = None
+    
+    def _open(self):
+        self._file = gzip.open(self.path, 'wt', encoding='utf-8', compresslevel=6)
+    
+    def _write_records(self, records):
+        for record in records:
+            self._file.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')))
+            self._file.write('\n')
+    
+    def _write_items(self, kind, items):
+        known = self.previous.get(kind, {}) if self.previous is not None else None
+        changed = []
+        for item in items:
+            key = str(item['id'])
+            digest = backup_record_hash(item)
+            self.index[kind][key] = digest
+            if known is None or known.get(key) != digest:
+                changed.append(dict(item, type=kind))
+        self.counts[kind] += len(items)
+        self.changed += len(changed)
+        self._write_records(changed)
+    
+    def _finish(self):
+        if self.previous is not None:
+            for kind, known in self.previous.items():
+                current = self.index.get(kind, {})
+                deleted = [{'type': 'deleted', 'kind': kind, 'id': int(key)} for key in known if key not in current]
+                self.changed += len(deleted)
+                self._write_records(deleted)
+        self._write_records([{'type': 'footer', 'counts': dict(self.counts)}])
+        self._file.close()
+        self._file = None
+        with gzip.open(backup_index_path(self.path), 'wt', encoding='utf-8') as f:
+            json.dump(self.index, f, separators=(',', ':'))
+    
+    def _discard(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+        for path in (self.path, backup_index_path(self.path)):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    async def _submit(self, func, *args):
+        """等待上一批写入完成后再提交下一批（最多一批在写入中，避免内存堆积）"""
+        if self._pending is not None:
+            pending, self._pending = self._pending, None
+            await pending
+        self._pending = asyncio.get_running_loop().run_in_executor(backup_executor, func, *args)
+    
+    async def open(self, header):
+        await self._submit(self._open)
+        await self._submit(self._write_records, [dict(header, type='header')])
+    
+    async def write(self, kind, items):
+        if items:
+            await self._submit(self._write_items, kind, items)
+    
+    async def close(self):
+        """写入删除记录与 footer（记录数，用于确认备份完整）并关闭文件，返回文件大小"""
+        await self._submit(self._finish)
+        pending, self._pending = self._pending, None
+        await pending
+        return os.path.getsize(self.path)
+    
+    async def abort(self):
+        """失败时关闭并删除不完整的备份文件"""
+        if self._pending is not None:
+            try:
+                await self._pending
+            except Exception:
+                pass
+            self._pending = None
+        await asyncio.get_running_loop().run_in_executor(backup_executor, self._discard)
+
+def iter_backup_records(path):
+    """逐条读取备份记录（兼容旧版整份 .json 备份）"""
+    if path.endswith('.jsonl.gz'):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        return
+    
+    with open(path, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    yield {'type': 'header', 'guild_id': data['guild_id'], 'guild_name': data['guild_name'], 'timestamp': data['timestamp']}
+    for kind, key in (('channel', 'channels'), ('role', 'roles'), ('member', 'members')):
+        for item in data[key]:
+            yield dict(item, type=kind)
+    yield {'type': 'footer'}
+
+def summarize_backup(path):
+    """统计备份的时间与各类记录数（在 backup_executor 中执行）"""
+    summary = {'timestamp': None, 'kind': 'full', 'channel': 0, 'role': 0, 'member': 0, 'complete': False}
+    for record in iter_backup_records(path):
+        kind = record['type']
+        if kind == 'header':
+            summary['timestamp'] = record['timestamp']
+            summary['kind'] = record.get('kind', 'full')
+        elif kind == 'footer':
+            summary['complete'] = True
+        elif kind in summary:
+            summary[kind] += 1
+    return summary
+
+def load_backup_snapshot(paths):
+    """依序套用完整备份与之后的增量备份，返回快照：类型 -> {id: 记录}（在 backup_executor 中执行）"""
+    snapshot = {'header': None, 'channel': {}, 'role': {}, 'member': {}, 'complete': True}
+    for path in paths:
+        complete = False
+        for record in iter_backup_records(path):
+            kind = record.pop('type')
+            if kind == 'header':
+                snapshot['header'] = record
+            elif kind == 'footer':
+                complete = True
+            elif kind == 'deleted':
+                snapshot[record['kind']].pop(record['id'], None)
+            elif kind in snapshot:
+                snapshot[kind][record['id']] = record
+        snapshot['complete'] = snapshot['complete'] and complete
+    return snapshot
+
+def verify_backup_files(chain):
+    """检查备份链中的文件都存在且校验和相符，返回错误信息（没有问题时为 None）"""
+    for backup in chain:
+        path = os.path.join(BACKUP_DIR, backup.file_name)
+        if not os.path.exists(path):
+            return f"备份文件 `{backup.file_name}` 不存在"
+        if backup.checksum and file_sha256(path) != backup.checksum:
+            return f"备份 #{backup.id} 校验和不符，文件可能已损坏"
+    return None
+
+async def run_backup_io(func, *args):
+    """在 backup_executor 中执行备份文件读取，不阻塞事件循环"""
+    return await asyncio.get_running_loop().run_in_executor(backup_executor, functools.partial(func, *args))
+
+def format_file_size(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f"{size:.1f} {unit}" if unit != 'B' else f"{size} B"
+        size /= 1024
+    return f"{size:.1f} GB"
+
+# 备份目录：每个备份的伺服器、时间、记录数、大小与校验和记录在 server_backups 表，
+# 列表与选择备份只需查询数据库，不需要读取备份文件
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _record_backup(session, guild_id, file_name, created_at, counts, size_bytes, checksum, kind='full', base_id=None, changed_count=None):
+    entry = ServerBackup(
+        guild_id=guild_id,
+        file_name=file_name,
+        kind=kind,
+        base_id=base_id,
+        channel_count=counts.get('channel', 0),
+        role_count=counts.get('role', 0),
+        member_count=counts.get('member', 0),
+        changed_count=changed_count,
+        size_bytes=size_bytes,
+        checksum=checksum,
+        created_at=created_at
+    )
+    session.add(entry)
+    session.commit()
+    return entry.id
+
+def _load_recent_backups(session, guild_id, limit=10):
+    total = session.query(func.count(ServerBackup.id)).filter_by(guild_id=guild_id).scalar()
+    entries = session.query(ServerBackup).filter_by(guild_id=guild_id).order_by(ServerBackup.id.desc()).limit(limit).all()
+    return total, entries
+
+def _load_backup_chain(session, guild_id, backup_id=None):
+    """取得还原指定备份需要的备份链（从完整备份到目标备份；backup_id 为 None 时取最新的备份）"""
+    query = session.query(ServerBackup).filter_by(guild_id=guild_id)
+    if backup_id is not None:
+        query = query.filter_by(id=backup_id)
+    backup = query.order_by(ServerBackup.id.desc()).first()
+    if not backup:
+        return []
+    chain = [backup]
+    while chain[-1].kind == 'incremental':
+        base = session.query(ServerBackup).filter_by(id=chain[-1].base_id).first()
+        if not base:
+            raise ValueError(f"备份 #{chain[-1].id} 的基础备份已不存在")
+        chain.append(base)
+    chain.reverse()
+    return chain
+
+def _tracked_backup_files(session):
+    return {file_name for file_name, in session.query(ServerBackup.file_name).all()}
+
+def _scan_untracked_backups(tracked):
+    """读取尚未记录在备份目录中的旧备份文件（在 backup_executor 中执行）"""
+    found = []
+    for file_name in sorted(os.listdir(BACKUP_DIR)):
+        guild_part = file_name.split('_', 1)[0]
+        if file_name in tracked or file_name.endswith('.idx') or not guild_part.isdigit():
+            continue
+        path = os.path.join(BACKUP_DIR, file_name)
+        try:
+            summary = summarize_backup(path)
+        except Exception as e:
+            print(f"⚠️ 无法读取备份文件 {file_name}：{str(e)}")
+            continue
+        if summary['kind'] != 'full':
+            print(f"⚠️ 略过未登记的增量备份 {file_name}（缺少基础备份记录）")
+            continue
+        if summary['timestamp']:
+            created_at = datetime.strptime(summary['timestamp'], "%Y-%m-%d %H:%M:%S")
+        else:
+            created_at = datetime.fromtimestamp(os.path.getmtime(path))
+        found.append((int(guild_part), file_name, created_at, summary, os.path.getsize(path), file_sha256(path)))
+    return found
+
+async def import_untracked_backups():
+    """启动时把备份目录中尚未登记的备份文件补登记到 server_backups"""
+    if not os.path.isdir(BACKUP_DIR):
+        return
+    tracked = await run_db(_tracked_backup_files)
+    found = await run_backup_io(_scan_untracked_backups, tracked)
+    for guild_id, file_name, created_at, summary, size_bytes, checksum in found:
+        await run_db(_record_backup, guild_id, file_name, created_at, summary, size_bytes, checksum)
+    if found:
+        print(f"✅ 已登记 {len(found)} 个旧备份文件")
+
+async def _iter_backup_members(guild):
+    """成员缓存已完整时直接使用缓存，否则通过 API 获取"""
+    if guild.chunked:
+        for member in guild.members:
+            yield member
+    else:
+        async for member in guild.fetch_members(limit=None):
+            yield member
+
+async def create_server_backup(guild, force_full=False):
+    """备份伺服器：上一个备份可用且备份链未超过 BACKUP_FULL_EVERY 时做增量备份，否则做完整备份"""
+    ensure_backup_dir()
+    started = perf_counter()
+    
+    previous = None
+    base = None
+    chain = [] if force_full else await run_db(_load_backup_chain, guild.id)
+    if chain and len(chain) <= BACKUP_FULL_EVERY:
+        base = chain[-1]
+        try:
+            previous = await run_backup_io(load_backup_index, os.path.join(BACKUP_DIR, base.file_name))
+        except Exception:
+            base = None  # 旧版备份没有哈希索引，改做完整备份
     
+    created_at = datetime.now().replace(microsecond=0)
+    backup_file = os.path.join(BACKUP_DIR, f"{guild.id}_{created_at.strftime('%Y%m%d_%H%M%S')}.jsonl.gz")
+    writer = BackupWriter(backup_file, previous)
     try:
-        ensure_backup_dir()
-        guild = interaction.guild
-        
-        if not guild:
-            await interaction.followup.send("❌ 此指令只能在伺服器中使用", ephemeral=True)
-            return
-        
-        # 准备备份数据
-        backup_data = {
+        await writer.open({
             "guild_id": guild.id,
             "guild_name": guild.name,
-            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            "channels": [],
-            "roles": [],
-            "members": []
-        }
+            "timestamp": created_at.strftime("%Y-%m-%d %H:%M:%S"),
+            "kind": "incremental" if base else "full",
+            "base_id": base.id if base else None
+        })
         
         # 备份频道
+        channels = []
         for channel in guild.channels:
             channel_info = {
                 "id": channel.id,
                 "name": channel.name,
                 "type": str(channel.type),
-                "position": channel.position
+                "position": channel.position,
+                "category_id": channel.category_id
             }
             if isinstance(channel, discord.TextChannel):
                 channel_info["topic"] = channel.topic
-            backup_data["channels"].append(channel_info)
+            channels.append(channel_info)
+        await writer.write("channel", channels)
         
         # 备份角色
-        for role in guild.roles:
-            if role != guild.default_role:
-                backup_data["roles"].append({
-                    "id": role.id,
-                    "name": role.name,
-                    "color": str(role.color),
-                    "permissions": role.permissions.value
-                })
+        await writer.write("role", [
+            {
+                "id": role.id,
+                "name": role.name,
+                "color": str(role.color),
+                "permissions": role.permissions.value,
+                "position": role.position,
+                "hoist": role.hoist,
+                "mentionable": role.mentionable,
+                "managed": role.managed
+            }
+            for role in guild.roles if role != guild.default_role
+        ])
         
-        # 备份成员
-        async for member in guild.fetch_members(limit=None):
-            backup_data["members"].append({
+        # 备份成员（边获取边分批写入）
+        batch = []
+        async for member in _iter_backup_members(guild):
+            batch.append({
                 "id": member.id,
                 "name": member.name,
                 "roles": [r.id for r in member.roles if r != guild.default_role]
             })
+            if len(batch) >= BACKUP_MEMBER_BATCH:
+                await writer.write("member", batch)
+                batch = []
+        await writer.write("member", batch)
+        
+        file_size = await writer.close()
+    except Exception:
+        await writer.abort()
+        raise
+    
+    checksum = await run_backup_io(file_sha256, backup_file)
+    backup_id = await run_db(
+        _record_backup, guild.id, os.path.basename(backup_file), created_at, writer.counts, file_size, checksum,
+        "incremental" if base else "full", base.id if base else None, writer.changed
+    )
+    return {
+        'id': backup_id,
+        'file_name': os.path.basename(backup_file),
+        'kind': "incremental" if base else "full",
+        'base_id': base.id if base else None,
+        'counts': writer.counts,
+        'changed': writer.changed,
+        'size': file_size,
+        'elapsed': perf_counter() - started
+    }
+
+# 备份链压缩：把超过保留期的最新一个增量备份改写成完整备份，并删除链中已被合并的增量备份；
+# 完整备份（包括链的起点）不会被删除
+def _load_compaction_targets(session, cutoff):
+    """每个伺服器在 cutoff 之前的最新备份（只有增量备份需要压缩）"""
+    rows = session.query(func.max(ServerBackup.id)).filter(ServerBackup.created_at < cutoff).group_by(ServerBackup.guild_id).all()
+    return session.query(ServerBackup).filter(
+        ServerBackup.id.in_([backup_id for backup_id, in rows]),
+        ServerBackup.kind == 'incremental'
+    ).all()
+
+def _replace_with_full_backup(session, backup_id, file_name, size_bytes, checksum):
+    backup = session.query(ServerBackup).filter_by(id=backup_id).first()
+    backup.file_name = file_name
+    backup.kind = 'full'
+    backup.base_id = None
+    backup.size_bytes = size_bytes
+    backup.checksum = checksum
+    session.commit()
+
+def _delete_backup_rows(session, backup_ids):
+    session.query(ServerBackup).filter(ServerBackup.id.in_(backup_ids)).delete(synchronize_session=False)
+    session.commit()
+
+def _remove_backup_files(file_names):
+    for file_name in file_names:
+        path = os.path.join(BACKUP_DIR, file_name)
+        for target in (path, backup_index_path(path)):
+            if os.path.exists(target):
+                os.remove(target)
+
+async def compact_backup_chain(target):
+    """把增量备份 target 改写成完整备份，再删除链中已合并进来的增量备份，返回删除数量"""
+    chain = await run_db(_load_backup_chain, target.guild_id, target.id)
+    if target.kind == 'incremental':
+        snapshot = await run_backup_io(load_backup_snapshot, [os.path.join(BACKUP_DIR, backup.file_name) for backup in chain])
+        path = os.path.join(BACKUP_DIR, target.file_name.replace('.jsonl.gz', '_full.jsonl.gz'))
+        writer = BackupWriter(path)
+        try:
+            await writer.open(dict(snapshot['header'], kind='full', base_id=None))
+            for kind in ('channel', 'role', 'member'):
+                records = list(snapshot[kind].values())
+                for i in range(0, len(records), BACKUP_MEMBER_BATCH):
+                    await writer.write(kind, records[i:i + BACKUP_MEMBER_BATCH])
+            size_bytes = await writer.close()
+        except Exception:
+            await writer.abort()
+            raise
+        checksum = await run_backup_io(file_sha256, path)
+        await run_db(_replace_with_full_backup, target.id, os.path.basename(path), size_bytes, checksum)
+        await run_backup_io(_remove_backup_files, [target.file_name])
+    
+    # 之后的备份只会以 target 或更新的备份为基础，链中较早的增量备份已不再被引用
+    folded = [backup for backup in chain[:-1] if backup.kind == 'incremental']
+    if folded:
+        await run_db(_delete_backup_rows, [backup.id for backup in folded])
+        await run_backup_io(_remove_backup_files, [backup.file_name for backup in folded])
+    return len(folded)
+
+@tasks.loop(hours=24)
+async def compact_server_backups():
+    """每日压缩超过保留期的增量备份链"""
+    try:
+        cutoff = datetime.now() - timedelta(days=BACKUP_RETENTION_DAYS)
+        removed = 0
+        for target in await run_db(_load_compaction_targets, cutoff):
+            try:
+                removed += await compact_backup_chain(target)
+            except Exception as e:
+                print(f"⚠️ 无法压缩伺服器 {target.guild_id} 的备份：{str(e)}")
+        if removed:
+            print(f"✅ 备份压缩完成，已删除 {removed} 个旧备份")
+    except Exception as e:
+        print(f"⚠️ 备份压缩失败：{str(e)}")
+
+# 备份还原引擎：比对备份快照与现有伺服器，只重建缺少的部分。任务依赖顺序：
+# 角色（按位置依序创建，最后统一调整位置）-> 分类 -> 频道；已存在频道的主题修正可并行；成员角色在所有角色创建后补上。
+# 同一路由的请求保持最小间隔，遇到 429 依 retry_after 暂停后重试
+RESTORE_CONCURRENCY = 5  # 同时进行的请求数
+RESTORE_ROUTE_INTERVALS = {  # 各类请求在同一路由上的最小间隔（秒），同时用于估算耗时
+    'role': 1.0,
+    'channel': 1.0,
+    'topic': 0.5,
+    'member': 0.3,
+}
+RESTORE_MAX_RETRIES = 3
+RESTORE_REASON = "从备份还原"
+RESTORE_CHANNEL_TYPES = {'category', 'text', 'news', 'voice', 'stage_voice', 'forum'}
+
+class RestoreJob:
+    __slots__ = ('key', 'kind', 'route', 'action', 'deps', 'label')
+    
+    def __init__(self, key, kind, route, action, deps=(), label=None):
+        self.key = key
+        self.kind = kind
+        self.route = route
+        self.action = action
+        self.deps = list(deps)
+        self.label = label
+
+class RestoreEngine:
+    """还原任务图：plan() 比对并建立任务（不呼叫 API），estimate() 估算耗时，run() 依依赖顺序并行执行"""
+    
+    def __init__(self, guild, snapshot):
+        self.guild = guild
+        self.snapshot = snapshot
+        self.jobs = {}  # key -> RestoreJob（加入顺序即依赖顺序）
+        self.role_map = {}  # 备份角色 id -> 现有角色
+        self.category_map = {}  # 备份分类 id -> 现有分类
+        self.created_roles = []  # (角色, 备份中的位置)
+        self.member_roles = []  # (成员, 缺少的备份角色 id)
+        self.skipped_channels = 0
+        self.completed = defaultdict(int)
+        self.failed = defaultdict(int)
+        self.rate_limited = 0
+        self.errors = []
+        self._route_ready_at = {}
+        self._semaphore = None
+    
+    def _add(self, job):
+        self.jobs[job.key] = job
+    
+    async def plan(self):
+        guild = self.guild
+        
+        # 角色：按备份中的位置由低到高依序创建
+        live_roles = {role.name: role for role in guild.roles}
+        role_keys = {}
+        previous_key = None
+        for record in sorted(self.snapshot['role'].values(), key=lambda r: r.get('position', 0)):
+            if record.get('managed'):
+                continue
+            role = guild.get_role(record['id']) or live_roles.get(record['name'])
+            if role:
+                self.role_map[record['id']] = role
+                continue
+            key = ('role', record['id'])
+            self._add(RestoreJob(key, 'role', ('role', guild.id), functools.partial(self._create_role, record),
+                                 deps=[previous_key] if previous_key else [], label=f"角色 {record['name']}"))
+            role_keys[record['id']] = key
+            previous_key = key
+        if role_keys:
+            self._add(RestoreJob(('role_positions',), 'role', ('role', guild.id), self._apply_role_positions,
+                                 deps=list(role_keys.values()), label="角色位置"))
+        
+        # 分类与频道：频道依赖所属分类
+        live_channels = {(channel.name, str(channel.type)): channel for channel in guild.channels}
+        channels = sorted(self.snapshot['channel'].values(), key=lambda c: c.get('position', 0))
+        category_keys = {}
+        for record in channels:
+            if record['type'] != 'category':
+                continue
+            category = guild.get_channel(record['id']) or live_channels.get((record['name'], 'category'))
+            if category:
+                self.category_map[record['id']] = category
+                continue
+            key = ('category', record['id'])
+            self._add(RestoreJob(key, 'channel', ('channel', guild.id), functools.partial(self._create_channel, record),
+                                 label=f"分类 {record['name']}"))
+            category_keys[record['id']] = key
+        
+        for record in channels:
+            if record['type'] == 'category':
+                continue
+            channel = guild.get_channel(record['id']) or live_channels.get((record['name'], record['type']))
+            if channel:
+                topic = record.get('topic')
+                if topic is not None and isinstance(channel, discord.TextChannel) and channel.topic != topic:
+                    self._add(RestoreJob(('topic', record['id']), 'topic', ('topic', channel.id),
+                                         functools.partial(self._edit_topic, channel, topic), label=f"频道主题 {channel.name}"))
+                continue
+            if record['type'] not in RESTORE_CHANNEL_TYPES:
+                self.skipped_channels += 1
+                continue
+            category_key = category_keys.get(record.get('category_id'))
+            self._add(RestoreJob(('channel', record['id']), 'channel', ('channel', guild.id),
+                                 functools.partial(self._create_channel, record),
+                                 deps=[category_key] if category_key else [], label=f"频道 {record['name']}"))
+        
+        # 成员角色：只处理仍在伺服器中、缺少备份角色的成员
+        for i, record in enumerate(self.snapshot['member'].values(), 1):
+            if i % 5000 == 0:
+                await asyncio.sleep(0)  # 大型伺服器分段让出事件循环
+            member = guild.get_member(record['id'])
+            if not member:
+                continue
+            current = {role.id for role in member.roles}
+            missing = [
+                role_id for role_id in record.get('roles', ())
+                if role_id in role_keys or (role_id in self.role_map and self.role_map[role_id].id not in current)
+            ]
+            if missing:
+                self.member_roles.append((member, missing))
+        if self.member_roles:
+            self._add(RestoreJob(('member_roles',), 'member', ('member', guild.id), self._assign_member_roles,
+                                 deps=list(role_keys.values()), label="成员角色"))
+    
+    def summary(self):
+        counts = defaultdict(int)
+        for key in self.jobs:
+            counts[key[0]] += 1
+        return {
+            'role': counts['role'],
+            'category': counts['category'],
+            'channel': counts['channel'],
+            'topic': counts['topic'],
+            'member': len(self.member_roles),
+            'skipped_channels': self.skipped_channels,
+        }
+    
+    def _job_cost(self, job):
+        count = len(self.member_roles) if job.key == ('member_roles',) else 1
+        return count * RESTORE_ROUTE_INTERVALS[job.kind]
+    
+    def estimate(self):
+        """估算耗时（秒）：取依赖链最长路径与单一路由累计间隔两者的较大值"""
+        finish = {}
+        route_totals = defaultdict(float)
+        for key, job in self.jobs.items():
+            cost = self._job_cost(job)
+            finish[key] = max((finish[dep] for dep in job.deps), default=0.0) + cost
+            route_totals[job.route] += cost
+        return max([*finish.values(), *route_totals.values()], default=0.0)
+    
+    async def _call(self, route, kind, coro_factory):
+        for attempt in range(RESTORE_MAX_RETRIES + 1):
+            delay = self._route_ready_at.get(route, 0) - monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._route_ready_at[route] = max(self._route_ready_at.get(route, 0), monotonic()) + RESTORE_ROUTE_INTERVALS[kind]
+            try:
+                async with self._semaphore:
+                    return await coro_factory()
+            except discord.HTTPException as e:
+                if e.status != 429 or attempt == RESTORE_MAX_RETRIES:
+                    raise
+                self.rate_limited += 1
+                self._route_ready_at[route] = monotonic() + (getattr(e, 'retry_after', None) or 1.0)
+    
+    async def _create_role(self, record):
+        role = await self._call(('role', self.guild.id), 'role', lambda: self.guild.create_role(
+            name=record['name'],
+            colour=discord.Colour(int(record.get('color', '#000000').lstrip('#'), 16)),
+            permissions=discord.Permissions(record.get('permissions', 0)),
+            hoist=record.get('hoist', False),
+            mentionable=record.get('mentionable', False),
+            reason=RESTORE_REASON
+        ))
+        self.role_map[record['id']] = role
+        self.created_roles.append((role, record.get('position', 1)))
+    
+    async def _apply_role_positions(self):
+        top = self.guild.me.top_role.position
+        positions = {role: max(1, min(position, top - 1)) for role, position in self.created_roles}
+        if positions:
+            await self._call(('role', self.guild.id), 'role', lambda: self.guild.edit_role_positions(positions, reason=RESTORE_REASON))
+    
+    async def _create_channel(self, record):
+        kwargs = {'name': record['name'], 'reason': RESTORE_REASON}
+        if record.get('position') is not None:
+            kwargs['position'] = record['position']
+        route = ('channel', self.guild.id)
+        if record['type'] == 'category':
+            self.category_map[record['id']] = await self._call(route, 'channel', lambda: self.guild.create_category(**kwargs))
+            return
+        
+        category = self.category_map.get(record.get('category_id'))
+        if category:
+            kwargs['category'] = category
+        if record['type'] in ('text', 'news'):
+            if record.get('topic'):
+                kwargs['topic'] = record['topic']
+            await self._call(route, 'channel', lambda: self.guild.create_text_channel(**kwargs))
+        elif record['type'] == 'voice':
+            await self._call(route, 'channel', lambda: self.guild.create_voice_channel(**kwargs))
+        elif record['type'] == 'stage_voice':
+            await self._call(route, 'channel', lambda: self.guild.create_stage_channel(**kwargs))
+        else:
+            await self._call(route, 'channel', lambda: self.guild.create_forum(**kwargs))
+    
+    async def _edit_topic(self, channel, topic):
+        await self._call(('topic', channel.id), 'topic', lambda: channel.edit(topic=topic, reason=RESTORE_REASON))
+    
+    async def _assign_member_roles(self):
+        top_role = self.guild.me.top_role
+        route = ('member', self.guild.id)
+        for member, role_ids in self.member_roles:
+            roles = [
+                role for role in map(self.role_map.get, role_ids)
+                if role and not role.managed and role < top_role and role not in member.roles
+            ]
+            if not roles:
+                continue
+            try:
+                await self._call(route, 'member', lambda: member.add_roles(*roles, reason=RESTORE_REASON))
+                self.completed['member'] += 1
+            except Exception as e:
+                self.failed['member'] += 1
+                if len(self.errors) < 10:
+                    self.errors.append(f"成员 {member}：{str(e)}")
+    
+    async def _run_job(self, job, deps):
+        if deps:
+            await asyncio.gather(*deps)  # 依赖只决定顺序：依赖失败时仍继续（例如分类建立失败，频道不放入分类）
+        try:
+            await job.action()
+            if job.key[0] not in ('role_positions', 'member_roles'):  # 成员角色逐人计数
+                self.completed[job.kind] += 1
+        except Exception as e:
+            self.failed[job.kind] += 1
+            if len(self.errors) < 10:
+                self.errors.append(f"{job.label}：{str(e)}")
+    
+    async def run(self):
+        self._semaphore = asyncio.Semaphore(RESTORE_CONCURRENCY)
+        tasks = {}
+        for key, job in self.jobs.items():
+            tasks[key] = asyncio.get_running_loop().create_task(self._run_job(job, [tasks[dep] for dep in job.deps]))
+        await asyncio.gather(*tasks.values())
+
+active_restores = {}  # guild_id -> 执行中的 RestoreEngine（准备阶段为 None，先占住避免同时还原）
+
+def format_duration(seconds):
+    seconds = int(math.ceil(seconds))
+    if seconds >= 3600:
+        return f"{seconds // 3600} 小时 {seconds % 3600 // 60} 分"
+    if seconds >= 60:
+        return f"{seconds // 60} 分 {seconds % 60} 秒"
+    return f"{seconds} 秒"
+
+async def run_restore_job(engine, channel):
+    """在背景执行还原，完成后在指令频道发送结果"""
+    guild = engine.guild
+    started = perf_counter()
+    try:
+        await engine.run()
+    except Exception as e:
+        engine.errors.append(f"还原中断：{str(e)}")
+    finally:
+        active_restores.pop(guild.id, None)
+    
+    failed = sum(engine.failed.values())
+    embed = discord.Embed(
+        title="✅ 伺服器还原完成" if not failed else "⚠️ 伺服器还原完成（部分失败）",
+        description=f"已还原 {guild.name} 到备份状态",
+        color=discord.Color.green() if not failed else discord.Color.orange()
+    )
+    embed.add_field(name="角色", value=f"{engine.completed['role']} 项", inline=True)
+    embed.add_field(name="分类 / 频道", value=f"{engine.completed['channel']} 个", inline=True)
+    embed.add_field(name="频道主题", value=f"{engine.completed['topic']} 个", inline=True)
+    embed.add_field(name="成员角色", value=f"{engine.completed['member']} 人", inline=True)
+    embed.add_field(name="失败", value=f"{failed} 项", inline=True)
+    embed.add_field(name="耗时", value=format_duration(perf_counter() - started), inline=True)
+    if engine.errors:
+        embed.add_field(name="⚠️ 还原错误", value="\n".join(engine.errors)[:1024], inline=False)
+    print(f"✅ 已还原伺服器 {guild.name} (ID: {guild.id})：失败 {failed} 项，速率限制 {engine.rate_limited} 次")
+    if channel:
+        try:
+            await channel.send(embed=embed)
+        except Exception as e:
+            print(f"⚠️ 无法发送还原结果：{str(e)}")
+
+@bot.tree.command(name="備份伺服器", description="备份服务器数据（仅开发者）")
+@app_commands.describe(full="强制完整备份（默认在上一个备份的基础上做增量备份）")
+async def backup_server(interaction: Interaction, full: bool = False):
+    """备份服务器的频道、角色和成员信息"""
+    if not is_bot_admin(interaction.user.id):
+        await interaction.response.send_message("❌ 此指令只有开发者可以使用", ephemeral=True)
+        return
+    
+    await interaction.response.defer()
+    
+    try:
+        guild = interaction.guild
+        
+        if not guild:
+            await interaction.followup.send("❌ 此指令只能在伺服器中使用", ephemeral=True)
+            return
         
-        # 保存备份文件
-        backup_file = os.path.join(BACKUP_DIR, f"{guild.id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
-        with open(backup_file, 'w', encoding='utf-8') as f:
-            json.dump(backup_data, f, ensure_ascii=False, indent=2)
+        result = await create_server_backup(guild, force_full=full)
+        counts = result['counts']
         
         # 返回确认
         embed = discord.Embed(
@@ -5955,14 +8223,22 @@ async def backup_server(interaction: Interaction):
             color=discord.Color.green()
         )
         embed.add_field(name="伺服器名称", value=guild.name, inline=False)
-        embed.add_field(name="频道数量", value=len(backup_data["channels"]), inline=True)
-        embed.add_field(name="角色数量", value=len(backup_data["roles"]), inline=True)
-        embed.add_field(name="成员数量", value=len(backup_data["members"]), inline=True)
+        embed.add_field(name="频道数量", value=counts["channel"], inline=True)
+        embed.add_field(name="角色数量", value=counts["role"], inline=True)
+        embed.add_field(name="成员数量", value=counts["member"], inline=True)
+        if result['kind'] == 'incremental':
+            embed.add_field(name="备份类型", value=f"增量（基于 #{result['base_id']}）", inline=True)
+            embed.add_field(name="变更记录", value=f"{result['changed']} 条", inline=True)
+        else:
+            embed.add_field(name="备份类型", value="完整", inline=True)
+        embed.add_field(name="文件大小", value=format_file_size(result['size']), inline=True)
+        embed.add_field(name="耗时", value=f"{result['elapsed']:.1f} 秒", inline=True)
         embed.add_field(name="备份时间", value=datetime.now().strftime("%Y-%m-%d %H:%M:%S"), inline=False)
-        embed.add_field(name="备份文件", value=f"`{os.path.basename(backup_file)}`", inline=False)
+        embed.add_field(name="备份 ID", value=f"`{result['id']}`", inline=True)
+        embed.add_field(name="备份文件", value=f"`{result['file_name']}`", inline=False)
         
         await interaction.followup.send(embed=embed)
-        print(f"✅ 已备份伺服器 {guild.name} (ID: {guild.id})")
+        print(f"✅ 已备份伺服器 {guild.name} (ID: {guild.id})：{counts['member']} 个成员，变更 {result['changed']} 条，{format_file_size(result['size'])}，耗时 {result['elapsed']:.1f} 秒")
         
     except Exception as e:
         error_msg = f"❌ 备份失败：{str(e)}"
@@ -5970,9 +8246,9 @@ async def backup_server(interaction: Interaction):
         await interaction.followup.send(error_msg, ephemeral=True)
 
 @bot.tree.command(name="還原到備份", description="还原服务器到备份状态（仅开发者）")
-@app_commands.describe(backup_id="备份文件ID（使用查看备份列表获取）")
-async def restore_from_backup(interaction: Interaction, backup_id: str):
-    """从备份文件还原服务器"""
+@app_commands.describe(backup_id="备份ID（使用查看备份列表获取，输入 latest 使用最新备份）", dry_run="只预览需要重建的内容与预计耗时，不实际执行（默认开启）")
+async def restore_from_backup(interaction: Interaction, backup_id: str, dry_run: bool = True):
+    """从备份文件还原服务器：重建缺少的角色、分类、频道、频道主题与成员角色"""
     if not is_bot_admin(interaction.user.id):
         await interaction.response.send_message("❌ 此指令只有开发者可以使用", ephemeral=True)
         return
@@ -5987,58 +8263,77 @@ async def restore_from_backup(interaction: Interaction, backup_id: str):
             await interaction.followup.send("❌ 此指令只能在伺服器中使用", ephemeral=True)
             return
         
-        # 查找备份文件
-        backup_files = [f for f in os.listdir(BACKUP_DIR) if f.startswith(str(guild.id))]
-        
-        if not backup_files:
-            await interaction.followup.send("❌ 未找到此伺服器的备份", ephemeral=True)
+        if guild.id in active_restores:
+            await interaction.followup.send("❌ 此伺服器已有还原任务进行中", ephemeral=True)
             return
         
-        # 选择最新的备份或指定的备份
-        target_file = os.path.join(BACKUP_DIR, sorted(backup_files)[-1])
-        
-        with open(target_file, 'r', encoding='utf-8') as f:
-            backup_data = json.load(f)
-        
-        # 还原信息
-        restore_info = {
-            "channels_restored": 0,
-            "roles_restored": 0,
-            "errors": []
-        }
-        
-        # 还原频道（需要权限）
-        try:
-            for channel_info in backup_data["channels"]:
-                # 仅记录可还原的频道信息
-                restore_info["channels_restored"] += 1
-        except Exception as e:
-            restore_info["errors"].append(f"频道还原失败：{str(e)}")
-        
-        # 还原角色（需要权限）
+        # 检查后立即占住，准备期间的 await 不会让第二个还原同时通过检查
+        active_restores[guild.id] = None
+        started = False
         try:
-            for role_info in backup_data["roles"]:
-                restore_info["roles_restored"] += 1
-        except Exception as e:
-            restore_info["errors"].append(f"角色还原失败：{str(e)}")
-        
-        # 返回还原结果
-        embed = discord.Embed(
-            title="✅ 伺服器还原完成",
-            description=f"已还原 {guild.name} 到备份状态",
-            color=discord.Color.green()
-        )
-        embed.add_field(name="还原时间", value=backup_data["timestamp"], inline=False)
-        embed.add_field(name="频道信息", value=f"已记录 {restore_info['channels_restored']} 个频道", inline=True)
-        embed.add_field(name="角色信息", value=f"已记录 {restore_info['roles_restored']} 个角色", inline=True)
-        embed.add_field(name="成员信息", value=f"已记录 {len(backup_data['members'])} 个成员", inline=True)
-        
-        if restore_info["errors"]:
-            embed.add_field(name="⚠️ 还原错误", value="\n".join(restore_info["errors"]), inline=False)
-        
-        await interaction.followup.send(embed=embed)
-        print(f"✅ 已还原伺服器 {guild.name} (ID: {guild.id})")
-        
+            # 选择最新的备份或指定的备份
+            if backup_id.strip().lower() in ("latest", "最新"):
+                target_id = None
+            else:
+                try:
+                    target_id = int(backup_id)
+                except ValueError:
+                    await interaction.followup.send("❌ 无效的备份ID", ephemeral=True)
+                    return
+            
+            chain = await run_db(_load_backup_chain, guild.id, target_id)
+            if not chain:
+                await interaction.followup.send("❌ 未找到此伺服器的备份", ephemeral=True)
+                return
+            
+            error = await run_backup_io(verify_backup_files, chain)
+            if error:
+                await interaction.followup.send(f"❌ {error}", ephemeral=True)
+                return
+            
+            snapshot = await run_backup_io(load_backup_snapshot, [os.path.join(BACKUP_DIR, backup.file_name) for backup in chain])
+            if not snapshot["complete"]:
+                await interaction.followup.send("❌ 备份文件不完整（缺少结尾记录），无法还原", ephemeral=True)
+                return
+            
+            engine = RestoreEngine(guild, snapshot)
+            await engine.plan()
+            plan = engine.summary()
+            
+            embed = discord.Embed(
+                title="🔍 还原预览" if dry_run else "⏳ 开始还原",
+                description=f"备份 #{chain[-1].id}（{snapshot['header']['timestamp']}）与 {guild.name} 的差异",
+                color=discord.Color.blue() if dry_run else discord.Color.orange()
+            )
+            embed.add_field(name="需创建角色", value=f"{plan['role']} 个", inline=True)
+            embed.add_field(name="需创建分类", value=f"{plan['category']} 个", inline=True)
+            embed.add_field(name="需创建频道", value=f"{plan['channel']} 个", inline=True)
+            embed.add_field(name="需修正主题", value=f"{plan['topic']} 个", inline=True)
+            embed.add_field(name="需补回角色的成员", value=f"{plan['member']} 人", inline=True)
+            embed.add_field(name="预计耗时", value=format_duration(engine.estimate()), inline=True)
+            if plan['skipped_channels']:
+                embed.add_field(name="⚠️ 略过", value=f"{plan['skipped_channels']} 个不支持的频道类型", inline=False)
+            
+            if not engine.jobs:
+                embed.description += "\n\n✅ 伺服器与备份一致，无需还原"
+                await interaction.followup.send(embed=embed)
+                return
+            
+            if dry_run:
+                embed.set_footer(text="使用 dry_run:False 实际执行还原")
+                await interaction.followup.send(embed=embed)
+                return
+            
+            active_restores[guild.id] = engine
+            started = True
+            await interaction.followup.send(embed=embed)
+            bot.loop.create_task(run_restore_job(engine, interaction.channel))
+            print(f"⏳ 开始还原伺服器 {guild.name} (ID: {guild.id}) 到备份 #{chain[-1].id}")
+        finally:
+            # 预览、提前返回或出错时释放；实际还原由 run_restore_job 结束时释放
+            if not started:
+                active_restores.pop(guild.id, None)
+    
     except Exception as e:
         error_msg = f"❌ 还原失败：{str(e)}"
         print(error_msg)
@@ -6051,42 +8346,40 @@ async def list_backups(interaction: Interaction):
         await interaction.response.send_message("❌ 此指令只有开发者可以使用", ephemeral=True)
         return
     
+    await interaction.response.defer(ephemeral=True)
+    
     try:
         ensure_backup_dir()
         guild = interaction.guild
         
         if not guild:
-            await interaction.response.send_message("❌ 此指令只能在伺服器中使用", ephemeral=True)
+            await interaction.followup.send("❌ 此指令只能在伺服器中使用", ephemeral=True)
             return
         
-        # 查找备份文件
-        backup_files = [f for f in os.listdir(BACKUP_DIR) if f.startswith(str(guild.id))]
+        total, backups = await run_db(_load_recent_backups, guild.id)
         
-        if not backup_files:
-            await interaction.response.send_message("❌ 未找到此伺服器的备份", ephemeral=True)
+        if not backups:
+            await interaction.followup.send("❌ 未找到此伺服器的备份", ephemeral=True)
             return
         
         embed = discord.Embed(
             title=f"📋 {guild.name} 的备份列表",
-            description=f"共找到 {len(backup_files)} 个备份",
+            description=f"共找到 {total} 个备份" + (f"（显示最新 {len(backups)} 个）" if total > len(backups) else ""),
             color=discord.Color.blue()
         )
         
-        for i, backup_file in enumerate(sorted(backup_files)[-10:], 1):
-            file_path = os.path.join(BACKUP_DIR, backup_file)
-            with open(file_path, 'r', encoding='utf-8') as f:
-                backup_data = json.load(f)
-            
+        for backup in backups:
+            kind = f"增量（基于 #{backup.base_id}，变更 {backup.changed_count} 条）" if backup.kind == 'incremental' else "完整"
             embed.add_field(
-                name=f"备份 #{i}",
-                value=f"时间：{backup_data['timestamp']}\n频道：{len(backup_data['channels'])} | 角色：{len(backup_data['roles'])} | 成员：{len(backup_data['members'])}",
+                name=f"备份 ID: {backup.id}",
+                value=f"时间：{backup.created_at.strftime('%Y-%m-%d %H:%M:%S')}\n频道：{backup.channel_count} | 角色：{backup.role_count} | 成员：{backup.member_count}\n类型：{kind} | 大小：{format_file_size(backup.size_bytes or 0)}",
                 inline=False
             )
         
-        await interaction.response.send_message(embed=embed, ephemeral=True)
+        await interaction.followup.send(embed=embed, ephemeral=True)
         
     except Exception as e:
-        await interaction.response.send_message(f"❌ 查看备份列表失败：{str(e)}", ephemeral=True)
+        await interaction.followup.send(f"❌ 查看备份列表失败：{str(e)}", ephemeral=True)
 
 # ====== 防炸群管理命令（斜線指令） ======
 @bot.tree.command(name="防炸狀態", description="查看防炸群保護狀態（需要管理員）")
@@ -6102,12 +8395,17 @@ async def raid_status(interaction: Interaction):
         await interaction.response.send_message("❌ 您沒有管理員權限", ephemeral=True)
         return
     
+    raid_policy = await get_raid_policy(interaction.guild.id)
+    
     embed = discord.Embed(title="🛡️ 防炸群保護狀態", color=discord.Color.green())
-    embed.add_field(name="👥 加入限制", value=f"**{MAX_JOINS_PER_10MIN}人/10分鐘**", inline=True)
-    embed.add_field(name="💬 訊息限制", value=f"**{MAX_MSGS_PER_MINUTE}條/分鐘**", inline=True)
-    embed.add_field(name="🔄 重複訊息", value=f"**{SPAM_THRESHOLD}次觸發**", inline=True)
-    embed.add_field(name="📅 最低帳齡", value=f"**{MIN_ACCOUNT_AGE_DAYS}天**", inline=True)
-    embed.add_field(name="🔥 目前狀態", value="✅ **正常運作中**", inline=False)
+    embed.add_field(name="👥 加入限制", value=f"**{raid_policy.max_joins_per_10min}人/10分鐘**", inline=True)
+    embed.add_field(name="💬 訊息限制", value=f"**{raid_policy.max_msgs_per_minute}條/分鐘**", inline=True)
+    embed.add_field(name="🔄 重複訊息", value=f"**{raid_policy.spam_threshold}次觸發**", inline=True)
+    embed.add_field(name="📅 最低帳齡", value=f"**{raid_policy.min_account_age_days}天**", inline=True)
+    if raid_mode.is_active(interaction.guild.id):
+        embed.add_field(name="🔥 目前狀態", value="🚨 **封鎖模式中**（可用 `/解除防炸模式` 手動解除）", inline=False)
+    else:
+        embed.add_field(name="🔥 目前狀態", value="✅ **正常運作中**", inline=False)
     embed.set_footer(text="由哲學AI寫機器人提供保護")
     await interaction.response.send_message(embed=embed)
 
@@ -6133,7 +8431,7 @@ async def raid_test(interaction: Interaction):
     await interaction.response.send_message(embed=embed)
 
 @bot.tree.command(name="設定防炸", description="設定防炸群參數（需要管理員）")
-@app_commands.describe(類型="設定類型：加入/訊息/重複/帳齡", 值="數值")
+@app_commands.describe(類型="設定類型：加入/訊息/重複/帳齡/重載", 值="數值")
 async def raid_config(interaction: Interaction, 類型: str, 值: int):
     """設定防炸群參數"""
     if not interaction.guild:
@@ -6146,22 +8444,44 @@ async def raid_config(interaction: Interaction, 類型: str, 值: int):
         await interaction.response.send_message("❌ 您沒有管理員權限", ephemeral=True)
         return
     
-    global MAX_JOINS_PER_10MIN, MAX_MSGS_PER_MINUTE, SPAM_THRESHOLD, MIN_ACCOUNT_AGE_DAYS
-    
-    if 類型 == "加入":
-        MAX_JOINS_PER_10MIN = 值
-        await interaction.response.send_message(f"✅ 加入限制已設定為 **{值}人/10分鐘**")
-    elif 類型 == "訊息":
-        MAX_MSGS_PER_MINUTE = 值
-        await interaction.response.send_message(f"✅ 訊息限制已設定為 **{值}條/分鐘**")
-    elif 類型 == "重複":
-        SPAM_THRESHOLD = 值
-        await interaction.response.send_message(f"✅ 重複訊息閾值已設定為 **{值}次**")
-    elif 類型 == "帳齡":
-        MIN_ACCOUNT_AGE_DAYS = 值
-        await interaction.response.send_message(f"✅ 最低帳齡已設定為 **{值}天**")
-    else:
-        await interaction.response.send_message("❌ 使用方式：`/設定防炸 類型:加入/訊息/重複/帳齡 值:[數字]`\n\n例如：\n• `/設定防炸 類型:加入 值:10` - 10分鐘內最多10人加入\n• `/設定防炸 類型:訊息 值:10` - 1分鐘內最多10條訊息\n• `/設定防炸 類型:重複 值:5` - 相同訊息重複5次觸發\n• `/設定防炸 類型:帳齡 值:14` - 帳號至少14天才允許", ephemeral=True)
+    guild_id = interaction.guild.id
+    
+    if 類型 == "重載":
+        # 重新從數據庫載入本伺服器的參數（數據庫被直接修改時使用）
+        guild_config_cache.invalidate(guild_id)
+        raid_policy = await get_raid_policy(guild_id)
+        await interaction.response.send_message(
+            f"✅ 已重新載入防炸群參數：**{raid_policy.max_joins_per_10min}人/10分鐘**、**{raid_policy.max_msgs_per_minute}條/分鐘**、"
+            f"重複 **{raid_policy.spam_threshold}次**、帳齡 **{raid_policy.min_account_age_days}天**"
+        )
+        return
+    
+    settings = {
+        "加入": ('raid_max_joins_per_10min', f"✅ 加入限制已設定為 **{值}人/10分鐘**"),
+        "訊息": ('raid_max_msgs_per_minute', f"✅ 訊息限制已設定為 **{值}條/分鐘**"),
+        "重複": ('raid_spam_threshold', f"✅ 重複訊息閾值已設定為 **{值}次**"),
+        "帳齡": ('raid_min_account_age_days', f"✅ 最低帳齡已設定為 **{值}天**"),
+    }
+    if 類型 not in settings:
+        await interaction.response.send_message("❌ 使用方式：`/設定防炸 類型:加入/訊息/重複/帳齡/重載 值:[數字]`\n\n例如：\n• `/設定防炸 類型:加入 值:10` - 10分鐘內最多10人加入\n• `/設定防炸 類型:訊息 值:10` - 1分鐘內最多10條訊息\n• `/設定防炸 類型:重複 值:5` - 相同訊息重複5次觸發\n• `/設定防炸 類型:帳齡 值:14` - 帳號至少14天才允許\n• `/設定防炸 類型:重載 值:0` - 從數據庫重新載入參數", ephemeral=True)
+        return
+    if 值 < 0 or (值 == 0 and 類型 != "帳齡"):
+        await interaction.response.send_message("❌ 數值必須大於 0", ephemeral=True)
+        return
+    
+    column, reply = settings[類型]
+    
+    def _update_raid_policy(session):
+        guild = _get_or_create_guild(session, guild_id)
+        setattr(guild, column, 值)
+        session.commit()
+    
+    try:
+        await run_db(_update_raid_policy)
+        guild_config_cache.invalidate(guild_id)  # 下一條訊息即使用新參數
+        await interaction.response.send_message(reply)
+    except Exception as e:
+        await interaction.response.send_message(f"❌ 設定失敗：{str(e)}", ephemeral=True)
 
 @bot.tree.command(name="防炸統計", description="查看防炸群統計資訊（需要管理員）")
 async def raid_stats(interaction: Interaction):
@@ -6179,8 +8499,9 @@ async def raid_stats(interaction: Interaction):
     guild_id = interaction.guild.id
     
     # 統計資訊
-    recent_joins = len(join_times.get(guild_id, []))
-    total_spam_blocked = sum(1 for key in spam_messages.keys() if key[0] == guild_id and spam_messages[key] >= SPAM_THRESHOLD)
+    recent_joins = join_times[guild_id].count() if guild_id in join_times else 0
+    spam_threshold = (await get_raid_policy(guild_id)).spam_threshold
+    total_spam_blocked = sum(1 for key in spam_messages.keys() if key[0] == guild_id and spam_messages[key] >= spam_threshold)
     
     embed = discord.Embed(title="📊 防炸群統計資訊", color=discord.Color.blue())
     embed.add_field(name="📈 最近10分鐘加入", value=f"**{recent_joins}** 人", inline=True)
@@ -6208,8 +8529,7 @@ async def clear_raid_logs(interaction: Interaction):
     # 清除記錄
     if guild_id in join_times:
         join_times[guild_id].clear()
-    if guild_id in message_counts:
-        message_counts[guild_id].clear()
+    message_counts.discard_where(lambda key: key[0] == guild_id)
     
     # 清除該伺服器的 spam 記錄
     spam_keys_to_remove = [key for key in spam_messages.keys() if key[0] == guild_id]
@@ -6223,6 +8543,132 @@ async def clear_raid_logs(interaction: Interaction):
     )
     await interaction.response.send_message(embed=embed)
 
+@bot.tree.command(name="解除防炸模式", description="手動解除防炸群封鎖模式（需要管理員）")
+async def exit_raid_mode(interaction: Interaction):
+    """手動解除防炸群封鎖模式"""
+    if not interaction.guild:
+        await interaction.response.send_message("❌ 此指令只能在伺服器中使用", ephemeral=True)
+        return
+    if not is_bot_admin(interaction.user.id):
+        await interaction.response.send_message("❌ 您沒有管理員權限", ephemeral=True)
+        return
+    
+    if raid_mode.exit(interaction.guild.id):
+        await interaction.response.send_message("✅ 已解除防炸群封鎖模式，驗證等級與慢速模式將自動還原")
+    else:
+        await interaction.response.send_message("❌ 此伺服器目前不在封鎖模式中", ephemeral=True)
+
+# ====== 效能監測指令 ======
+@bot.tree.command(name="效能統計", description="查看機器人內部效能統計（限開發者）")
+async def performance_stats(interaction: Interaction):
+    """顯示事件循環延遲與各快取/佇列的統計"""
+    if not is_bot_admin(interaction.user.id):
+        await interaction.response.send_message("❌ 此指令只有開發者可以使用", ephemeral=True)
+        return
+    
+    embed = discord.Embed(title="📈 效能統計", color=discord.Color.blue())
+    
+    samples = event_loop_lag_stats['samples']
+    avg_lag = event_loop_lag_stats['total_ms'] / samples if samples else 0.0
+    embed.add_field(
+        name="⏱️ 事件循環延遲",
+        value=f"最近: {event_loop_lag_stats['last_ms']:.1f} ms\n平均: {avg_lag:.1f} ms\n最大: {event_loop_lag_stats['max_ms']:.1f} ms\n取樣數: {samples}",
+        inline=False
+    )
+    cache_stats = guild_config_cache.stats()
+    embed.add_field(
+        name="⚙️ 伺服器設定快取",
+        value=f"項目: {cache_stats['size']}\n命中: {cache_stats['hits']} | 未命中: {cache_stats['misses']}\n命中率: {cache_stats['hit_rate']:.1f}%\n失效次數: {cache_stats['invalidations']}",
+        inline=False
+    )
+    embed.add_field(
+        name="🚨 防炸群封鎖模式",
+        value=f"目前封鎖中: {len(raid_mode.active_guilds())} 個伺服器\n累計啟動: {raid_mode.activations} 次",
+        inline=False
+    )
+    embed.add_field(
+        name="📨 管理員通知",
+        value=f"已建立索引: {admin_recipient_index.rebuilds} 次\n等待發送: {admin_notifier.pending()}\n已發送: {admin_notifier.sent} 則\n失敗: {admin_notifier.failed}\n合併略過: {admin_notifier.deduplicated}",
+        inline=False
+    )
+    executor_stats = moderation_executor.stats()
+    embed.add_field(
+        name="🔨 審核動作執行器",
+        value=f"佇列深度: {executor_stats['queue_depth']} ({executor_stats['active_guilds']} 個伺服器)\n完成 / 失敗: {executor_stats['completed']} / {executor_stats['failed']}\n批量刪除: {executor_stats['bulk_deletes']} 次\n遇到速率限制: {executor_stats['rate_limited']} 次\n延遲 (平均/最大): {executor_stats['avg_latency_ms']:.1f} / {executor_stats['max_latency_ms']:.1f} ms",
+        inline=False
+    )
+    stage_lines = [
+        f"{name}: {stats['hits']}/{stats['calls']} 命中, 平均 {stats['total_ms'] / stats['calls'] if stats['calls'] else 0:.3f} ms, 最大 {stats['max_ms']:.3f} ms"
+        for name, stats in moderation_stats['stages'].items()
+    ]
+    action_summary = ", ".join(f"{stage} {count}" for stage, count in moderation_stats['actions'].items()) or "無"
+    embed.add_field(
+        name="🛡️ 訊息審核管線",
+        value=f"已審核訊息: {moderation_stats['messages']}\n" + "\n".join(stage_lines) + f"\n處理動作: {action_summary}\n合併略過: {moderation_stats['suppressed']}",
+        inline=False
+    )
+    avg_lateness = expiry_scheduler.total_lateness_ms / expiry_scheduler.fired if expiry_scheduler.fired else 0.0
+    embed.add_field(
+        name="⏲️ 延遲清理排程",
+        value=f"等待中: {expiry_scheduler.pending()}\n已排程: {expiry_scheduler.scheduled}\n已執行: {expiry_scheduler.fired}\n已取消: {expiry_scheduler.cancelled}\n延遲 (平均/最大): {avg_lateness:.1f} / {expiry_scheduler.max_lateness_ms:.1f} ms",
+        inline=False
+    )
+    embed.add_field(
+        name="🧹 用戶狀態儲存",
+        value="\n".join(
+            f"{store.name}: {len(store)}/{store.max_entries} (過期 {store.expired}, 淘汰 {store.evicted})"
+            for store in user_state_stores
+        ),
+        inline=False
+    )
+    audit_stats = command_audit_queue.stats()
+    embed.add_field(
+        name="📢 指令使用審計佇列",
+        value=f"待處理: {audit_stats['pending']}\n已記錄: {audit_stats['enqueued']}\n已丟棄: {audit_stats['dropped']}\n已寫入: {audit_stats['persisted']}\n已發送訊息: {audit_stats['messages_sent']}\n失敗 (寫入/發送): {audit_stats['persist_failures']}/{audit_stats['send_failures']}",
+        inline=False
+    )
+    embed.add_field(
+        name="🚫 黑名單索引",
+        value=f"狀態: {'已載入' if blacklist_index.loaded else '未載入（使用數據庫）'}\n模式: {'精確' if blacklist_index.exact else 'Bloom filter'}\n記錄數: {blacklist_index.entry_count}",
+        inline=False
+    )
+    embed.add_field(
+        name="🎪 包廂資料儲存",
+        value="\n".join(
+            f"{os.path.basename(store.path)}: {len(store)} 筆 (待寫入 {store.pending()}, 寫入 {store.writes}, 壓縮 {store.compactions}, 失敗 {store.failures})"
+            for store in booth_state_stores
+        ),
+        inline=False
+    )
+    embed.add_field(
+        name="🧹 空包廂回收",
+        value=f"待回收: {booth_reaper.pending()}\n已回收: {booth_reaper.reaped} (失敗 {booth_reaper.failed})\n寬限期內取消: {booth_reaper.rescued}\n啟動時清除失效記錄: {booth_reaper.orphans}",
+        inline=False
+    )
+    pool_lines = []
+    for mode, label in (('pooled', "預熱池"), ('on_demand', "即時建立")):
+        stats = booth_pool.latency[mode]
+        avg_ms = stats['total_ms'] / stats['count'] if stats['count'] else 0.0
+        pool_lines.append(f"{label}: {stats['count']} 次 (平均/最大 {avg_ms:.0f} / {stats['max_ms']:.0f} ms)")
+    embed.add_field(
+        name="🎪 包廂建立延遲（進入入口到移入包廂）",
+        value="\n".join(pool_lines),
+        inline=False
+    )
+    embed.add_field(
+        name="👤 用戶資料快取",
+        value=f"快取筆數: {len(user_profile_cache)}\n命中: {user_profile_stats['hits']}\n查詢 API: {user_profile_stats['fetches']}\n查無此人: {user_profile_stats['not_found']}",
+        inline=False
+    )
+    embed.add_field(
+        name="🗄️ 數據庫執行緒池",
+        value=f"工作執行緒: {DB_EXECUTOR_WORKERS}\n排隊中: {db_executor._work_queue.qsize()}",
+        inline=False
+    )
+    
+    embed.set_footer(text=f"查詢時間：{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
 def main():
     print("正在啟動機器人...")
     print("檢查設定...")